@@ -22,13 +22,20 @@
 
 import multiprocessing
 import os
+import pickle
 import random
 
-import numpy as np
-
-from voice_transformation.utils.load import load_utterances_parallel
+from voice_transformation.utils.archive import is_archive, iter_archive_speakers, load_librispeech_archives
+from voice_transformation.utils.load import FeatureCache, get_duration, load_utterances_parallel
 from voice_transformation.utils.dataset import load_librispeech, load_verbmobil
-
+from voice_transformation.utils.journal import Journal
+from voice_transformation.utils.parallel import (SpeakerJob, convert_speaker, convert_speakers_parallel,
+                                                  get_enrollment_paths)
+from voice_transformation.utils.pipeline import ConversionPipeline
+from voice_transformation.utils.sharding import derive_seed, in_shard, parse_shard, reseed
+from voice_transformation.utils.writer import AsyncWriter, FileWriter, TarShardWriter
+
+import soundfile as sf
 import tqdm
 
 
@@ -43,14 +50,53 @@ def main():
     parser.add_argument('corpus', type=str, help='which corpus ? librispeech or verbmobil',
                         choices=['librispeech', 'verbmobil'])
 
-    parser.add_argument('input_path', type=str, help='Path to librispeech (root)', nargs='+')
+    parser.add_argument('input_path', type=str, nargs='+',
+                        help='Path to librispeech (root), or librispeech tar archives (.tar, .tar.gz, .tgz)')
     parser.add_argument('-o', '--output_path', type=str, help='Path to save the transformed utterances',
                         default='output')
     parser.add_argument('-s', '--suffix', type=str, help='suffix to add to the subset name')
     parser.add_argument('-N', '--nb_proc', type=int, help='Nb of parallel processes', default=2)
     parser.add_argument('-T', '--nb_targets', type=int, help='Max nb of target speakers', default=10)
     parser.add_argument('--targets_file', type=str, default='')
-    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted run: skip the utterances recorded in the journal of the output dir')
+    parser.add_argument('--engine', type=str, default='serial', choices=['serial', 'speaker', 'pipeline'],
+                        help='serial: speakers are converted one by one in the main process; '
+                             'speaker: whole speakers are converted in parallel in the worker processes; '
+                             'pipeline: analysis, fit, transform and write stages run concurrently')
+    parser.add_argument('--max_in_flight', type=int, default=None,
+                        help='Max nb of speakers being converted at the same time by the speaker engine '
+                             '(default: 2 * nb_proc), or waiting between 2 stages of the pipeline engine (default: 2)')
+    parser.add_argument('--feature_cache', type=str, default='',
+                        help='Directory where the features of the target speakers are cached, to reuse them '
+                             'when these speakers are converted. If not set, they are analysed again')
+    parser.add_argument('--enrollment_seconds', type=float, default=None,
+                        help='Fit the transformer of each speaker on a random subset of about this duration of its '
+                             'utterances, then load, transform and save the other utterances one at a time. Default: '
+                             'all the utterances of a speaker are loaded and used for the fit')
+    parser.add_argument('--output_format', type=str, default='files', choices=['files', 'tar'],
+                        help='files: an audio file per utterance; tar: tar shards of bounded size (see '
+                             '--tar_shard_size) in the shards subdir of the output dir, listed in index.tsv')
+    parser.add_argument('--tar_shard_size', type=int, default=1024,
+                        help='Size in MB from which a tar shard is closed and a new one started')
+    parser.add_argument('--subtype', type=str, default=None,
+                        help='Subtype of the transformed utterances, e.g. PCM_16 or FLOAT (not available in FLAC). '
+                             'Default: the default subtype of the format (PCM_16 for FLAC and WAV)')
+    parser.add_argument('--writer_threads', type=int, default=2,
+                        help='Nb of threads encoding and saving the transformed utterances in the background, in '
+                             'each process. 0 to save them synchronously')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the random choices (targets, transformations). Default: a random seed, saved '
+                             'in the params file')
+    parser.add_argument('--params_file', type=str, default='',
+                        help='File with the seed, the targets and the transformer params: they are loaded from this '
+                             'file if it exists, else built and saved in it. Default: params.pickle in the output '
+                             'dir, only loaded with --resume')
+    parser.add_argument('--prepare_only', action='store_true',
+                        help='Only build the params file (see --params_file), to share it between shards')
+    parser.add_argument('--shard', type=str, default='',
+                        help='i/N: only convert the speakers of the i-th of N shards (0 <= i < N). The shards need '
+                             'a params file built beforehand')
 
     args = parser.parse_args()
     method = args.method
@@ -62,11 +108,32 @@ def main():
     nb_targets = args.nb_targets
     targets_file = args.targets_file
     resume = args.resume
-
+    engine = args.engine
+    max_in_flight = args.max_in_flight
+    feature_cache_path = args.feature_cache
+    enrollment_seconds = args.enrollment_seconds
+    output_format = args.output_format
+    tar_shard_size = args.tar_shard_size
+    subtype = args.subtype
+    writer_threads = args.writer_threads
+    seed = args.seed
+    params_file = args.params_file or os.path.join(output_path, 'params.pickle')
+    prepare_only = args.prepare_only
+    shard = parse_shard(args.shard) if args.shard else None
+    # the shards all convert with the params built beforehand (they never build nor save them), and --prepare_only
+    # keeps the params the shards may already be using
+    reuse_params = bool(args.params_file) or resume or shard is not None or prepare_only
+
+    archives = all(is_archive(p) for p in input_paths)
+    if archives and corpus != 'librispeech':
+        parser.error('Only librispeech can be read from archives')
     for p in input_paths:
-        if not os.path.isdir(p):
+        if not (archives or os.path.isdir(p)):
             raise FileNotFoundError(p)
 
+    if shard and not os.path.exists(params_file):
+        parser.error('--shard needs the params shared by all the shards: build them first with --prepare_only')
+
     if not suffix:
         suffix = '_mod_' + method
 
@@ -78,98 +145,309 @@ def main():
     else:
         from voice_transformation.vtln_based_conversion import Transformer, builder
 
-    if corpus == 'librispeech':
+    if archives:
+        paths = load_librispeech_archives(input_paths)
+    elif corpus == 'librispeech':
         paths = load_librispeech(input_paths)
     else:
         paths = load_verbmobil(input_paths)
     print("Nb of speakers=", len(paths))
 
-    #####
-    # 1. Choose and load data for target speaker(s)
-    print("\n1. Target speaker(s)")
-    nb_targets = min(nb_targets, len(paths))
-    print("Nb of target speakers=", nb_targets)
-
-    print("\n- get target speakers")
-    if targets_file:
-        print("Load targets list from file")
-        target_speakers = load_targets(targets_file)
-        assert len(target_speakers) == nb_targets, target_speakers
+    if subtype:
+        # fail now rather than when the first utterance is saved
+        for audio_format in {os.path.splitext(path)[1][1:].upper() for utterances in paths.values()
+                             for _, path, _ in utterances}:
+            if not sf.check_format(audio_format, subtype):
+                parser.error('Subtype {} is not available in {}'.format(subtype, audio_format))
+
+    feature_cache = FeatureCache(feature_cache_path) if feature_cache_path else None
+    # the converted utterances are recorded in the journal, to resume an interrupted run
+    os.makedirs(output_path, exist_ok=True)
+    journal = Journal(os.path.join(output_path, 'journal.tsv'), output_path)
+    if output_format == 'tar':
+        writer = TarShardWriter(output_path, journal, max_size=tar_shard_size * 2 ** 20, subtype=subtype)
     else:
-        print("Choose targets")
-        target_speakers = choose_target(paths, nb_targets)
-
-    with multiprocessing.Pool(nb_proc) as pool:
-        print("\n- load target speakers data and pre-build transformer params")
-        target_utterances = {spk_id: load_utterances_parallel([os.path.join(subset, path)
-                                                               for subset, path, _ in paths[spk_id]], pool)
-                             for spk_id in tqdm.tqdm(target_speakers)}
-        transformer_params = builder(target_utterances)
-
-        #####
-        # 2. Convert utterances
-        print("\n2. Conversion\n")
-        for spk_id in tqdm.tqdm(paths):
-            if not resume or not already_processed(output_path, paths[spk_id], suffix):
-                # load all utterances of this speaker
-                path_to_utterances = paths[spk_id]
-                if spk_id in target_speakers:
-                    utterances = target_utterances[spk_id]
-                else:
-                    utterances = load_utterances_parallel(
-                        [os.path.join(subset, path) for subset, path, _ in path_to_utterances],
-                        pool, desc='Step 1/2: load data')
-
-                # create the transformer
-                transformer = Transformer(transformer_params)
-                transformer.fit(utterances)
-
-                # pre-define targets : if we transform utterances of dialogs (Verbmobil), we want to keep the same target
-                # for the same speaker for each dialog so we predefine them
-                dialog_ids = {dialog_id for _, _, dialog_id in path_to_utterances if dialog_id}
-                if dialog_ids:
-                    mapping_dialog2target = {dialog_id: target_speakers[np.random.randint(0, nb_targets)]
-                                             for dialog_id in dialog_ids}
-
-                    def get_target(dialog):
-                        return mapping_dialog2target[dialog]
+        writer = FileWriter(journal, subtype=subtype)
+    # the pipeline engine has its own writer threads
+    if writer_threads and engine != 'pipeline':
+        writer = AsyncWriter(writer, writer_threads)
+
+    try:
+        with multiprocessing.Pool(nb_proc) as pool:
+            #####
+            # 1. Choose and load data for target speaker(s)
+            print("\n1. Target speaker(s)")
+            if reuse_params and os.path.exists(params_file):
+                print("Load targets and transformer params from", params_file)
+                seed, target_speakers, transformer_params = load_params(params_file, method)
+            else:
+                if shard:
+                    # removed since the check above: a shard never builds params of its own
+                    parser.error('--shard needs the params shared by all the shards: ' + params_file + ' is missing')
+                if seed is None:
+                    seed = random.SystemRandom().randrange(2 ** 32)
+                nb_targets = min(nb_targets, len(paths))
+                print("Nb of target speakers=", nb_targets)
+
+                print("\n- get target speakers")
+                if targets_file:
+                    print("Load targets list from file")
+                    target_speakers = load_targets(targets_file)
+                    assert len(target_speakers) == nb_targets, target_speakers
                 else:
-                    # if not, the transformer will choose a target
-                    def get_target(_):
-                        return None
+                    print("Choose targets")
+                    target_speakers = choose_target(paths, nb_targets, derive_seed(seed, 'targets'))
+
+                print("\n- load target speakers data and pre-build transformer params")
+                target_paths = {spk_id: [os.path.join(subset, path) for subset, path, _ in paths[spk_id]]
+                                for spk_id in target_speakers}
+                if archives:
+                    # read the audio files of the targets in a single pass over the archives
+                    target_paths = {spk_id: [members[path] for path in target_paths[spk_id]]
+                                    for spk_id, members in iter_archive_speakers(input_paths, target_paths)}
+                target_utterances = {spk_id: load_utterances_parallel(target_paths[spk_id], pool, cache=feature_cache)
+                                     for spk_id in tqdm.tqdm(target_speakers)}
+                del target_paths
+                reseed(derive_seed(seed, 'builder'))
+                transformer_params = builder(target_utterances)
+                # only the compact params are kept: when they are converted, the target speakers are reloaded from the
+                # feature cache or analysed again
+                del target_utterances
+
+                save_params(params_file, method, seed, target_speakers, transformer_params)
+                print("Targets and transformer params saved in", params_file)
+            print("Seed=", seed)
+            save_targets(target_speakers, os.path.join(output_path, 'targets.txt'))
+
+            if prepare_only:
+                return
+
+            #####
+            # 2. Convert utterances
+            print("\n2. Conversion\n")
+            if shard:
+                paths = {spk_id: path_to_utterances for spk_id, path_to_utterances in paths.items()
+                         if in_shard(spk_id, shard)}
+                print("Nb of speakers in shard {}/{}=".format(*shard), len(paths))
+            pending = get_pending_utterances(paths, output_path, suffix, journal if resume else None,
+                                             check_files=output_format == 'files')
+            print("Nb of speakers to convert=", len(pending))
+            if archives:
+                # the speakers are converted in the order of the archives, as soon as their audio files are read
+                speakers = iter_archive_speakers(input_paths, {spk_id: [os.path.join(subset, path)
+                                                                        for subset, path, _ in paths[spk_id]]
+                                                               for spk_id in pending})
+            else:
+                speakers = ((spk_id, None) for spk_id in pending)
+            jobs = (make_speaker_job(spk_id, paths[spk_id], pending[spk_id], output_path, suffix, target_speakers,
+                                     derive_seed(seed, spk_id), feature_cache if spk_id in target_speakers else None,
+                                     enrollment_seconds, members)
+                    for spk_id, members in speakers)
+
+            if engine == 'serial':
+                for job in tqdm.tqdm(jobs, total=len(pending)):
+                    # load the utterances of this speaker (only the enrollment ones with --enrollment_seconds)
+                    utterances = load_utterances_parallel(get_enrollment_paths(job), pool, desc='Step 1/2: load data',
+                                                          cache=job.feature_cache)
+
+                    # fit the transformer if needed and convert the utterances
+                    convert_speaker(Transformer, transformer_params, job, utterances, writer=writer,
+                                    desc='Step 2/2: Conversion', pool=pool, window=2 * nb_proc)
+                    del utterances
+
+            elif engine == 'pipeline':
+                pipeline = ConversionPipeline(Transformer, transformer_params, pool,
+                                              max_speakers=max_in_flight or 2, max_utterances=4 * nb_proc,
+                                              nb_writers=max(writer_threads, 1), writer=writer)
+                pipeline.run(jobs, total=len(pending))
+                print(pipeline.format_stats())
+
+        if engine == 'speaker':
+            convert_speakers_parallel(Transformer, transformer_params, jobs, nb_proc,
+                                      max_in_flight=max_in_flight, writer=writer, total=len(pending))
+    finally:
+        writer.close()
+
+
+def get_pending_utterances(paths, output_path, suffix, journal=None, check_files=True):
+    """Find the utterances to convert
+
+    Parameters
+    ----------
+    paths: dict
+        Utterances of each speaker, see utils.dataset
+    output_path: str
+    suffix: str
+    journal: Journal
+        Journal of a previous run to resume. If None, all the utterances are to convert
+    check_files: bool
+        Whether to check the output files if there is no journal. If False, all the utterances are to convert
+
+    Returns
+    -------
+    dict
+        keys = ids of the speakers with utterances to convert
+        values = indices of these utterances in the list of utterances of the speaker
+    """
+    if journal is None:
+        return {spk_id: list(range(len(paths[spk_id]))) for spk_id in paths}
+
+    if os.path.exists(journal.path):
+        print("Nb of utterances already converted=", len(journal))
+        is_converted = journal.__contains__
+    elif not check_files:
+        return get_pending_utterances(paths, output_path, suffix)
+    else:
+        # run started without a journal: check the output files
+        print("No journal found in", journal.path, ": checking the output files")
+        is_converted = os.path.exists
 
-                for (input_subset, path, dialog_id), original_utt in tqdm.tqdm(zip(path_to_utterances, utterances),
-                                                                               total=len(utterances), desc='Step 2/2: Conversion'):
-                    output_subset = input_subset.split('/')[-1] + '_' + suffix
-                    os.makedirs(os.path.join(output_path, output_subset, *path.split('/')[:-1]), exist_ok=True)
+    pending = {}
+    for spk_id, path_to_utterances in paths.items():
+        indices = [i for i, (subset, path, _) in enumerate(path_to_utterances)
+                   if not is_converted(get_output_path(output_path, subset, path, suffix))]
+        if indices:
+            pending[spk_id] = indices
+    return pending
 
-                    transformed_utt = transformer.transform(original_utt, target=get_target(dialog_id))
-                    transformed_utt.save(os.path.join(output_path, output_subset, path))
 
+def make_speaker_job(spk_id, path_to_utterances, indices, output_path, suffix, target_speakers, seed,
+                     feature_cache=None, enrollment_seconds=None, members=None):
+    """Prepare the conversion of the pending utterances of a speaker
 
-def choose_target(speakers, nb_targets, min_utterances=10):
-    speakers_id = list(speakers.keys())
-    random.shuffle(speakers_id)
+    The transformer fitted to the speaker is saved in the output directory. If the conversion of the speaker was
+    interrupted, it is reloaded so that only the remaining utterances have to be loaded.
+
+    The seed of each utterance is derived from the seed of the speaker and the path of the utterance in its subset, so
+    it is the same whatever the node and the input directory.
+
+    With `enrollment_seconds`, the transformer is fitted on a subset of the utterances (see `choose_enrollment`) and
+    the other ones are streamed.
+
+    If the utterances are read from archives, `members` maps their virtual paths to the audio files read from the
+    archives.
+
+    """
+    transformer_path = os.path.join(output_path, 'transformers', spk_id + '.pickle')
+    transformer = None
+    if len(indices) < len(path_to_utterances) and os.path.exists(transformer_path):
+        with open(transformer_path, 'rb') as f:
+            transformer = pickle.load(f)
+    else:
+        # a new transformer will be fitted on all the utterances of the speaker
+        indices = range(len(path_to_utterances))
+
+    targets = choose_dialog_targets(path_to_utterances, target_speakers, seed)
+    path_to_utterances = [path_to_utterances[i] for i in indices]
+    input_paths = [os.path.join(subset, path) for subset, path, _ in path_to_utterances]
+    if members is not None:
+        input_paths = [members[path] for path in input_paths]
+
+    enrollment = None
+    if enrollment_seconds is not None:
+        # no enrollment utterance is needed by a saved transformer
+        enrollment = [] if transformer else choose_enrollment(input_paths, enrollment_seconds, seed)
+
+    return SpeakerJob(spk_id,
+                      input_paths,
+                      [get_output_path(output_path, subset, path, suffix) for subset, path, _ in path_to_utterances],
+                      [targets[i] for i in indices],
+                      feature_cache=feature_cache,
+                      transformer=transformer,
+                      transformer_path=transformer_path,
+                      seed=seed,
+                      utterance_seeds=[derive_seed(seed, os.path.basename(subset), path)
+                                       for subset, path, _ in path_to_utterances],
+                      enrollment=enrollment)
+
+
+def get_output_path(output_path, subset, path, suffix):
+    """Path of the transformed utterance : the subset name gets a suffix, the structure of the subset is kept"""
+    output_subset = subset.split('/')[-1] + '_' + suffix
+    return os.path.join(output_path, output_subset, path)
+
+
+def choose_dialog_targets(path_to_utterances, target_speakers, seed):
+    """Pre-define the target of each utterance of a speaker
+
+    If we transform utterances of dialogs (Verbmobil), we want to keep the same target for the same speaker for each
+    dialog so we predefine them. If not, the target is None and the transformer will choose a target.
+
+    The target of a dialog is drawn with a seed derived from the seed of the speaker and the dialog id.
+
+    """
+    dialog_ids = {dialog_id for _, _, dialog_id in path_to_utterances if dialog_id}
+    mapping_dialog2target = {dialog_id: random.Random(derive_seed(seed, dialog_id)).choice(target_speakers)
+                             for dialog_id in dialog_ids}
+    return [mapping_dialog2target.get(dialog_id) for _, _, dialog_id in path_to_utterances]
+
+
+def choose_enrollment(input_paths, enrollment_seconds, seed):
+    """Choose the utterances to fit the transformer of a speaker
+
+    The utterances are drawn at random (with a seed derived from the seed of the speaker) until their total duration
+    reaches `enrollment_seconds`. The durations are read from the headers of the audio files.
+
+    Returns
+    -------
+    list of int
+        Indices of the chosen utterances in `input_paths`
+    """
+    indices = list(range(len(input_paths)))
+    random.Random(derive_seed(seed, 'enrollment')).shuffle(indices)
+    enrollment = []
+    duration = 0.
+    for i in indices:
+        if duration >= enrollment_seconds:
+            break
+        enrollment.append(i)
+        duration += get_duration(input_paths[i])
+    return sorted(enrollment)
+
+
+def choose_target(speakers, nb_targets, seed, min_utterances=10):
+    speakers_id = sorted(speakers.keys())
+    random.Random(seed).shuffle(speakers_id)
     target_speakers = []
     for spk_id in speakers_id:
         if len(speakers[spk_id]) > min_utterances:
             target_speakers.append(spk_id)
         if len(target_speakers) >= nb_targets:
             break
+    return target_speakers
 
-    # save the list of targets in a file
-    target_file_path = 'targets.txt'
-    if os.path.exists(target_file_path):
-        i = 1
-        while os.path.exists('targets_{}.txt'.format(i)):
-            i += 1
-        target_file_path = 'targets_{}.txt'.format(i)
 
+def save_targets(target_speakers, target_file_path):
     with open(target_file_path, mode='w') as f:
         for t in target_speakers:
             f.write('{}\n'.format(t))
     print("Targets list saved in", target_file_path)
-    return target_speakers
+
+
+def save_params(params_file, method, seed, target_speakers, transformer_params):
+    """Save the targets and the transformer params, to share them between the shards of a run"""
+    params_dir = os.path.dirname(params_file)
+    if params_dir:
+        os.makedirs(params_dir, exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(params_file, os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump({'method': method, 'seed': seed, 'targets': target_speakers, 'params': transformer_params}, f)
+    os.replace(temp_path, params_file)
+
+
+def load_params(params_file, method):
+    """Load the targets and the transformer params saved by `save_params`
+
+    Returns
+    -------
+    tuple
+        (seed, target speakers, transformer params)
+    """
+    with open(params_file, 'rb') as f:
+        saved = pickle.load(f)
+    if saved['method'] != method:
+        raise ValueError("{} was built for the {} method, not {}".format(params_file, saved['method'], method))
+    return saved['seed'], saved['targets'], saved['params']
 
 
 def load_targets(target_file_path):
@@ -180,13 +458,5 @@ def load_targets(target_file_path):
     return target_speakers
 
 
-def already_processed(output_path, subset_files, suffix):
-    for subset, utt, _ in subset_files:
-        new_subset = subset.split('/')[-1] + '_' + suffix
-        if not os.path.exists(os.path.join(output_path, new_subset, utt)):
-            return False
-    return True
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Long-lived personalization and conversion worker
+
+Unlike the one-shot scripts of steps 2 and 3, the worker loads the libraries, the pre-built params and the pool of
+processes once, keeps the personalized transformers of the most recent users in memory, and then handles requests:
+only the analysis and the synthesis of the utterances are left for each conversion.
+
+The requests are JSON objects, one per line, read from stdin (default) or from the connections to a unix socket
+(`--socket`). Each request gets a JSON response on one line, with the `id` of the request if it has one:
+
+- `{"op": "personalize", "user": "174", "input": "data/user/personalization/174/50561"}`: fit a transformer on the
+  flac files of a directory (or a list of files), save it in the transformers dir and keep it in memory
+- `{"op": "convert", "user": "174", "input": "utt.flac", "output": "utt_transformed.flac"}`: convert a file. Instead of
+  paths, the audio file can be given as base64 (`"audio": "..."`): the transformed utterance is then returned as
+  base64 flac (`"audio"` in the response)
+- `{"op": "convert_dir", "user": "174", "input": "data/user/speech/174", "output": "output/174"}`: convert all the flac
+  files of a directory (recursively) in the pool of processes
+
+Responses: `{"id": ..., "ok": true, ...}` or `{"id": ..., "ok": false, "error": "..."}`.
+
+"""
+
+import base64
+import collections
+import glob
+import io
+import json
+import multiprocessing
+import os
+import socketserver
+import sys
+import threading
+
+import dill
+
+from voice_transformation.utils.archive import ArchiveMember
+from voice_transformation.utils.load import load_utterance
+from voice_transformation.utils.writer import save_utterance
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('method', type=str, help='which method ? voicemask or vtln',
+                        choices=['voicemask', 'vtln'])
+    parser.add_argument('--params', type=str, help='path to prebuilt params', required=True)
+    parser.add_argument('--transformers_dir', type=str, default='output/transformers',
+                        help='Where the personalized transformers are saved and loaded, as <user>.pickle')
+    parser.add_argument('--cache_size', type=int, default=32,
+                        help='Max nb of personalized transformers kept in memory')
+    parser.add_argument('--socket', type=str, default='',
+                        help='Path to a unix socket to listen to. Default: read the requests from stdin')
+    parser.add_argument('-N', '--nb_proc', type=int, default=multiprocessing.cpu_count() - 1,
+                        help='Nb of processes of the pool')
+
+    args = parser.parse_args()
+
+    with open(args.params, 'rb') as f:
+        transformer_params = dill.load(f)
+
+    if args.method == 'voicemask':
+        from voice_transformation.voicemask import Transformer
+    else:
+        from voice_transformation.vtln_based_conversion import Transformer
+
+    with multiprocessing.Pool(args.nb_proc) as pool:
+        worker = Worker(Transformer, transformer_params, pool,
+                        TransformerCache(args.transformers_dir, args.cache_size))
+        if args.socket:
+            serve_socket(worker, args.socket)
+        else:
+            serve_stream(worker, sys.stdin, sys.stdout)
+
+
+class TransformerCache:
+    """LRU cache of the personalized transformers
+
+    The transformers are saved in a directory, as `<user>.pickle`. The most recently used ones are kept in memory.
+
+    Parameters
+    ----------
+    directory: str
+    capacity: int
+        Max nb of transformers kept in memory
+
+    """
+    def __init__(self, directory, capacity=32):
+        self.directory = directory
+        self.capacity = capacity
+        self._transformers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """Get the transformer of a user, from memory or from its file"""
+        with self._lock:
+            if user in self._transformers:
+                self._transformers.move_to_end(user)
+                return self._transformers[user]
+
+        path = self._get_path(user)
+        if not os.path.exists(path):
+            raise KeyError('No personalized transformer for user {}'.format(user))
+        with open(path, 'rb') as f:
+            transformer = dill.load(f)
+        self._add(user, transformer)
+        return transformer
+
+    def put(self, user, transformer):
+        """Save the transformer of a user and keep it in memory"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(user)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            dill.dump(transformer, f)
+        os.replace(temp_path, path)
+        self._add(user, transformer)
+
+    def _add(self, user, transformer):
+        with self._lock:
+            self._transformers[user] = transformer
+            self._transformers.move_to_end(user)
+            while len(self._transformers) > self.capacity:
+                self._transformers.popitem(last=False)
+
+    def _get_path(self, user):
+        if os.path.basename(user) != user or user in ('', '.', '..'):
+            raise ValueError('Invalid user id {}'.format(user))
+        return os.path.join(self.directory, user + '.pickle')
+
+
+class Worker:
+    """Handle the requests, see the module documentation
+
+    Parameters
+    ----------
+    transformer_class: type
+        The `Transformer` class of the conversion method
+    transformer_params
+        The pre-built params
+    pool: multiprocessing.Pool
+        Pool of processes where the utterances are analysed and synthesized
+    cache: TransformerCache
+
+    """
+    def __init__(self, transformer_class, transformer_params, pool, cache):
+        self.transformer_class = transformer_class
+        self.transformer_params = transformer_params
+        self.pool = pool
+        self.cache = cache
+
+    def handle(self, request):
+        """Handle a request and get the response"""
+        response = {'id': request.get('id')} if isinstance(request, dict) and 'id' in request else {}
+        try:
+            handler = {'personalize': self.personalize,
+                       'convert': self.convert,
+                       'convert_dir': self.convert_dir}.get(request.get('op'))
+            if handler is None:
+                raise ValueError('Unknown op {!r}'.format(request.get('op')))
+            response.update(handler(request))
+            response['ok'] = True
+        except Exception as e:
+            response.update(ok=False, error='{}: {}'.format(type(e).__name__, e))
+        return response
+
+    def personalize(self, request):
+        input_path = request['input']
+        if isinstance(input_path, list):
+            path_to_utterances = input_path
+        else:
+            path_to_utterances = sorted(glob.glob(os.path.join(input_path, '*.flac')))
+        if not path_to_utterances:
+            raise FileNotFoundError('No utterance in {}'.format(input_path))
+
+        # no progress bar (and none of its processes) for each request
+        utterances = self.pool.map(_load_utterance, path_to_utterances)
+        transformer = self.transformer_class(self.transformer_params)
+        transformer.fit(utterances)
+        self.cache.put(request['user'], transformer)
+        return {'nb_utterances': len(utterances)}
+
+    def convert(self, request):
+        transformer = self.cache.get(request['user'])
+        if 'audio' in request:
+            member = ArchiveMember(request.get('name', 'audio'), base64.b64decode(request['audio']))
+            data = self.pool.apply(_convert_to_bytes, (transformer, member))
+            return {'audio': base64.b64encode(data).decode()}
+
+        output_path = request.get('output') or _get_default_output_path(request['input'])
+        self.pool.apply(_convert_file, (transformer, request['input'], output_path))
+        return {'output': output_path}
+
+    def convert_dir(self, request):
+        transformer = self.cache.get(request['user'])
+        input_dir, output_dir = request['input'], request['output']
+        path_to_utterances = sorted(glob.glob(os.path.join(input_dir, '**', '*.flac'), recursive=True))
+        tasks = [(transformer, path, os.path.join(output_dir, os.path.relpath(path, input_dir)))
+                 for path in path_to_utterances]
+        for _ in self.pool.imap_unordered(_star_convert_file, tasks):
+            pass
+        return {'nb_utterances': len(tasks)}
+
+
+def serve_stream(worker, input_stream, output_stream):
+    """Handle the requests read from a stream, one JSON object per line, and write the responses to another one"""
+    for line in input_stream:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'ok': False, 'error': 'Invalid JSON: {}'.format(e)}
+        else:
+            response = worker.handle(request)
+        output_stream.write(json.dumps(response) + '\n')
+        output_stream.flush()
+
+
+def serve_socket(worker, socket_path):
+    """Handle the requests of the connections to a unix socket, each connection in its own thread"""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stream(worker, io.TextIOWrapper(self.rfile, encoding='utf-8'),
+                         io.TextIOWrapper(self.wfile, encoding='utf-8'))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        print('Listening on', socket_path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def _get_default_output_path(input_path):
+    # same as 03_conversion.py
+    return os.path.join('output', '{}_transformed.flac'.format(os.path.basename(input_path).split('.')[0]))
+
+
+def _load_utterance(path):
+    return load_utterance(path, lazy=False)
+
+
+def _convert_file(transformer, input_path, output_path):
+    transformed_utt = transformer.transform(load_utterance(input_path))
+    save_utterance(transformed_utt, output_path)
+
+
+def _star_convert_file(args):
+    _convert_file(*args)
+
+
+def _convert_to_bytes(transformer, member):
+    transformed_utt = transformer.transform(load_utterance(member))
+    buffer = io.BytesIO()
+    transformed_utt.save(buffer, format='FLAC')
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    main()
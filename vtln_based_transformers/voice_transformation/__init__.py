@@ -72,9 +72,23 @@ class Utterance:
         self._aperiodicity = None
         self._voiced_frames = None
 
-    def save(self, path):
-        with open(path, mode='wb') as f:
-            sf.write(f, self.data, self.sample_rate)
+    def save(self, path, format=None, subtype=None):
+        """Save the data in an audio file
+
+        Parameters
+        ----------
+        path: str or file-like object
+        format: str
+            Format of the file (e.g. 'FLAC'). By default, it is inferred from the extension of the path
+        subtype: str
+            Subtype of the data (e.g. 'PCM_16', 'FLOAT'), see `soundfile.available_subtypes`. By default, the default
+            subtype of the format
+        """
+        if isinstance(path, str):
+            with open(path, mode='wb') as f:
+                sf.write(f, self.data, self.sample_rate, format=format, subtype=subtype)
+        else:
+            sf.write(path, self.data, self.sample_rate, format=format, subtype=subtype)
 
     @property
     def f0(self):
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read the utterances from tar archives
+
+LibriSpeech is distributed as tar archives (`dev-clean.tar.gz`...). The functions of this module read the utterances
+straight from these archives, without extracting them: the archives are read sequentially, and the audio files are
+kept in memory as `ArchiveMember` until they are decoded by `voice_transformation.utils.load.load_utterance`.
+
+An utterance of an archive is identified by a virtual path: the path to the archive followed by the path of the
+utterance in the archive (e.g. `/data/dev-clean.tar.gz/LibriSpeech/dev-clean/84/121123/84-121123-0000.flac`), so that
+the subsets and the relative paths of the utterances are the same as with an extracted corpus.
+
+"""
+
+import collections
+import os
+import tarfile
+
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz')
+
+ArchiveMember = collections.namedtuple('ArchiveMember', ['name', 'data'])
+ArchiveMember.__doc__ = """Audio file read from an archive
+
+Attributes
+----------
+name: str
+    Virtual path of the file, see the module documentation
+data: bytes
+    Content of the file
+"""
+
+
+def is_archive(path):
+    """Whether a path is a tar archive that can be read by this module"""
+    return os.path.isfile(path) and path.endswith(ARCHIVE_EXTENSIONS)
+
+
+def load_librispeech_archives(archive_paths):
+    """List the speakers and their utterances in librispeech archives
+
+    The archives are read once, sequentially, to get the names of their members.
+
+    Parameters
+    ----------
+    archive_paths: list of str
+
+    Returns
+    -------
+    dict
+        Same as `voice_transformation.utils.dataset.load_librispeech`, with the virtual path of the subset in the
+        archive instead of the path of the subset directory
+    """
+    speakers = {}
+    for archive_path in archive_paths:
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for member in archive:
+                # <prefix>/<subset>/<speaker>/<chapter>/<utterance>.flac
+                parts = member.name.split('/')
+                if not member.isfile() or not member.name.endswith('.flac') or len(parts) < 4:
+                    continue
+                subset_path = os.path.join(archive_path, *parts[:-3])
+                speakers.setdefault(parts[-3], []).append((subset_path, '/'.join(parts[-3:]), None))
+
+    # same order as with an extracted corpus
+    return {spk_id: sorted(speakers[spk_id]) for spk_id in sorted(speakers)}
+
+
+def iter_archive_members(archive_paths, paths):
+    """Read some utterances from archives
+
+    Parameters
+    ----------
+    archive_paths: list of str
+    paths: set of str
+        Virtual paths of the utterances to read
+
+    Yields
+    ------
+    ArchiveMember
+        The utterances in the order of the archives
+    """
+    for archive_path in archive_paths:
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for member in archive:
+                path = os.path.join(archive_path, member.name)
+                if member.isfile() and path in paths:
+                    yield ArchiveMember(path, archive.extractfile(member).read())
+
+
+def iter_archive_speakers(archive_paths, speakers):
+    """Read the utterances of some speakers from archives, speaker by speaker
+
+    The utterances of a speaker are yielded as soon as they have all been read. The utterances of a speaker are
+    usually stored together in the archives, so only a few speakers are kept in memory at the same time.
+
+    Parameters
+    ----------
+    archive_paths: list of str
+    speakers: dict
+        keys = ids of the speakers to read
+        values = virtual paths of their utterances
+
+    Yields
+    ------
+    tuple
+        (speaker id, dict with the virtual paths as keys and the `ArchiveMember` as values)
+    """
+    speaker_of = {path: spk_id for spk_id, paths in speakers.items() for path in paths}
+    members = collections.defaultdict(dict)
+    for member in iter_archive_members(archive_paths, speaker_of.keys()):
+        spk_id = speaker_of[member.name]
+        members[spk_id][member.name] = member
+        if len(members[spk_id]) == len(speakers[spk_id]):
+            yield spk_id, members.pop(spk_id)
+
+    if members:
+        raise FileNotFoundError('Utterances missing from the archives for speakers {}'.format(sorted(members)))
@@ -43,7 +43,8 @@ def load_librispeech(input_paths):
     dict
         keys = speaker ids
         values = [tuple(subset,rel path to utterance, None)]. The last value in the tuple is None since librispeech is
-        not a dialog corpus
+        not a dialog corpus. The speakers and the utterances are sorted, so that the result doesn't depend on the
+        file system
     """
     speakers = {}
 
@@ -52,17 +53,17 @@ def load_librispeech(input_paths):
             subset_path = subset_path[:-1]
 
         if os.path.isdir(subset_path):
-            for speaker_id in os.listdir(subset_path):
+            for speaker_id in sorted(os.listdir(subset_path)):
                 speaker_path = os.path.join(subset_path, speaker_id)
                 speaker_utterances = []
 
                 if os.path.isdir(speaker_path):
-                    for chapter in os.listdir(speaker_path):
+                    for chapter in sorted(os.listdir(speaker_path)):
                         chapter_path = os.path.join(speaker_path, chapter)
 
                         if os.path.isdir(chapter_path):
                             speaker_utterances.extend([(subset_path, p.replace(subset_path + '/', ''), None)
-                                                       for p in glob.glob(chapter_path + '/*.flac')])
+                                                       for p in sorted(glob.glob(chapter_path + '/*.flac'))])
                     speakers[speaker_id] = speaker_utterances
 
     return speakers
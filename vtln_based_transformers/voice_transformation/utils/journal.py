@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Journal of the transformed utterances
+
+The journal is an append-only text file with a line for each transformed utterance saved in the output directory:
+its path (relative to the output directory), its size and its SHA-256 checksum. An utterance is recorded only once
+its file is complete (see `voice_transformation.utils.writer.save_utterance`), so the journal tells which utterances
+are already converted when a run is resumed, without checking the output files one by one.
+
+"""
+
+import hashlib
+import os
+import threading
+
+
+class Journal:
+    """Append-only journal of the transformed utterances
+
+    Several threads and processes can record utterances in the same journal: each record is a single append of
+    complete lines.
+
+    Parameters
+    ----------
+    path: str
+        Path to the journal file
+    root: str
+        Directory the paths of the utterances are relative to
+
+    Attributes
+    ----------
+    entries: dict
+        keys = relative paths of the recorded utterances
+        values = tuple(size, checksum)
+
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = self._read() if os.path.exists(path) else {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, output_path):
+        return os.path.relpath(output_path, self.root) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, output_path, size=None, checksum=None):
+        """Record a complete utterance file
+
+        Parameters
+        ----------
+        output_path: str
+            Path to the file of the utterance
+        size: int
+        checksum: str
+            SHA-256 of the file. If the size or the checksum is not given, they are computed from the file
+        """
+        if size is None or checksum is None:
+            size, checksum = _get_size_and_checksum(output_path)
+        self.record_many([(output_path, size, checksum)])
+
+    def record_many(self, records):
+        """Record several complete utterances at once
+
+        Parameters
+        ----------
+        records: list of tuple
+            (output path, size, checksum) of each utterance
+        """
+        entries = {os.path.relpath(output_path, self.root): (size, checksum) for output_path, size, checksum in records}
+        lines = ''.join('{}\t{}\t{}\n'.format(key, size, checksum) for key, (size, checksum) in entries.items())
+
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, lines.encode())
+            finally:
+                os.close(fd)
+            self.entries.update(entries)
+
+    def _read(self):
+        entries = {}
+        complete_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # the last line may be truncated if a run was interrupted while writing it
+                if not line.endswith(b'\n'):
+                    break
+                complete_size += len(line)
+                fields = line.decode().rstrip('\n').split('\t')
+                if len(fields) == 3:
+                    key, size, checksum = fields
+                    entries[key] = (int(size), checksum)
+
+        # drop the truncated line, so that the next records are not appended to it
+        if complete_size < os.path.getsize(self.path):
+            os.truncate(self.path, complete_size)
+        return entries
+
+    def __getstate__(self):
+        # the workers only record utterances: they don't need the entries
+        state = self.__dict__.copy()
+        state['entries'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def _get_size_and_checksum(path):
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+            size += len(block)
+    return size, sha256.hexdigest()
@@ -22,37 +22,121 @@
 """Load the data from audio files
 
 The functions of this module load the data and get the features of audio files.
+The features can be kept in an on-disk cache (see `FeatureCache`) to reload them without analysing the audio again.
 
 """
 
+import hashlib
+import io
 import multiprocessing
+import os
 
+import numpy as np
 import soundfile as sf
 import tqdm
 
 from voice_transformation import Utterance
+from voice_transformation.utils.archive import ArchiveMember
 
 
-def load_utterance(path, frame_length_in_ms=20, voiced_threshold_factor=0.06, lazy=True):
+class FeatureCache:
+    """On-disk cache of decomposed utterances
+
+    The data and the WORLD features (f0, spectrogram, aperiodicity) of an utterance are saved in a file of the cache
+    directory, to be reloaded later instead of analysing the audio file again.
+    The entries are identified by the path, size and modification time of the audio file (or the content of the file
+    for an utterance read from an archive) and the analysis settings.
+
+    Parameters
+    ----------
+    root: str
+        Directory of the cache
+
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def load(self, path, frame_length_in_ms=20, voiced_threshold_factor=0.06):
+        """Get a decomposed utterance from the cache
+
+        Returns
+        -------
+        Utterance or None
+            None if the utterance is not in the cache
+        """
+        cache_path = self._get_cache_path(path, frame_length_in_ms, voiced_threshold_factor)
+        if not os.path.exists(cache_path):
+            return None
+
+        with np.load(cache_path) as features:
+            utterance = Utterance(features['data'], int(features['sample_rate']),
+                                  frame_length_in_ms=frame_length_in_ms,
+                                  voiced_threshold_factor=voiced_threshold_factor)
+            utterance._f0 = features['f0']
+            utterance._timeaxis = features['timeaxis']
+            utterance._spectrogram = features['spectrogram']
+            utterance._aperiodicity = features['aperiodicity']
+        return utterance
+
+    def save(self, path, utterance):
+        """Save a decomposed utterance in the cache
+
+        Parameters
+        ----------
+        path: str
+            Path to the audio file of the utterance
+        utterance: Utterance
+        """
+        cache_path = self._get_cache_path(path, utterance.frame_length_in_ms, utterance.voiced_threshold_factor)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        # several processes may save the same entry: write in a temp file, then rename it atomically
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, data=utterance.data, sample_rate=utterance.sample_rate,
+                     f0=utterance.f0, timeaxis=utterance.timeaxis,
+                     spectrogram=utterance.spectrogram, aperiodicity=utterance.aperiodicity)
+        os.replace(temp_path, cache_path)
+
+    def _get_cache_path(self, path, frame_length_in_ms, voiced_threshold_factor):
+        if isinstance(path, ArchiveMember):
+            key = '{}|{}|{}|{}'.format(path.name, hashlib.sha1(path.data).hexdigest(),
+                                       frame_length_in_ms, voiced_threshold_factor)
+        else:
+            stat = os.stat(path)
+            key = '{}|{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                                          frame_length_in_ms, voiced_threshold_factor)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + '.npz')
+
+
+def load_utterance(path, frame_length_in_ms=20, voiced_threshold_factor=0.06, lazy=True, cache=None):
     """Load an utterance from a path
 
     Parameters
     ----------
-    path: str
-        Path to the audio file
+    path: str or voice_transformation.utils.archive.ArchiveMember
+        Path to the audio file, or audio file read from an archive
     frame_length_in_ms: int
         Length of the frames
     voiced_threshold_factor: float
         Factor to apply to the energy mean to get the voiced threshold
     lazy: bool
         If True, the data will be decoded only when needed. If False, the data will be decoded when loaded.
+    cache: FeatureCache
+        If set, the decomposed utterance is read from this cache, or analysed and saved in it (only if not lazy)
 
     Returns
     -------
     Utterance
 
     """
-    with open(path, 'rb') as f:
+    if cache is not None and not lazy:
+        utterance = cache.load(path, frame_length_in_ms, voiced_threshold_factor)
+        if utterance is not None:
+            return utterance
+
+    with _open(path) as f:
         data, sample_rate = sf.read(f)
 
     utterance = Utterance(data, sample_rate,
@@ -61,19 +145,29 @@ def load_utterance(path, frame_length_in_ms=20, voiced_threshold_factor=0.06, la
 
     if not lazy:
         utterance.decompose()
+        if cache is not None:
+            cache.save(path, utterance)
 
     return utterance
 
 
-def load_utterances_parallel(path_to_utterances, pool, desc='Load data'):
+def get_duration(path):
+    """Get the duration in seconds of an audio file (or of an `ArchiveMember`), from its header"""
+    with _open(path) as f:
+        return sf.info(f).duration
+
+
+def load_utterances_parallel(path_to_utterances, pool, desc='Load data', cache=None):
     """Load utterances using multiprocessing
 
     Parameters
     ----------
-    path_to_utterances: list of str
+    path_to_utterances: list of str or ArchiveMember
         List of paths to audio files
     pool: multiprocessing.Pool
         Pool of processes to run in parallel to decode the utterances
+    cache: FeatureCache
+        Optional cache of the decomposed utterances. See `load_utterance`
 
     Returns
     -------
@@ -90,7 +184,7 @@ def load_utterances_parallel(path_to_utterances, pool, desc='Load data'):
     p.start()
 
     # analyse the utterances in parallel
-    utterances = pool.starmap(_get_utterance_data, [(path, q) for path in path_to_utterances])
+    utterances = pool.starmap(_get_utterance_data, [(path, q, cache) for path in path_to_utterances])
 
     # stop the progress bar process
     q.put(None)
@@ -99,12 +193,13 @@ def load_utterances_parallel(path_to_utterances, pool, desc='Load data'):
     return utterances
 
 
-def _get_utterance_data(path, q):
-    utt = load_utterance(path, lazy=False)
+def _get_utterance_data(path, q, cache=None):
+    utt = load_utterance(path, lazy=False, cache=cache)
     q.put(1)  # to display a progressbar
     return utt
 
 
-
-
-
+def _open(path):
+    if isinstance(path, ArchiveMember):
+        return io.BytesIO(path.data)
+    return open(path, 'rb')
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Convert whole speakers in worker processes
+
+The conversion of a speaker (fit of the transformer, then transformation and synthesis of each utterance) is the
+costly part of the conversion of a corpus. The functions of this module run it in worker processes, one speaker per
+worker, so that several speakers are converted at the same time. The transformed utterances are saved directly by the
+workers.
+
+"""
+
+import collections
+import itertools
+import multiprocessing
+import os
+import pickle
+import random
+import threading
+
+import numpy as np
+import tqdm
+
+from voice_transformation.utils.load import load_utterance
+from voice_transformation.utils.sharding import reseed
+from voice_transformation.utils.writer import FileWriter
+
+
+SpeakerJob = collections.namedtuple('SpeakerJob', ['spk_id', 'input_paths', 'output_paths', 'targets',
+                                                   'feature_cache', 'transformer', 'transformer_path', 'seed',
+                                                   'utterance_seeds', 'enrollment'],
+                                    defaults=[None, None, None, None, None, None])
+SpeakerJob.__doc__ = """Conversion of the utterances of a speaker
+
+Attributes
+----------
+spk_id: str
+input_paths: list of str
+    Paths to the audio files of the utterances to convert
+output_paths: list of str
+    Where to save each transformed utterance
+targets: list of str or None
+    Target speaker of each utterance. None lets the transformer choose a target
+feature_cache: voice_transformation.utils.load.FeatureCache
+    Optional cache where the decomposed utterances of the speaker can be found (e.g. for a target speaker)
+transformer: voice_transformation.VoiceTransformer
+    Transformer already fitted to the speaker (e.g. when a run is resumed). If None, a transformer is fitted on the
+    utterances to convert, which must then be all the utterances of the speaker
+transformer_path: str
+    Where to save the fitted transformer, to resume the conversion of the speaker without fitting it again
+seed: int
+    If set, the random generators are reseeded with it before fitting the transformer
+utterance_seeds: list of int
+    If set, the random generators are reseeded with the seed of each utterance before transforming it
+enrollment: list of int
+    If set, indices of the utterances to load before the fit: the transformer is fitted on them (if not already
+    fitted) and the other utterances are streamed, i.e. loaded, transformed and saved one at a time, so that the memory
+    used doesn't depend on the number of utterances of the speaker. If None, all the utterances are loaded first
+"""
+
+# Transformer class, pre-built params and writer of the worker processes, set by `_init_worker`
+_transformer_class = None
+_transformer_params = None
+_writer = None
+
+# Transformers loaded by the process from their pickle file (see `get_transformer`), the most recently used last
+_transformers = collections.OrderedDict()
+_MAX_TRANSFORMERS = 4
+
+
+def fit_transformer(transformer, utterances, save_path=None, seed=None):
+    """Fit a transformer to a speaker
+
+    Parameters
+    ----------
+    transformer: voice_transformation.VoiceTransformer
+        Transformer initialized with the pre-built params
+    utterances: list of Utterance
+        All the utterances of the speaker
+    save_path: str
+        If set, the fitted transformer is pickled in this file
+    seed: int
+        If set, the random generators are reseeded with it before the fit
+
+    Returns
+    -------
+    voice_transformation.VoiceTransformer
+        The fitted transformer
+
+    """
+    if seed is not None:
+        reseed(seed)
+    transformer.fit(utterances)
+    if save_path:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(save_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(transformer, f)
+        os.replace(temp_path, save_path)
+    return transformer
+
+
+def get_transformer(transformer):
+    """Get a transformer, or load it from its pickle file
+
+    A pickled transformer is loaded once per process: the tasks of the utterances of a speaker only carry the path to
+    its file (see `shareable_transformer`), and the last loaded transformers are kept
+
+    Parameters
+    ----------
+    transformer: voice_transformation.VoiceTransformer or str
+        The transformer, or the path to the file where it is pickled
+
+    """
+    if not isinstance(transformer, str):
+        return transformer
+    if transformer in _transformers:
+        _transformers.move_to_end(transformer)
+    else:
+        with open(transformer, 'rb') as f:
+            _transformers[transformer] = pickle.load(f)
+        if len(_transformers) > _MAX_TRANSFORMERS:
+            _transformers.popitem(last=False)
+    return _transformers[transformer]
+
+
+def shareable_transformer(job, transformer):
+    """What to send to the processes transforming the utterances of a job: the path to the file of its fitted
+    transformer if it is saved, so that it is pickled only once per process and not in every task, else the transformer
+    """
+    if job.transformer_path and os.path.exists(job.transformer_path):
+        return job.transformer_path
+    return transformer
+
+
+def get_enrollment(job):
+    """Get the indices of the utterances of a job to load before the fit, see `SpeakerJob.enrollment`"""
+    return job.enrollment if job.enrollment is not None else range(len(job.input_paths))
+
+
+def get_enrollment_paths(job):
+    """Get the paths of the utterances of a job to load before the fit, see `SpeakerJob.enrollment`"""
+    return [job.input_paths[i] for i in get_enrollment(job)]
+
+
+def convert_speaker(transformer_class, transformer_params, job, utterances, writer=None, desc=None, pool=None,
+                    window=None):
+    """Fit a transformer to a speaker if needed, then transform and save the utterances of the speaker
+
+    Parameters
+    ----------
+    transformer_class: type
+        The `Transformer` class of the conversion method
+    transformer_params
+        Params pre-built with the `builder` function of the conversion method
+    job: SpeakerJob
+    utterances: list of Utterance
+        The loaded utterances of `get_enrollment_paths(job)`. The other utterances of the job are streamed
+    writer: voice_transformation.utils.writer.FileWriter or voice_transformation.utils.writer.TarShardWriter
+        Writer of the transformed utterances. Default is a `FileWriter` without journal
+    desc: str
+        If set, display a progress bar with this description
+    pool: multiprocessing.Pool
+        If set, the streamed utterances are loaded and transformed in this pool. Else, in the current process
+    window: int
+        Max number of streamed utterances submitted to the pool and not saved yet. Default is 4
+
+    """
+    if writer is None:
+        writer = FileWriter()
+
+    transformer = job.transformer
+    if transformer is None:
+        transformer = fit_transformer(transformer_class(transformer_params), utterances, job.transformer_path, job.seed)
+
+    seeds = job.utterance_seeds or [None] * len(job.input_paths)
+    progress_bar = tqdm.tqdm(total=len(job.input_paths), desc=desc) if desc else None
+
+    # the loaded utterances first, then the streamed ones
+    enrollment = get_enrollment(job)
+    transformed = ((i, transform_utterance(transformer, utterance, job.targets[i], seeds[i]))
+                   for i, utterance in zip(enrollment, utterances))
+    streamed = set(range(len(job.input_paths))).difference(enrollment)
+    shared = shareable_transformer(job, transformer) if pool is not None else transformer
+    tasks = [(i, (job.input_paths[i], shared, job.targets[i], seeds[i], job.feature_cache))
+             for i in sorted(streamed)]
+    for i, transformed_utt in itertools.chain(transformed, _map_bounded(load_and_transform_utterance, tasks, pool,
+                                                                        window or 4)):
+        writer.write(transformed_utt, job.output_paths[i])
+        if progress_bar is not None:
+            progress_bar.update()
+
+    if progress_bar is not None:
+        progress_bar.close()
+
+
+def transform_utterance(transformer, utterance, target=None, seed=None):
+    """Transform an utterance, after reseeding the random generators if a seed is given. The transformer can be given
+    by the path to its pickle file, see `get_transformer`"""
+    if seed is not None:
+        reseed(seed)
+    return get_transformer(transformer).transform(utterance, target=target)
+
+
+def load_and_transform_utterance(path, transformer, target=None, seed=None, cache=None):
+    """Load, decompose and transform an utterance, see `transform_utterance`"""
+    utterance = load_utterance(path, lazy=False, cache=cache)
+    return transform_utterance(transformer, utterance, target, seed)
+
+
+def convert_speakers_parallel(transformer_class, transformer_params, jobs, nb_proc, max_in_flight=None, writer=None,
+                              total=None, desc='Conversion'):
+    """Convert speakers in parallel, each one in a worker process
+
+    Parameters
+    ----------
+    transformer_class: type
+        The `Transformer` class of the conversion method
+    transformer_params
+        Params pre-built with the `builder` function of the conversion method
+    jobs: iterable of SpeakerJob
+        The speakers to convert. The iterable is consumed lazily, as the workers become available
+    nb_proc: int
+        Number of worker processes
+    max_in_flight: int
+        Max number of speakers submitted to the workers and not converted yet. This bounds the memory used by the
+        pending jobs. Default is twice the number of processes
+    writer: voice_transformation.utils.writer.FileWriter or voice_transformation.utils.writer.TarShardWriter
+        Writer of the transformed utterances, used by each worker. Default is a `FileWriter` without journal
+    total: int
+        Number of jobs, to display the progress bar
+    desc: str
+        Description of the progress bar
+
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * nb_proc
+    slots = threading.BoundedSemaphore(max_in_flight)
+    errors = []
+    progress_bar = tqdm.tqdm(total=total, desc=desc)
+
+    def on_success(_):
+        progress_bar.update()
+        slots.release()
+
+    def on_error(error):
+        errors.append(error)
+        slots.release()
+
+    with multiprocessing.Pool(nb_proc, initializer=_init_worker,
+                              initargs=(transformer_class, transformer_params, writer)) as pool:
+        for job in jobs:
+            slots.acquire()
+            if errors:
+                break
+            pool.apply_async(_convert_speaker_job, (job,), callback=on_success, error_callback=on_error)
+        pool.close()
+        pool.join()
+    progress_bar.close()
+
+    if errors:
+        raise errors[0]
+
+
+def _init_worker(transformer_class, transformer_params, writer):
+    global _transformer_class, _transformer_params, _writer
+    _transformer_class = transformer_class
+    _transformer_params = transformer_params
+    _writer = writer
+
+    # forked workers inherit the random state of the parent: reseed them so that they don't draw the same values
+    np.random.seed()
+    random.seed()
+
+
+def _convert_speaker_job(job):
+    utterances = [load_utterance(path, lazy=False, cache=job.feature_cache) for path in get_enrollment_paths(job)]
+    convert_speaker(_transformer_class, _transformer_params, job, utterances, writer=_writer)
+    if _writer is not None:
+        # the speaker is converted once its utterances are saved
+        _writer.flush()
+    return job.spk_id
+
+
+def _map_bounded(fn, tasks, pool, window):
+    # yield (key, fn(*args)) for each (key, args) of tasks, with at most `window` calls pending in the pool
+    if pool is None:
+        for key, args in tasks:
+            yield key, fn(*args)
+        return
+
+    pending = collections.deque()
+    for key, args in tasks:
+        pending.append((key, pool.apply_async(fn, args)))
+        if len(pending) >= window:
+            key, result = pending.popleft()
+            yield key, result.get()
+    while pending:
+        key, result = pending.popleft()
+        yield key, result.get()
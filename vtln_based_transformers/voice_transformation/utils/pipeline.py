@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Convert speakers with a pipeline of stages
+
+The conversion of a speaker is split in 4 stages:
+
+- analysis: decode the audio files and decompose the utterances (WORLD analysis), in the pool of processes
+- fit: fit a transformer to the speaker, in the main process
+- transform: transform the utterances and synthesize the new waveforms, in the pool of processes
+- write: encode and save the transformed utterances, in threads
+
+If only some enrollment utterances of a speaker are analysed before the fit (see `SpeakerJob.enrollment`), the other
+utterances are analysed by the transform stage, in the same task as their transformation.
+
+Each stage runs in its own thread and the stages are connected by bounded queues, so that the analysis of the next
+speakers overlaps the synthesis and the encoding of the current one, while the bounds keep the memory in check.
+
+See `ConversionPipeline`
+
+"""
+
+import queue
+import threading
+import time
+
+import tqdm
+
+from voice_transformation.utils.load import load_utterance
+from voice_transformation.utils.parallel import (fit_transformer, get_enrollment, get_enrollment_paths,
+                                                  load_and_transform_utterance, shareable_transformer,
+                                                  transform_utterance)
+from voice_transformation.utils.writer import FileWriter
+
+
+class StageStats:
+    """Counters of a stage of the pipeline
+
+    Attributes
+    ----------
+    name: str
+    count: int
+        Number of items processed by the stage
+    unit: str
+        What an item is : speakers or utterances
+
+    """
+    def __init__(self, name, unit, depth_fn):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self._depth_fn = depth_fn
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        with self._lock:
+            self.count += count
+
+    @property
+    def depth(self):
+        """Number of items waiting to be processed by the stage"""
+        return self._depth_fn()
+
+
+class ConversionPipeline:
+    """Convert speakers with a pipeline of analysis, fit, transform and write stages
+
+    Parameters
+    ----------
+    transformer_class: type
+        The `Transformer` class of the conversion method
+    transformer_params
+        Params pre-built with the `builder` function of the conversion method
+    pool: multiprocessing.Pool
+        Pool of processes for the analysis and transform stages
+    max_speakers: int
+        Max number of speakers waiting between 2 stages
+    max_utterances: int
+        Max number of utterances submitted to the transform stage and not written yet
+    nb_writers: int
+        Number of threads of the write stage
+    writer: voice_transformation.utils.writer.FileWriter or voice_transformation.utils.writer.TarShardWriter
+        Writer of the transformed utterances. Default is a `FileWriter` without journal
+
+    Examples
+    --------
+    >>> pipeline = ConversionPipeline(Transformer, params, pool)
+    >>> pipeline.run(jobs)  # jobs: iterable of voice_transformation.utils.parallel.SpeakerJob
+    >>> print(pipeline.format_stats())
+
+    """
+
+    def __init__(self, transformer_class, transformer_params, pool, max_speakers=2, max_utterances=16, nb_writers=2,
+                 writer=None):
+        self.transformer_class = transformer_class
+        self.transformer_params = transformer_params
+        self.pool = pool
+        self.nb_writers = nb_writers
+        self.writer = writer if writer is not None else FileWriter()
+
+        self._fit_queue = queue.Queue(max_speakers)
+        self._transform_queue = queue.Queue(max_speakers)
+        self._write_queue = queue.Queue(max_utterances)
+
+        self._pending_analyses = 0
+        self.stages = [StageStats('analysis', 'utt', lambda: self._pending_analyses),
+                       StageStats('fit', 'spk', self._fit_queue.qsize),
+                       StageStats('transform', 'utt', self._transform_queue.qsize),
+                       StageStats('write', 'utt', self._write_queue.qsize)]
+        self._analysis_stats, self._fit_stats, self._transform_stats, self._write_stats = self.stages
+
+        self._errors = []
+        self._failed = threading.Event()
+        self._remaining_utterances = {}
+        self._lock = threading.Lock()
+        self._progress_bar = None
+        self._start_time = None
+
+    def run(self, jobs, total=None, desc='Conversion'):
+        """Convert the speakers
+
+        Parameters
+        ----------
+        jobs: iterable of voice_transformation.utils.parallel.SpeakerJob
+            The speakers to convert. The iterable is consumed lazily by the analysis stage
+        total: int
+            Number of jobs, to display the progress bar
+        desc: str
+            Description of the progress bar
+
+        """
+        self._start_time = time.time()
+        self._progress_bar = tqdm.tqdm(total=total, desc=desc)
+
+        threads = [threading.Thread(target=self._run_stage, args=(self._analyse, jobs)),
+                   threading.Thread(target=self._run_stage, args=(self._fit,)),
+                   threading.Thread(target=self._run_stage, args=(self._transform,))]
+        threads.extend(threading.Thread(target=self._run_stage, args=(self._write,)) for _ in range(self.nb_writers))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._progress_bar.close()
+        if self._errors:
+            raise self._errors[0]
+
+    def stats(self):
+        """Get the queue depth and the throughput of each stage
+
+        Returns
+        -------
+        dict
+            keys = stage names
+            values = dict with the number of items waiting in the input queue of the stage (`queue`), the number of
+            items processed (`count`) and the number of items processed per second since the start (`per_second`)
+        """
+        elapsed = time.time() - self._start_time if self._start_time else 0
+        return {stage.name: {'queue': stage.depth,
+                             'count': stage.count,
+                             'per_second': stage.count / elapsed if elapsed else 0.,
+                             'unit': stage.unit}
+                for stage in self.stages}
+
+    def format_stats(self):
+        return ' | '.join('{}: q={} {:.2f} {}/s'.format(name, s['queue'], s['per_second'], s['unit'])
+                          for name, s in self.stats().items())
+
+    # STAGES
+    # each stage reads its input queue until it gets None, then sends None to the next stage
+    def _analyse(self, jobs):
+        for job in jobs:
+            paths = get_enrollment_paths(job)
+            with self._lock:
+                self._pending_analyses += len(paths)
+            results = [self.pool.apply_async(load_utterance, (path,), {'lazy': False, 'cache': job.feature_cache},
+                                             callback=self._on_analysed, error_callback=self._on_error)
+                       for path in paths]
+            self._put(self._fit_queue, (job, results))
+        self._put(self._fit_queue, None)
+
+    def _fit(self):
+        for job, results in self._iter_queue(self._fit_queue):
+            utterances = [result.get() for result in results]
+            transformer = job.transformer
+            if transformer is None:
+                transformer = fit_transformer(self.transformer_class(self.transformer_params), utterances,
+                                              job.transformer_path, job.seed)
+            self._fit_stats.add()
+            self._put(self._transform_queue, (job, transformer, utterances))
+        self._put(self._transform_queue, None)
+
+    def _transform(self):
+        for job, transformer, utterances in self._iter_queue(self._transform_queue):
+            with self._lock:
+                self._remaining_utterances[job.spk_id] = len(job.input_paths)
+            seeds = job.utterance_seeds or [None] * len(job.input_paths)
+            # the path to the saved transformer, loaded once by each process
+            transformer = shareable_transformer(job, transformer)
+
+            # the analysed utterances first, then the streamed ones are analysed and transformed in the same task
+            enrollment = get_enrollment(job)
+            for i, utterance in zip(enrollment, utterances):
+                result = self.pool.apply_async(transform_utterance, (transformer, utterance, job.targets[i], seeds[i]))
+                self._put(self._write_queue, (job.spk_id, job.output_paths[i], result))
+            del utterances
+            for i in sorted(set(range(len(job.input_paths))).difference(enrollment)):
+                result = self.pool.apply_async(load_and_transform_utterance,
+                                               (job.input_paths[i], transformer, job.targets[i], seeds[i],
+                                                job.feature_cache))
+                self._put(self._write_queue, (job.spk_id, job.output_paths[i], result))
+        for _ in range(self.nb_writers):
+            self._put(self._write_queue, None)
+
+    def _write(self):
+        for spk_id, output_path, result in self._iter_queue(self._write_queue):
+            transformed_utt = result.get()
+            self._transform_stats.add()
+
+            self.writer.write(transformed_utt, output_path)
+            self._write_stats.add()
+
+            with self._lock:
+                self._remaining_utterances[spk_id] -= 1
+                speaker_done = self._remaining_utterances[spk_id] == 0
+                if speaker_done:
+                    del self._remaining_utterances[spk_id]
+                    self._progress_bar.set_postfix_str(self.format_stats(), refresh=False)
+                    self._progress_bar.update()
+
+    # PLUMBING
+    def _run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except _Aborted:
+            pass
+        except Exception as e:
+            self._on_error(e)
+
+    def _on_analysed(self, _):
+        with self._lock:
+            self._pending_analyses -= 1
+        self._analysis_stats.add()
+
+    def _on_error(self, error):
+        self._errors.append(error)
+        self._failed.set()
+
+    def _put(self, q, item):
+        # do not block forever on a full queue if the next stage has failed
+        while True:
+            if self._failed.is_set():
+                raise _Aborted()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _iter_queue(self, q):
+        while True:
+            if self._failed.is_set():
+                raise _Aborted()
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            yield item
+
+
+class _Aborted(Exception):
+    pass
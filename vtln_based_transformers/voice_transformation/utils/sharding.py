@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Split a conversion deterministically across several nodes
+
+Each speaker is assigned to a shard from a hash of its id, and each random draw of the conversion (choice of the
+targets, fit of the transformer, transformation of an utterance) is done after reseeding the random generators with a
+seed derived from the seed of the run and from what is drawn. So the output of an utterance depends only on the seed
+of the run, not on the node, the process or the order in which the utterances are converted, and N nodes converting
+a shard each produce exactly the output of a single node converting the whole corpus.
+
+"""
+
+import hashlib
+import random
+
+import numpy as np
+
+
+def parse_shard(shard):
+    """Parse a shard given as 'i/N'
+
+    Parameters
+    ----------
+    shard: str
+        'i/N' for the i-th of N shards, i in [0, N)
+
+    Returns
+    -------
+    tuple
+        (i, N)
+
+    """
+    try:
+        index, count = (int(value) for value in shard.split('/'))
+    except ValueError:
+        raise ValueError("Invalid shard '{}': expected 'i/N'".format(shard))
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard '{}': expected 0 <= i < N".format(shard))
+    return index, count
+
+
+def in_shard(key, shard):
+    """Whether a speaker belongs to a shard
+
+    Parameters
+    ----------
+    key: str
+        Id of the speaker
+    shard: tuple
+        (i, N) as returned by `parse_shard`
+
+    """
+    index, count = shard
+    return _hash(key) % count == index
+
+
+def derive_seed(seed, *keys):
+    """Derive a seed from the seed of the run and some keys (speaker id, utterance path...)
+
+    Returns
+    -------
+    int
+        A seed in [0, 2**32), suitable for `reseed`
+
+    """
+    return _hash(seed, *keys) % 2 ** 32
+
+
+def reseed(seed):
+    """Reseed the global generators of `random` and `numpy.random` used by the transformers"""
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def _hash(*keys):
+    # unlike hash(), stable across processes and runs
+    data = '\0'.join(str(key) for key in keys).encode()
+    return int.from_bytes(hashlib.sha1(data).digest()[:8], 'big')
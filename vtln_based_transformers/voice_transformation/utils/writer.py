@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# This file is a part of the voice transformation tool
+# developed as part of the COMPRISE project
+# Author(s): Nathalie Vauquier, Brij Mohan Lal Srivastava
+# Copyright (C) 2019 Inria
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Save the transformed utterances
+
+2 writers are available:
+
+- `FileWriter` saves each utterance in its own audio file, atomically: in a temp file first, which is renamed once
+  complete. An interrupted run never leaves a partially written utterance under its final name.
+- `TarShardWriter` appends the utterances to tar archives of bounded size (the shards), to write a few large files
+  sequentially instead of many small ones. A shard is renamed once complete, and its utterances are then listed in an
+  index.
+
+Both writers have the same interface: `write(utterance, output_path)`, `flush()` and `close()`, and can record the
+saved utterances in a journal. The utterances can be encoded and saved in background threads by wrapping a writer in
+an `AsyncWriter`.
+
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing.util
+import os
+import tarfile
+import threading
+import time
+import uuid
+
+
+# directories already created by this process, to avoid checking them for each utterance
+_created_dirs = set()
+
+
+def save_utterance(utterance, output_path, journal=None, subtype=None):
+    """Save an utterance atomically
+
+    Parameters
+    ----------
+    utterance: voice_transformation.Utterance
+    output_path: str
+        Path to the audio file to create. The format is inferred from the extension
+    journal: voice_transformation.utils.journal.Journal
+        If set, the utterance is recorded in this journal once saved
+    subtype: str
+        Subtype of the data, see `voice_transformation.Utterance.save`
+
+    """
+    directory, filename = os.path.split(output_path)
+    _makedirs(directory)
+
+    # hidden temp file, with the same extension to keep the format
+    root, ext = os.path.splitext(filename)
+    temp_path = os.path.join(directory, '.{}.{}.tmp{}'.format(root, os.getpid(), ext))
+    utterance.save(temp_path, subtype=subtype)
+    _fsync(temp_path)
+    os.replace(temp_path, output_path)
+
+    if journal is not None:
+        journal.record(output_path)
+
+
+class FileWriter:
+    """Save each utterance in its own file, see `save_utterance`
+
+    Parameters
+    ----------
+    journal: voice_transformation.utils.journal.Journal
+        If set, the saved utterances are recorded in this journal
+    subtype: str
+        Subtype of the data, see `voice_transformation.Utterance.save`
+
+    """
+    def __init__(self, journal=None, subtype=None):
+        self.journal = journal
+        self.subtype = subtype
+
+    def write(self, utterance, output_path):
+        save_utterance(utterance, output_path, self.journal, self.subtype)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TarShardWriter:
+    """Save the utterances in tar shards of bounded size
+
+    The utterances are added to the current shard, which is closed and replaced by a new one once it reaches
+    `max_size`. A shard is written under a temp name (`.tar.tmp`) and renamed once closed: only then are its utterances
+    added to the index and recorded in the journal. So an interrupted run loses the utterances of the shards being
+    written, which are converted again when the run is resumed.
+
+    The index (`index.tsv` in the root directory) has a line for each utterance: its path in the shard, the name of
+    the shard, the offset of its data in the shard and its size, so that it can be read without going through the
+    whole shard.
+
+    Each process writes its own shards: the writer can be passed to worker processes, and the shards of a worker are
+    closed when it exits.
+
+    Parameters
+    ----------
+    root: str
+        Output directory. The shards are written in its `shards` subdirectory, and the paths of the utterances in the
+        shards are relative to it
+    journal: voice_transformation.utils.journal.Journal
+        If set, the utterances are recorded in this journal once their shard is complete
+    max_size: int
+        Size in bytes from which a shard is closed
+    subtype: str
+        Subtype of the data, see `voice_transformation.Utterance.save`
+
+    """
+    def __init__(self, root, journal=None, max_size=1 << 30, subtype=None):
+        self.root = root
+        self.journal = journal
+        self.max_size = max_size
+        self.subtype = subtype
+        self.index_path = os.path.join(root, 'index.tsv')
+        self._reset()
+
+    def write(self, utterance, output_path):
+        name = os.path.relpath(output_path, self.root)
+        buffer = io.BytesIO()
+        utterance.save(buffer, format=os.path.splitext(output_path)[1][1:].upper(), subtype=self.subtype)
+        data = buffer.getvalue()
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # first write in a forked process: don't reuse the shards of the parent process
+                self._reset()
+                multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+            if self._shard is None:
+                self._open_shard()
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            header_size = len(info.tobuf(self._shard.format, self._shard.encoding, self._shard.errors))
+            offset = self._shard.offset + header_size
+            self._shard.addfile(info, io.BytesIO(data))
+            self._records.append((output_path, name, offset, len(data), hashlib.sha256(data).hexdigest()))
+
+            if self._shard.offset >= self.max_size:
+                self._close_shard()
+
+    def flush(self):
+        # the utterances are durable only once their shard is closed: see `close`
+        pass
+
+    def close(self):
+        """Close the current shard"""
+        with self._lock:
+            if self._pid == os.getpid() and self._shard is not None:
+                self._close_shard()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # unique prefix of the shards of this process, also among several nodes writing in the same directory
+        self._prefix = uuid.uuid4().hex[:12]
+        self._nb_shards = 0
+        self._shard = None
+        self._shard_name = None
+        self._records = []
+
+    def _open_shard(self):
+        self._shard_name = os.path.join('shards', '{}-{:05d}.tar'.format(self._prefix, self._nb_shards))
+        self._nb_shards += 1
+        shard_path = os.path.join(self.root, self._shard_name)
+        _makedirs(os.path.dirname(shard_path))
+        self._shard = tarfile.open(shard_path + '.tmp', mode='w', format=tarfile.PAX_FORMAT)
+
+    def _close_shard(self):
+        self._shard.close()
+        shard_path = os.path.join(self.root, self._shard_name)
+        _fsync(shard_path + '.tmp')
+        os.replace(shard_path + '.tmp', shard_path)
+
+        lines = ''.join('{}\t{}\t{}\t{}\n'.format(name, self._shard_name, offset, size)
+                        for _, name, offset, size, _ in self._records)
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+        if self.journal is not None:
+            self.journal.record_many([(output_path, size, checksum)
+                                      for output_path, _, _, size, checksum in self._records])
+
+        self._shard = None
+        self._records = []
+
+    def __getstate__(self):
+        # sent to a worker process: it will write its own shards
+        state = self.__dict__.copy()
+        for key in ('_lock', '_shard', '_records'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+        self._pid = None
+
+
+class AsyncWriter:
+    """Encode and save the utterances in background threads
+
+    `write` returns as soon as the utterance is submitted to the threads, so that the encoding of an utterance
+    overlaps the transformation of the next one (libsndfile releases the GIL while encoding). The number of submitted
+    utterances not saved yet is bounded: `write` blocks when it is reached.
+
+    The utterances are recorded in the journal of the wrapped writer once durable, by the threads. Call `flush` to
+    wait until all the submitted utterances are saved. An error raised while saving an utterance is raised again by
+    the next call to `write`, `flush` or `close`.
+
+    The writer can be passed to worker processes: each process starts its own threads.
+
+    Parameters
+    ----------
+    writer: FileWriter or TarShardWriter
+        The writer to use in the threads
+    nb_threads: int
+    max_pending: int
+        Max number of utterances submitted and not saved yet. Default is twice the number of threads
+
+    """
+    def __init__(self, writer, nb_threads=2, max_pending=None):
+        self.writer = writer
+        self.nb_threads = nb_threads
+        self.max_pending = max_pending or 2 * nb_threads
+        self._pid = None
+
+    def write(self, utterance, output_path):
+        self._start()
+        self._raise_error()
+        self._slots.acquire()
+        future = self._executor.submit(self.writer.write, utterance, output_path)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def flush(self):
+        """Wait until all the submitted utterances are saved"""
+        if self._pid == os.getpid():
+            with self._lock:
+                pending = list(self._pending)
+            concurrent.futures.wait(pending)
+        self._raise_error()
+        self.writer.flush()
+
+    def close(self):
+        """Save the submitted utterances, stop the threads and close the wrapped writer"""
+        try:
+            self.flush()
+        finally:
+            if self._pid == os.getpid():
+                self._executor.shutdown()
+                self._pid = None
+            self.writer.close()
+
+    def _start(self):
+        # first write in this process (the threads are not inherited by forked processes)
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.nb_threads)
+            self._slots = threading.BoundedSemaphore(self.max_pending)
+            self._lock = threading.Lock()
+            self._pending = set()
+            self._errors = []
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _raise_error(self):
+        if self._pid == os.getpid() and self._errors:
+            raise self._errors[0]
+
+    def __getstate__(self):
+        return {'writer': self.writer, 'nb_threads': self.nb_threads, 'max_pending': self.max_pending,
+                '_pid': None}
+
+
+def _makedirs(directory):
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -71,9 +71,7 @@ def builder(target_utterances, nb_classes=8, nb_proc=None):
         - the log f0 of each target speaker
 
     """
-    def k_means(utterances):
-        voiced_frames = np.concatenate([utt.spectrogram[utt.voiced_frames] for utt in utterances])
-        return sklearn.cluster.KMeans(n_clusters=nb_classes, n_jobs=nb_proc).fit(voiced_frames)
+    k_means = KMeansClusterer(nb_classes=nb_classes, nb_proc=nb_proc)
 
     target_centroids = {spk_id: k_means(target_utterances[spk_id]).cluster_centers_
                         for spk_id in target_utterances}
@@ -84,6 +82,30 @@ def builder(target_utterances, nb_classes=8, nb_proc=None):
     return k_means, target_centroids, target_pitches
 
 
+class KMeansClusterer:
+    """Build and fit the clusterer of the "artificial phonetic classes" of a speaker
+
+    This is the function returned in the built params. It is a class rather than a closure so that the built params
+    (and the fitted transformers) can be pickled, e.g. to be sent to worker processes.
+
+    Parameters
+    ----------
+    nb_classes: int
+        Number of "artifical phonetic classes" to consider
+    nb_proc: int
+        Number of jobs to use for the computation
+
+    """
+
+    def __init__(self, nb_classes=8, nb_proc=None):
+        self.nb_classes = nb_classes
+        self.nb_proc = nb_proc
+
+    def __call__(self, utterances):
+        voiced_frames = np.concatenate([utt.spectrogram[utt.voiced_frames] for utt in utterances])
+        return sklearn.cluster.KMeans(n_clusters=self.nb_classes, n_jobs=self.nb_proc).fit(voiced_frames)
+
+
 class Transformer(VoiceTransformer):
     """Transform speech utterances of a given speaker using vtln-based voice conversion
 
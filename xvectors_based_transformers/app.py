@@ -1,14 +1,139 @@
+import argparse
+import hashlib
 import os
-import pickle
-import json 
+import json
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import TimeoutError
 
-from flask import Flask, jsonify, send_from_directory, abort, request
+from flask import Flask, Response, jsonify, send_file, abort, request, g
+
+from vpc_service.admission import AdmissionController, DeadlineExceeded, Rejected, run_with_deadline
+from vpc_service.archive import MIMETYPES as ARCHIVE_MIMETYPES, extract_wavs, write_archive
+from vpc_service.batching import BatchQueue
+from vpc_service.cache import HashingReader, ResultCache, hash_file
+from vpc_service.jobs import JobManager, QueueFull, run_with_stages, DONE, QUEUED, RUNNING
+from vpc_service.metrics import Counter, Gauge, Histogram, Registry, format_server_timing, read_timings
+from vpc_service.vtln_backend import METHODS, VoiceTransformationBackend
 
 app = Flask(__name__)
 
+# TRANSFORM_SCRIPT: script running the transformation (vpc/transform.py runs the independent stages at the same time,
+# a stub can be used for tests)
+# BATCH_SIZE: max number of files converted in a single run of the script (1 = no batching)
+# BATCH_WAIT_MS: max time a file waits for other files before its batch is converted
+# JOB_WORKERS: number of jobs (see /jobs) running at the same time
+# JOB_MAX_PENDING: max number of queued or running jobs, more jobs are refused
+# JOB_RETENTION_S: time the jobs and their result are kept after their end
+# VOICEMASK_PARAMS, VTLN_PARAMS: pre-built params of the CPU backends (see /transform), None to disable them
+# ANON_POOL: anonymization pool of the transformation (relative to vpc)
+# CACHE_MAX_MB: max size of the cache of the results (0 = no cache)
+# CACHE_MAX_AGE_S: max age of the results in the cache
+# MAX_RUNNING: max number of runs of the script at the same time
+# MAX_WAITING: max number of requests waiting for a run, more requests are rejected
+# CPUS: number of CPUs shared by the runs (None = all the CPUs), see vpc_service.admission
+# REQUEST_TIMEOUT_S: default deadline of the requests to /vpc (0 = none)
+# PROFILES_DIR: directory of the profiles of the speakers (see the speaker param), None to disable them
+# SEGMENT_S: the input files longer than this are split into chunks transformed in parallel (0 = no split), see
+# --segment of transform.sh
+# WORKSPACE: directory of the intermediate files of the runs (None = /dev/shm when it has room for them), see
+# --workspace of transform.sh
+app.config.update(TRANSFORM_SCRIPT='./vpc/transform.sh', BATCH_SIZE=1, BATCH_WAIT_MS=200,
+                  JOB_WORKERS=1, JOB_MAX_PENDING=16, JOB_RETENTION_S=3600,
+                  VOICEMASK_PARAMS=None, VTLN_PARAMS=None,
+                  ANON_POOL='anon_pool/train_other_500', CACHE_MAX_MB=1024, CACHE_MAX_AGE_S=7 * 24 * 3600,
+                  MAX_RUNNING=2, MAX_WAITING=8, CPUS=None, REQUEST_TIMEOUT_S=0, PROFILES_DIR=None,
+                  SEGMENT_S=0, WORKSPACE=None)
+
 if not os.path.exists('io'):
     os.makedirs('io')
 
+# each request works in its own directory of io/requests, and in its own data dirs in vpc (see --name of transform.sh),
+# so that several requests can be processed at the same time
+REQUESTS_DIR = os.path.join('io', 'requests')
+JOBS_DIR = os.path.join('io', 'jobs')
+CACHE_DIR = os.path.join('io', 'cache')
+
+# the params of the transformation which can be sent with a request (see transform.sh)
+PARAMS = {'wgender', 'cross_gender', 'cross-gender', 'distance', 'proximity', 'sample_frequency', 'sample-frequency',
+          'rand_seed', 'rand-seed', 'speaker'}
+# the default values of transform.sh, so that the same transformation always has the same normalized params
+DEFAULT_PARAMS = {'cross-gender': 'same', 'distance': 'plda', 'proximity': 'dense', 'sample-frequency': '16000',
+                  'rand-seed': '20'}
+# the params of the CPU backends
+BACKEND_PARAMS = {'target'}
+CHUNK_SIZE = 1 << 20
+
+_batch_queue = None
+_job_manager = None
+_backends = {}
+_cache = None
+_admission = None
+_lock = threading.Lock()
+
+# the stages of transform.sh (see --timings)
+STAGE_NAMES = {'setup': 'data dir', 'a.0': 'x-vectors', 'a.1': 'pseudo-speakers', 'a.2': 'pitch', 'a.3': 'PPG',
+               'a.4': 'netcdf', 'a.5': 'AM', 'a.6': 'NSF', 'a.7': 'anonymized data', 'copy': 'copy',
+               'profile': 'load speaker profile', 'save-profile': 'save speaker profile'}
+
+metrics = Registry()
+STAGE_DURATION = metrics.add(Histogram('vpc_stage_duration_seconds', 'Duration of the stages of transform.sh',
+                                       ('stage', 'name')))
+STAGE_CPU = metrics.add(Histogram('vpc_stage_cpu_seconds', 'CPU time of the commands of the stages of transform.sh',
+                                  ('stage', 'name')))
+BACKEND_STEP_DURATION = metrics.add(Histogram('vpc_backend_step_duration_seconds',
+                                              'Duration of the steps of the CPU backends', ('method', 'step'),
+                                              buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)))
+REQUEST_DURATION = metrics.add(Histogram('vpc_request_duration_seconds', 'Duration of the requests', ('endpoint',)))
+IN_FLIGHT = metrics.add(Gauge('vpc_requests_in_flight', 'Number of requests being processed', ('endpoint',)))
+QUEUE_DEPTH = metrics.add(Gauge('vpc_queue_depth', 'Number of files in the batch queue, or of queued or running jobs',
+                                ('queue',)))
+CACHE_REQUESTS = metrics.add(Counter('vpc_cache_requests_total', 'Number of lookups in the cache of the results',
+                                     ('result',)))
+CACHE_HIT_RATIO = metrics.add(Gauge('vpc_cache_hit_ratio', 'Ratio of the lookups in the cache which were hits'))
+RUNNING_TRANSFORMATIONS = metrics.add(Gauge('vpc_running_transformations', 'Number of runs of transform.sh'))
+USED_CPUS = metrics.add(Gauge('vpc_used_cpus', 'Number of CPUs given to the runs of transform.sh (sum of their nj)'))
+REJECTED = metrics.add(Counter('vpc_requests_rejected_total', 'Number of requests rejected (full wait queue) or '
+                                                               'cancelled (deadline exceeded)', ('reason',)))
+CACHE_HIT_RATIO.set_function(lambda: CACHE_REQUESTS.get(result='hit') / max(
+    CACHE_REQUESTS.get(result='hit') + CACHE_REQUESTS.get(result='miss'), 1))
+
+@app.before_request
+def start_request():
+    if request.endpoint and request.endpoint != 'get_metrics':
+        g.start_time = time.perf_counter()
+        IN_FLIGHT.inc(endpoint=request.endpoint)
+
+@app.teardown_request
+def end_request(_):
+    if 'start_time' in g:
+        IN_FLIGHT.dec(endpoint=request.endpoint)
+        REQUEST_DURATION.observe(time.perf_counter() - g.start_time, endpoint=request.endpoint)
+
+@app.errorhandler(Rejected)
+def reject_request(error):
+    REJECTED.inc(reason='queue_full')
+    response = jsonify(error='too many pending requests, retry later')
+    response.status_code = 503
+    response.headers['Retry-After'] = '30'
+    return response
+
+@app.errorhandler(DeadlineExceeded)
+def cancel_request(error):
+    REJECTED.inc(reason='deadline')
+    response = jsonify(error=str(error))
+    response.status_code = 504
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    """Metrics of the service, in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def home():
     return 'Voice Transformation with VPC2020 baseline'
@@ -17,29 +142,493 @@ def home():
 @app.route("/vpc", methods=["POST"])
 def apply_vpc_baseline():
     """Upload an audio file, apply VPC on it and send the result."""
-    params = json.loads(request.args.items().__next__()[0])
-    # 1 Upload an audio file
-    source_filepath = upload_audio()
- 
-    # 2 apply vpc
-    result_filepath = '../io/output.wav'
-    from subprocess import check_call
-    cmd_vpc = ['./vpc/transform.sh']
-    cmd_vpc.extend(['--anon-pool', 'anon_pool/train_other_500'])
-    for key, value in params.items():
-        cmd_vpc.extend(['--' + key, str(value)])
-    cmd_vpc.extend(['../' + source_filepath, result_filepath])
-    check_call(cmd_vpc)
+    params = normalize_params(get_params())
+    deadline = get_deadline()
+    request_id = uuid.uuid4().hex
+    request_dir = os.path.join(REQUESTS_DIR, request_id)
+    os.makedirs(request_dir)
+    remove_request_dir = True
+    try:
+        # 1 Upload an audio file
+        source_filepath, digest = upload_audio(request_dir)
+
+        # the same file already transformed with the same params
+        cache = get_cache()
+        cache_key = get_cache_key(digest, params)
+        cached = lookup_cache(cache, cache_key)
+        if cached is not None:
+            return send_wav(cached, {'X-Cache': 'HIT'})
+
+        # 2 apply vpc
+        result_filepath = os.path.join(request_dir, 'output.wav')
+        if app.config['BATCH_SIZE'] > 1 and 'speaker' not in params:
+            # the file is converted with the files of the concurrent requests with the same params
+            # (not the files of a known speaker: each file of a batch is a different speaker)
+            # a batch is not cancelled when the deadline of one of its files is exceeded
+            key = json.dumps(params, sort_keys=True)
+            future = get_batch_queue().submit(key, (source_filepath, result_filepath))
+            try:
+                timings = future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                # the batch still reads the input and writes the output: the request dir is removed when it ends
+                remove_request_dir = False
+                future.add_done_callback(lambda _: shutil.rmtree(request_dir, ignore_errors=True))
+                raise DeadlineExceeded('deadline exceeded while waiting for the batch')
+        else:
+            timings_filepath = os.path.join(request_dir, 'timings.txt')
+            with get_admission().admit(deadline) as nj:
+                cmd_vpc = get_vpc_command(params, 'req_' + request_id, timings_filepath, nj)
+                cmd_vpc.extend(['../' + source_filepath, '../' + result_filepath])
+                run_with_deadline(cmd_vpc, deadline)
+            timings = observe_stages(timings_filepath)
+        if cache:
+            cache.put(cache_key, result_filepath)
+
+        # 3 send the result, by chunks: the open file is still readable once the request dir is removed
+        result = open(result_filepath, 'rb')
+    finally:
+        if remove_request_dir:
+            shutil.rmtree(request_dir, ignore_errors=True)
+    headers = {'Server-Timing': format_server_timing(timings, STAGE_NAMES)}
+    if cache:
+        headers['X-Cache'] = 'MISS'
+    return send_wav(result, headers)
+
+@app.route("/vpc/batch", methods=["POST"])
+def apply_vpc_speaker():
+    """Upload an archive (zip or tar) of audio files of one speaker, apply VPC on them as one speaker and send the
+    archive of the results."""
+    params = normalize_params(get_params())
+    deadline = get_deadline()
+    request_id = uuid.uuid4().hex
+    request_dir = os.path.join(REQUESTS_DIR, request_id)
+    # the files are a single speaker of create_dir_batch, named after the input dir
+    input_dir = os.path.join(request_dir, 'inputs', 'spk_' + request_id)
+    output_dir = os.path.join(request_dir, 'outputs')
+    os.makedirs(input_dir)
+    os.makedirs(output_dir)
+    try:
+        # 1 Upload the archive and extract its audio files
+        archive_filepath, _ = upload_audio(request_dir, 'input.archive')
+        try:
+            archive_format, files = extract_wavs(archive_filepath, input_dir, CHUNK_SIZE)
+        except (ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+            abort(400, 'invalid archive: {}'.format(e))
+        if not files:
+            abort(400, 'no wav file in the archive')
+        os.remove(archive_filepath)
+
+        # 2 apply vpc on all the files in a single run: one x-vector and one pseudo-speaker for the whole archive
+        timings_filepath = os.path.join(request_dir, 'timings.txt')
+        with get_admission().admit(deadline) as nj:
+            cmd_vpc = get_vpc_command(params, 'req_' + request_id, timings_filepath, nj)
+            cmd_vpc.extend(['../' + input_dir, '../' + output_dir])
+            run_with_deadline(cmd_vpc, deadline)
+        timings = observe_stages(timings_filepath)
+
+        # 3 send the archive of the results, with the names of the input files
+        result_filepath = os.path.join(request_dir, 'output.archive')
+        write_archive(archive_format, [(name, os.path.join(output_dir, utt_id + '.wav')) for name, utt_id in files],
+                      result_filepath)
+        result = open(result_filepath, 'rb')
+    finally:
+        shutil.rmtree(request_dir, ignore_errors=True)
+    return send_result(result, ARCHIVE_MIMETYPES[archive_format], 'output.' + archive_format,
+                       {'Server-Timing': format_server_timing(timings, STAGE_NAMES)})
+
+def send_wav(f, headers=None):
+    """Send an open wav file, by chunks"""
+    return send_result(f, 'audio/wav', 'output.wav', headers)
+
+def send_result(f, mimetype, download_name, headers=None):
+    """Send an open file, by chunks"""
+    response = send_file(f, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    response.content_length = os.fstat(f.fileno()).st_size
+    response.headers.extend(headers or {})
+    return response
+
+@app.route("/transform/<method>", methods=["POST"])
+def apply_cpu_backend(method):
+    """Upload an audio file, transform it in-process with the voicemask or vtln method and send the result."""
+    params = get_params(BACKEND_PARAMS)
+    backend = get_backend(method)
+    request_id = uuid.uuid4().hex
+    request_dir = os.path.join(REQUESTS_DIR, request_id)
+    os.makedirs(request_dir)
+    try:
+        source_filepath, _ = upload_audio(request_dir)
+        result_filepath = os.path.join(request_dir, 'output.wav')
+        try:
+            timings = backend.transform(source_filepath, result_filepath, target=params.get('target'))
+        except ValueError as e:
+            abort(400, str(e))
+        result = open(result_filepath, 'rb')
+    finally:
+        shutil.rmtree(request_dir, ignore_errors=True)
+    for step, seconds in timings:
+        BACKEND_STEP_DURATION.observe(seconds, method=method, step=step)
+    return send_wav(result, {'Server-Timing': format_server_timing(timings)})
+
+@app.route("/transform/<method>/targets", methods=["GET"])
+def get_backend_targets(method):
+    """List the target speakers of the voicemask or vtln method."""
+    return jsonify(get_backend(method).targets)
+
+def get_backend(method):
+    """Get the CPU backend of a method, loading its params the first time"""
+    if method not in METHODS:
+        abort(404)
+    params_path = app.config[method.upper() + '_PARAMS']
+    if not params_path:
+        abort(501, 'the {} backend is not enabled, see --{}-params'.format(method, method))
+    with _lock:
+        if method not in _backends:
+            _backends[method] = VoiceTransformationBackend(method, params_path)
+        return _backends[method]
+
+def get_params(allowed=PARAMS):
+    """Get the params of the transformation from the query string
+
+    The params can be given as query args (?wgender=m&proximity=dense), as a JSON object in the `params` field
+    (?params={"wgender": "m"}), or as a JSON object making the whole query string (?{"wgender": "m"}), which is what
+    requests.post(url, params=json.dumps(params)) sends.
+    """
+    args = request.args
+    try:
+        if 'params' in args:
+            params = json.loads(args['params'])
+        elif len(args) == 1 and next(iter(args)).startswith('{') and not next(iter(args.values())):
+            params = json.loads(next(iter(args)))
+        else:
+            params = args.to_dict()
+    except ValueError:
+        abort(400, 'invalid JSON params')
+    if not isinstance(params, dict):
+        abort(400, 'the params must be a JSON object')
+
+    unknown = set(params).difference(allowed)
+    if unknown:
+        abort(400, 'unknown params: {}'.format(', '.join(sorted(unknown))))
+    return params
 
-    # 3 send the result
-    return send_from_directory('io', 'output.wav', as_attachment=True)
+def normalize_params(params):
+    """Get the params of transform.sh, with their default values, so that the same transformation has the same params"""
+    normalized = dict(DEFAULT_PARAMS)
+    normalized.update((key.replace('_', '-'), str(value)) for key, value in params.items())
+    normalized['anon-pool'] = app.config['ANON_POOL']
+    if 'speaker' in normalized:
+        if not app.config['PROFILES_DIR']:
+            abort(501, 'the speaker profiles are not enabled, see --profiles-dir')
+        if not normalized['speaker']:
+            abort(400, 'empty speaker id')
+    if app.config['SEGMENT_S']:
+        # the stitched result differs from the one of a single run: it is cached apart
+        normalized['segment'] = str(app.config['SEGMENT_S'])
+    return normalized
 
-def upload_audio():
-    source_filepath = 'io/input.wav'
+def get_profile_dir(speaker):
+    """Get the directory of the profile of a speaker, named after a hash of its id so that any id can be used"""
+    return os.path.join(app.config['PROFILES_DIR'], hashlib.sha256(speaker.encode()).hexdigest())
+
+def get_profile_generation(speaker):
+    """Get the number of times the profile of a speaker was deleted, saved next to the profile"""
+    try:
+        with open(get_profile_dir(speaker) + '.generation') as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+
+@app.route("/profiles/<speaker>", methods=["DELETE"])
+def delete_profile(speaker):
+    """Remove the profile of a speaker: its next transformation gets a new pseudo-speaker.
+
+    The generation of the profile is incremented, so that the cached results of the old pseudo-speaker are not sent.
+    """
+    if not app.config['PROFILES_DIR']:
+        abort(404)
+    profile_dir = get_profile_dir(speaker)
+    if not os.path.isdir(profile_dir):
+        abort(404)
+    with _lock:
+        generation_path = profile_dir + '.generation'
+        temp_path = '{}.{}.tmp'.format(generation_path, uuid.uuid4().hex)
+        with open(temp_path, 'w') as f:
+            f.write(str(get_profile_generation(speaker) + 1))
+        os.replace(temp_path, generation_path)
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    return '', 204
+
+def upload_audio(request_dir, filename='input.wav'):
+    """Save the body of the request, by chunks so that a large file is not loaded in memory
+
+    Returns the path to the file and its SHA-256.
+    """
+    source_filepath = os.path.join(request_dir, filename)
+    source = HashingReader(request.stream)
     with open(source_filepath, "wb") as fp:
-        fp.write(request.data)
-    return source_filepath
+        shutil.copyfileobj(source, fp, CHUNK_SIZE)
+    return source_filepath, source.hexdigest()
+
+def get_cache():
+    global _cache
+    if not app.config['CACHE_MAX_MB']:
+        return None
+    with _lock:
+        if _cache is None:
+            _cache = ResultCache(CACHE_DIR, max_size=app.config['CACHE_MAX_MB'] << 20,
+                                 max_age=app.config['CACHE_MAX_AGE_S'])
+        return _cache
+
+def get_deadline():
+    """Get the deadline of the request (see time.monotonic), from its X-Request-Timeout header (in seconds) or the
+    default timeout, or None"""
+    timeouts = [app.config['REQUEST_TIMEOUT_S']]
+    if 'X-Request-Timeout' in request.headers:
+        try:
+            timeouts.append(float(request.headers['X-Request-Timeout']))
+        except ValueError:
+            abort(400, 'invalid X-Request-Timeout header')
+    timeouts = [timeout for timeout in timeouts if timeout > 0]
+    return time.monotonic() + min(timeouts) if timeouts else None
+
+def get_admission():
+    global _admission
+    with _lock:
+        if _admission is None:
+            _admission = AdmissionController(app.config['MAX_RUNNING'], app.config['MAX_WAITING'],
+                                             app.config['CPUS'])
+            QUEUE_DEPTH.set_function(lambda: _admission.nb_waiting, queue='admission')
+            RUNNING_TRANSFORMATIONS.set_function(lambda: _admission.nb_running)
+            USED_CPUS.set_function(lambda: _admission.used_cpus)
+        return _admission
+
+def get_cache_key(digest, params):
+    """Get the key of the cached result of a transformation, see ResultCache.get_key
+
+    With the speaker param, the key includes the generation of the profile of the speaker: the results of a deleted
+    profile are not sent again.
+    """
+    if 'speaker' in params:
+        params = dict(params, **{'profile-generation': get_profile_generation(params['speaker'])})
+    return ResultCache.get_key(digest, params)
+
+def lookup_cache(cache, cache_key):
+    """Open the cached result of a transformation, or return None"""
+    if not cache:
+        return None
+    cached = cache.open(cache_key)
+    CACHE_REQUESTS.inc(result='miss' if cached is None else 'hit')
+    return cached
+
+def get_vpc_command(params, name, timings_filepath=None, nj=None):
+    cmd_vpc = [app.config['TRANSFORM_SCRIPT']]
+    cmd_vpc.extend(['--name', name, '--cleanup', 'true'])
+    if timings_filepath:
+        cmd_vpc.extend(['--timings', os.path.abspath(timings_filepath)])
+    if nj:
+        cmd_vpc.extend(['--nj', str(nj)])
+    if app.config['WORKSPACE']:
+        cmd_vpc.extend(['--workspace', os.path.abspath(app.config['WORKSPACE'])])
+    for key, value in params.items():
+        if key == 'speaker':
+            # the script runs in vpc
+            cmd_vpc.extend(['--profile', os.path.abspath(get_profile_dir(value))])
+        else:
+            cmd_vpc.extend(['--' + key, str(value)])
+    return cmd_vpc
+
+def observe_stages(timings_filepath):
+    """Read the timings of a run of transform.sh and add them to the metrics"""
+    timings = read_timings(timings_filepath)
+    for stage, seconds in timings:
+        STAGE_DURATION.observe(seconds, stage=stage, name=STAGE_NAMES.get(stage, stage))
+    for stage, seconds in read_timings(timings_filepath, cpu=True):
+        STAGE_CPU.observe(seconds, stage=stage, name=STAGE_NAMES.get(stage, stage))
+    return timings
+
+def get_batch_queue():
+    global _batch_queue
+    with _lock:
+        if _batch_queue is None:
+            _batch_queue = BatchQueue(apply_vpc_batch, max_size=app.config['BATCH_SIZE'],
+                                      max_wait=app.config['BATCH_WAIT_MS'] / 1000)
+            QUEUE_DEPTH.set_function(_batch_queue.count_pending, queue='batch')
+        return _batch_queue
+
+def apply_vpc_batch(key, files):
+    """Apply VPC on a batch of audio files with the same params in a single run of transform.sh
+
+    The files are given as (input path, output path) pairs. Each file is anonymized as a different speaker (see
+    --spk-per-utt of transform.sh). Returns the timings of the run, for each file. The files whose request is gone
+    (its deadline was exceeded and its dir removed) are skipped, without failing the other files.
+    """
+    params = json.loads(key)
+    batch_id = uuid.uuid4().hex
+    batch_dir = os.path.join(REQUESTS_DIR, 'batch_' + batch_id)
+    input_dir = os.path.join(batch_dir, 'inputs')
+    output_dir = os.path.join(batch_dir, 'outputs')
+    os.makedirs(input_dir)
+    os.makedirs(output_dir)
+    try:
+        # the utterance ids must be sorted in the same order as the files
+        utt_ids = ['{:04d}_{}'.format(i, batch_id) for i in range(len(files))]
+        for utt_id, (source_filepath, _) in zip(utt_ids, files):
+            if os.path.exists(source_filepath):
+                os.symlink(os.path.abspath(source_filepath), os.path.join(input_dir, utt_id + '.wav'))
+        if not os.listdir(input_dir):
+            return [[]] * len(files)
+
+        timings_filepath = os.path.join(batch_dir, 'timings.txt')
+        # the batches and the jobs wait for a run whatever the wait queue: their number is already bounded
+        with get_admission().admit(bounded=False) as nj:
+            cmd_vpc = get_vpc_command(params, 'batch_' + batch_id, timings_filepath, nj)
+            cmd_vpc.extend(['--spk-per-utt', 'true'])
+            cmd_vpc.extend(['../' + input_dir, '../' + output_dir])
+            run_with_deadline(cmd_vpc)
+
+        for utt_id, (_, result_filepath) in zip(utt_ids, files):
+            output_filepath = os.path.join(output_dir, utt_id + '.wav')
+            if os.path.exists(output_filepath) and os.path.isdir(os.path.dirname(result_filepath)):
+                os.replace(output_filepath, result_filepath)
+        timings = observe_stages(timings_filepath)
+        return [timings] * len(files)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Upload an audio file and queue a job to apply VPC on it. Returns the id of the job."""
+    params = normalize_params(get_params())
+    try:
+        job_id = get_job_manager().submit(json.dumps(params), request.stream)
+    except QueueFull:
+        response = jsonify(error='too many pending jobs, retry later')
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    response = jsonify(id=job_id, status='queued')
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/' + job_id
+    return response
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Get the status of a job (queued, running, done or failed) and its current stage."""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """Send the transformed audio file of a job."""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] != DONE:
+        response = jsonify(job)
+        response.status_code = 409
+        return response
+    return send_file(os.path.abspath(manager.output_path(job_id)), mimetype='audio/wav', as_attachment=True,
+                     download_name='output.wav')
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def delete_job(job_id):
+    """Remove a job which is not running and its result."""
+    if not get_job_manager().delete(job_id):
+        abort(404 if get_job_manager().get(job_id) is None else 409)
+    return '', 204
+
+def get_job_manager():
+    global _job_manager
+    with _lock:
+        if _job_manager is None:
+            _job_manager = JobManager(JOBS_DIR, run_vpc_job, nb_workers=app.config['JOB_WORKERS'],
+                                      max_pending=app.config['JOB_MAX_PENDING'],
+                                      retention=app.config['JOB_RETENTION_S'])
+            QUEUE_DEPTH.set_function(lambda: _job_manager.count(QUEUED, RUNNING), queue='jobs')
+        return _job_manager
+
+def run_vpc_job(job_id, params, input_path, output_path, log_path, report_stage):
+    params = json.loads(params)
+    cache = get_cache()
+    cache_key = get_cache_key(hash_file(input_path), params)
+    cached = lookup_cache(cache, cache_key)
+    if cached is not None:
+        with cached, open(output_path, 'wb') as fp:
+            shutil.copyfileobj(cached, fp, CHUNK_SIZE)
+        report_stage('cached')
+        return
+
+    timings_filepath = os.path.join(os.path.dirname(output_path), 'timings.txt')
+    with get_admission().admit(bounded=False) as nj:
+        cmd_vpc = get_vpc_command(params, 'job_' + job_id, timings_filepath, nj)
+        cmd_vpc.extend(['../' + input_path, '../' + output_path])
+        run_with_stages(cmd_vpc, log_path, report_stage)
+    observe_stages(timings_filepath)
+    if cache:
+        cache.put(cache_key, output_path)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser(description='RESTful service applying the VPC baseline')
+    parser.add_argument('--batch-size', type=int, default=app.config['BATCH_SIZE'],
+                        help='max number of files of concurrent requests converted in a single run (default: 1, no '
+                             'batching)')
+    parser.add_argument('--batch-wait-ms', type=int, default=app.config['BATCH_WAIT_MS'],
+                        help='max time (in ms) a file waits for other files before its batch is converted '
+                             '(default: 200)')
+    parser.add_argument('--job-workers', type=int, default=app.config['JOB_WORKERS'],
+                        help='number of jobs running at the same time (default: 1)')
+    parser.add_argument('--job-max-pending', type=int, default=app.config['JOB_MAX_PENDING'],
+                        help='max number of queued or running jobs, more jobs are refused (default: 16)')
+    parser.add_argument('--job-retention', type=int, default=app.config['JOB_RETENTION_S'],
+                        help='time (in seconds) the jobs and their result are kept after their end (default: 3600)')
+    parser.add_argument('--anon-pool', default=app.config['ANON_POOL'],
+                        help='anonymization pool of the transformation, relative to vpc (default: '
+                             'anon_pool/train_other_500)')
+    parser.add_argument('--cache-max-mb', type=int, default=app.config['CACHE_MAX_MB'],
+                        help='max size (in MB) of the cache of the results, 0 to disable it (default: 1024)')
+    parser.add_argument('--cache-max-age', type=int, default=app.config['CACHE_MAX_AGE_S'],
+                        help='max age (in seconds) of the results in the cache (default: 7 days)')
+    parser.add_argument('--max-running', type=int, default=app.config['MAX_RUNNING'],
+                        help='max number of transformations running at the same time (default: 2)')
+    parser.add_argument('--max-waiting', type=int, default=app.config['MAX_WAITING'],
+                        help='max number of requests waiting for a transformation, more requests are rejected '
+                             '(default: 8)')
+    parser.add_argument('--cpus', type=int, default=app.config['CPUS'],
+                        help='number of CPUs shared by the transformations (default: all the CPUs)')
+    parser.add_argument('--request-timeout', type=float, default=app.config['REQUEST_TIMEOUT_S'],
+                        help='default deadline (in seconds) of the requests to /vpc, 0 for none (default: 0)')
+    parser.add_argument('--voicemask-params',
+                        help='pre-built params of the voicemask method, to enable the /transform/voicemask CPU backend')
+    parser.add_argument('--vtln-params',
+                        help='pre-built params of the vtln method, to enable the /transform/vtln CPU backend')
+    parser.add_argument('--profiles-dir',
+                        help='directory of the profiles of the speakers, to enable the speaker param (e.g. '
+                             'io/profiles)')
+    parser.add_argument('--segment', type=float, default=app.config['SEGMENT_S'],
+                        help='split the input files longer than this (in seconds) into chunks transformed in parallel, '
+                             '0 to disable it (default: 0)')
+    parser.add_argument('--workspace', default=app.config['WORKSPACE'],
+                        help='directory of the intermediate files of the transformations (default: /dev/shm/vpc when '
+                             'it has room for them, else vpc)')
+    parser.add_argument('--transform-script', default=app.config['TRANSFORM_SCRIPT'],
+                        help='script running the transformation, e.g. ./vpc/transform.py to run the independent stages '
+                             'at the same time (default: ./vpc/transform.sh)')
+    args = parser.parse_args()
+    app.config.update(TRANSFORM_SCRIPT=args.transform_script, BATCH_SIZE=args.batch_size,
+                      BATCH_WAIT_MS=args.batch_wait_ms, JOB_WORKERS=args.job_workers,
+                      JOB_MAX_PENDING=args.job_max_pending, JOB_RETENTION_S=args.job_retention,
+                      VOICEMASK_PARAMS=args.voicemask_params, VTLN_PARAMS=args.vtln_params,
+                      ANON_POOL=args.anon_pool, CACHE_MAX_MB=args.cache_max_mb, CACHE_MAX_AGE_S=args.cache_max_age,
+                      MAX_RUNNING=args.max_running, MAX_WAITING=args.max_waiting, CPUS=args.cpus,
+                      REQUEST_TIMEOUT_S=args.request_timeout, PROFILES_DIR=args.profiles_dir,
+                      SEGMENT_S=args.segment, WORKSPACE=args.workspace)
+
+    # the params are loaded at startup, not by the first request
+    for method in METHODS:
+        if app.config[method.upper() + '_PARAMS']:
+            get_backend(method)
 
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,76 @@
+"""Tests of the batches of concurrent requests to /vpc (see --batch-size), with a stub transformation script"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the stub converts the files of a directory (a batch) by appending '-out' to them, slowly, and counts its runs
+STUB_SCRIPT = '''#!/bin/bash
+cd $(dirname $0)
+args=("$@"); n=${#args[@]}; ipath=${args[$((n-2))]}; opath=${args[$((n-1))]}
+echo run >> runs
+sleep 1
+for f in $ipath/*.wav; do (cat $f; echo -n "-out") > $opath/$(basename $f); done
+'''
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        # the service works in its current directory, and runs the script from a directory below it
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        os.makedirs('stub')
+        with open(os.path.join('stub', 'transform.sh'), 'w') as f:
+            f.write(STUB_SCRIPT)
+        os.chmod(os.path.join('stub', 'transform.sh'), stat.S_IRWXU)
+        sys.path.insert(0, SERVICE_DIR)
+        import app
+        self.app = app
+        app.app.config.update(TRANSFORM_SCRIPT='./stub/transform.sh', BATCH_SIZE=2, BATCH_WAIT_MS=500,
+                              CACHE_MAX_MB=0)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        sys.path.remove(SERVICE_DIR)
+
+    def post_concurrently(self, headers):
+        # one request per item of headers, at the same time, with the input b'in<i>'
+        responses = {}
+
+        def post(i):
+            response = self.app.app.test_client().post('/vpc?wgender=f', data=b'in%d' % i, headers=headers[i])
+            responses[i] = (response.status_code, response.get_data())
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(headers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_concurrent_requests_are_converted_in_one_run(self):
+        responses = self.post_concurrently([{}, {}])
+
+        self.assertEqual(responses[0], (200, b'in0-out'))
+        self.assertEqual(responses[1], (200, b'in1-out'))
+        with open(os.path.join('stub', 'runs')) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_deadline_of_one_file_does_not_fail_the_batch(self):
+        responses = self.post_concurrently([{'X-Request-Timeout': '0.2'}, {}])
+
+        self.assertEqual(responses[0][0], 504)
+        self.assertEqual(responses[1], (200, b'in1-out'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests of the speaker profiles (see --profiles-dir) and of the cache of their results, with a stub transformation
+script"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the stub draws a pseudo-speaker when the profile is missing, and sends the pseudo-speaker of the profile
+STUB_SCRIPT = '''#!/bin/bash
+cd $(dirname $0)
+while [ $# -gt 2 ]; do [ "$1" = --profile ] && profile=$2; shift; done
+if [ ! -d $profile ]; then mkdir -p $profile; echo -n $RANDOM$RANDOM > $profile/pseudo; fi
+cat $profile/pseudo > $2
+'''
+
+
+class ProfileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # the service works in its current directory, and runs the script from a directory below it
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        os.makedirs('stub')
+        with open(os.path.join('stub', 'transform.sh'), 'w') as f:
+            f.write(STUB_SCRIPT)
+        os.chmod(os.path.join('stub', 'transform.sh'), stat.S_IRWXU)
+        sys.path.insert(0, SERVICE_DIR)
+        import app
+        self.app = app
+        app.app.config.update(TRANSFORM_SCRIPT='./stub/transform.sh', BATCH_SIZE=1, CACHE_MAX_MB=16,
+                              PROFILES_DIR='profiles')
+        app._cache = None
+
+    def tearDown(self):
+        self.app._cache = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        sys.path.remove(SERVICE_DIR)
+
+    def post(self):
+        response = self.app.app.test_client().post('/vpc?wgender=f&speaker=alice', data=b'in')
+        self.assertEqual(response.status_code, 200)
+        return response.headers['X-Cache'], response.get_data()
+
+    def test_deleted_profile_is_not_sent_from_the_cache(self):
+        cache, pseudo = self.post()
+        self.assertEqual(cache, 'MISS')
+        self.assertEqual(self.post(), ('HIT', pseudo))
+
+        self.assertEqual(self.app.app.test_client().delete('/profiles/alice').status_code, 204)
+        cache, new_pseudo = self.post()
+        self.assertEqual(cache, 'MISS')
+        self.assertNotEqual(new_pseudo, pseudo)
+        self.assertEqual(self.post(), ('HIT', new_pseudo))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 #!python
 import sys
-from os.path import join
+from os.path import exists, join
 from itertools import cycle
 
 import numpy as np
@@ -33,17 +33,21 @@ spks = []
 with open(spk_xvec_file) as f:
     for line in f.read().splitlines():
         spks.append(line.split()[0])
-X = []
-for spk in spks:
-    with open(join(plda_scores_dir, 'affinity_'+spk)) as f:
-        lines = f.read().splitlines()
-        scores = np.array([float(x.split()[2]) for x in lines], dtype='float')
-        X.append(scores[np.newaxis])
-
-X = np.concatenate(X, axis=0)
+matrix_file = join(plda_scores_dir, 'pool_affinity_matrix.npy')
+if exists(matrix_file):
+    # built by pool_affinity.py
+    X = np.load(matrix_file, mmap_mode='r').astype('float')
+else:
+    X = []
+    for spk in spks:
+        with open(join(plda_scores_dir, 'affinity_'+spk)) as f:
+            lines = f.read().splitlines()
+            scores = np.array([float(x.split()[2]) for x in lines], dtype='float')
+            X.append(scores[np.newaxis])
+    X = np.concatenate(X, axis=0)
+    # Save pool affinity matrix for later uses
+    np.save(matrix_file, X.astype(np.float32))
 print("affinity matrix shape: ", X.shape)
-# Save pool affinity matrix for later uses
-joblib.dump(X, join(out_dir, 'pool_affinity_matrix.pkl'))
 
 # Compute Affinity Propagation
 af = AffinityPropagation(affinity='precomputed').fit(X)
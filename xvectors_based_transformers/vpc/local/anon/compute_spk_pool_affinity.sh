@@ -18,7 +18,10 @@ fake_trials=${fake_trials_dir}/trial_${src_spk}
 # Creating the fake trials file
 cut -d' ' -f 1 ${pool_xvectors_dir}/spk_xvector.scp | awk -v a="${src_spk}" '{print a,$1}'  - > ${fake_trials}
 
-$train_cmd exp/scores/log/libritts_pool_scoring.log \
+# one log per scores file, so that several runs can score at the same time
+scoring_log=$(dirname ${trial_scores})/log/scoring_$(basename ${trial_scores}).log
+
+$train_cmd ${scoring_log} \
   ivector-plda-scoring --normalize-length=true \
     "ivector-copy-plda --smoothing=0.0 $plda_dir/plda - |" \
     "ark:ivector-subtract-global-mean $plda_dir/mean.vec scp:${src_xvectors_dir}/spk_xvector.scp ark:- | transform-vec $plda_dir/transform.mat ark:- ark:- | ivector-normalize-length ark:- ark:- |" \
@@ -140,7 +140,6 @@ print("Read ", c, "src xvectors")
 # Read clustering info
 if proximity in ["dense", "sparse"]:
     print("Reading clustering info.")
-    pool_affinity_matrix = joblib.load(join(cluster_dir, 'pool_affinity_matrix.pkl'))
     cluster_center_idx = joblib.load(join(cluster_dir, 'cc_idx.pkl'))
     pool_cluster_labels = joblib.load(join(cluster_dir, 'labels.pkl'))
     cluster_center_drank = joblib.load(join(cluster_dir, 'drank.pkl'))
@@ -41,7 +41,7 @@ pseudo_xvecs_dir=${src_xvec_dir}/pseudo_xvecs
 cluster_dir=${pool_xvec_dir}/cluster
 
 rm -rf ${affinity_scores_dir} ${pseudo_xvecs_dir}
-mkdir -p ${affinity_scores_dir} ${pseudo_xvecs_dir} ${cluster_dir} ${src_affinity_dir}
+mkdir -p ${affinity_scores_dir} ${pseudo_xvecs_dir} ${src_affinity_dir}
 
 # Iterate over all the source speakers and generate 
 # affinity distribution over anonymization pool
@@ -55,31 +55,33 @@ if [ $stage -le 0 ]; then
 	    ${affinity_scores_dir} || exit 1;
   elif [ "$distance" = "plda" ]; then
     echo "Computing PLDA affinity scores of each source speaker to each pool speaker."
-    cut -d\  -f 1 ${src_spk2gender} | while read s; do
-      #echo "Speaker: $s"
-      local/anon/compute_spk_pool_affinity.sh ${plda_dir} ${src_xvec_dir} ${pool_xvec_dir} \
-	   "$s" "${affinity_scores_dir}/affinity_${s}" || exit 1;
-    done
+    # all the source speakers at once (see plda.py)
+    python local/anon/plda.py ${plda_dir} ${src_xvec_dir} ${pool_xvec_dir} ${affinity_scores_dir} || exit 1;
 
     if [ "$proximity" = "dense" ] || [ "$proximity" = "sparse" ]; then
       echo "Computing PLDA affinity scores of each source speaker to each source speaker."
-      cut -d\  -f 1 ${src_spk2gender} | while read s; do
-      #echo "Speaker: $s"
-        local/anon/compute_spk_pool_affinity.sh ${plda_dir} ${src_xvec_dir} ${src_xvec_dir} \
-	   "$s" "${src_affinity_dir}/affinity_${s}" || exit 1;
-      done
+      python local/anon/plda.py ${plda_dir} ${src_xvec_dir} ${src_xvec_dir} ${src_affinity_dir} || exit 1;
 
       # Computing pairwise PLDA need not be calculated again
+      # (the pool is only read once the clustering is done: it can be read-only or shared; the lock keeps concurrent
+      # runs from computing it at the same time)
       expo=${cluster_dir}
       if [ ! -f $expo/.done-cluster ]; then
-        echo "Computing PLDA affinity scores of each pool speaker to each pool speaker.This is to create the pairwise score matrix for clustering."
-        cut -d\  -f 1 ${pool_spk2gender} | while read s; do
-        #echo "Speaker: $s"
-          local/anon/compute_spk_pool_affinity.sh ${plda_dir} ${pool_xvec_dir} ${pool_xvec_dir} \
-	     "$s" "${cluster_dir}/affinity_${s}" || exit 1;
-        done
-        python local/anon/affinity_propagation.py ${pool_xvec_dir} ${pool_spk2gender} ${cluster_dir} ${cluster_dir}
-        touch $expo/.done-cluster
+        if ! mkdir -p ${cluster_dir} 2>/dev/null || [ ! -w ${cluster_dir} ]; then
+          echo "$0: the pool speakers are not clustered yet and ${cluster_dir} can't be written: run once with a writable pool"
+          exit 1;
+        fi
+        (
+        flock 9
+        if [ ! -f $expo/.done-cluster ]; then
+          echo "Computing PLDA affinity scores of each pool speaker to each pool speaker.This is to create the pairwise score matrix for clustering."
+          # in blocks, straight to a matrix file (see pool_affinity.py)
+          python local/anon/pool_affinity.py --distance plda --plda-dir ${plda_dir} ${pool_xvec_dir} \
+	         ${cluster_dir}/pool_affinity_matrix.npy || exit 1;
+          python local/anon/affinity_propagation.py ${pool_xvec_dir} ${pool_spk2gender} ${cluster_dir} ${cluster_dir} || exit 1;
+          touch $expo/.done-cluster
+        fi
+        ) 9>${cluster_dir}/.lock || exit 1;
       fi
     fi
   fi
@@ -0,0 +1,132 @@
+"""Score x-vectors with the PLDA model of a Kaldi x-vector extractor, in NumPy
+
+Computes the same scores as the Kaldi pipeline of compute_spk_pool_affinity.sh (ivector-subtract-global-mean,
+transform-vec, ivector-normalize-length, then ivector-plda-scoring --normalize-length=true with one utterance per
+x-vector), for all the pairs of x-vectors at once: the model is read once, and all the source speakers are scored
+against all the pool speakers as matrix products, in place of a Kaldi pipeline per source speaker.
+
+Usage:
+  plda.py <plda-dir> <src-xvec-dir> <pool-xvec-dir> <scores-dir>
+
+Writes the scores of each source speaker against the pool speakers in <scores-dir>/affinity_<spk>, as
+`<spk> <pool-spk> <score>` lines (as ivector-plda-scoring).
+"""
+
+import os
+import struct
+import sys
+from os.path import join
+
+import numpy as np
+from kaldiio import ReadHelper, load_mat
+from kaldiio.matio import read_token
+
+
+def read_kaldi_array(fd):
+    """Read a vector or a matrix of a Kaldi binary object (after its header)"""
+    kind = read_token(fd)
+    if kind not in ('FV', 'DV', 'FM', 'DM'):
+        raise ValueError('unexpected Kaldi type: {}'.format(kind))
+    dtype = '<f4' if kind[0] == 'F' else '<f8'
+    shape = []
+    for _ in range(2 if kind[1] == 'M' else 1):
+        size, value = struct.unpack('<bi', fd.read(5))
+        if size != 4:
+            raise ValueError('unexpected int size: {}'.format(size))
+        shape.append(value)
+    count = int(np.prod(shape))
+    data = np.frombuffer(fd.read(count * np.dtype(dtype).itemsize), dtype=dtype, count=count)
+    return data.reshape(shape).astype(np.float64)
+
+
+def read_vectors(scp_file):
+    """Read the vectors of a scp file: (keys, matrix of the vectors), in the order of the file"""
+    keys, vectors = [], []
+    with ReadHelper('scp:' + scp_file) as reader:
+        for key, vector in reader:
+            keys.append(key)
+            vectors.append(vector)
+    return keys, np.array(vectors, dtype=np.float64)
+
+
+class Plda:
+    """PLDA model of a Kaldi x-vector extractor, with the preprocessing of its x-vectors
+
+    Parameters
+    ----------
+    plda_dir : str
+        directory of the x-vector extractor, with the files `plda` (binary), `mean.vec` and `transform.mat`
+    """
+
+    def __init__(self, plda_dir):
+        with open(join(plda_dir, 'plda'), 'rb') as fd:
+            if fd.read(2) != b'\0B' or read_token(fd) != '<Plda>':
+                raise ValueError('not a binary Kaldi PLDA model: ' + join(plda_dir, 'plda'))
+            self.mean = read_kaldi_array(fd)
+            self.transform = read_kaldi_array(fd)
+            self.psi = read_kaldi_array(fd)
+        self.global_mean = np.asarray(load_mat(join(plda_dir, 'mean.vec')), dtype=np.float64)
+        self.lda = np.asarray(load_mat(join(plda_dir, 'transform.mat')), dtype=np.float64)
+
+    def preprocess(self, xvectors):
+        """Center, project (LDA) and normalize the length of x-vectors (one per row), as the Kaldi pipeline"""
+        xvectors = xvectors - self.global_mean
+        if self.lda.shape[1] == xvectors.shape[1] + 1:
+            # affine transform: the last column is the offset
+            xvectors = xvectors @ self.lda[:, :-1].T + self.lda[:, -1]
+        else:
+            xvectors = xvectors @ self.lda.T
+        return xvectors * (np.sqrt(xvectors.shape[1]) / np.linalg.norm(xvectors, axis=1, keepdims=True))
+
+    def transform_xvectors(self, xvectors):
+        """Project preprocessed x-vectors in the space of the PLDA model, where the within-class covariance is the
+        identity and the between-class covariance is diag(psi), and normalize their length (one utterance each)"""
+        transformed = (xvectors - self.mean) @ self.transform.T
+        inv_covar = 1. / (self.psi + 1.)
+        factors = np.sqrt(self.psi.shape[0] / (transformed ** 2 @ inv_covar))
+        return transformed * factors[:, np.newaxis]
+
+    def prepare(self, xvectors):
+        """Preprocess and project x-vectors, for llr"""
+        return self.transform_xvectors(self.preprocess(xvectors))
+
+    def score(self, train, test):
+        """Log-likelihood ratios of the pairs of x-vectors (same speaker vs different speakers), as
+        ivector-plda-scoring: a matrix with a row per train x-vector and a column per test x-vector"""
+        return self.llr(self.prepare(train), self.prepare(test))
+
+    def llr(self, train, test):
+        """Log-likelihood ratios of the pairs of prepared x-vectors (see prepare), a row per train x-vector"""
+        # given the class of the train x-vector: the test x-vector has the mean psi / (psi + 1) * train and the
+        # variance 1 + psi / (psi + 1); without class: the mean 0 and the variance psi + 1
+        ratio = self.psi / (self.psi + 1.)
+        inv_var_given = 1. / (1. + ratio)
+        inv_var_without = 1. / (self.psi + 1.)
+        constant = 0.5 * (np.sum(np.log(self.psi + 1.)) - np.sum(np.log(1. + ratio)))
+        # the squared distances to the means, expanded as matrix products
+        sq_dist_given = ((train ** 2) @ (ratio ** 2 * inv_var_given))[:, np.newaxis] \
+            - 2. * (train * (ratio * inv_var_given)) @ test.T \
+            + ((test ** 2) @ inv_var_given)[np.newaxis, :]
+        sq_dist_without = (test ** 2) @ inv_var_without
+        return constant - 0.5 * sq_dist_given + 0.5 * sq_dist_without[np.newaxis, :]
+
+
+def write_scores(scores_dir, src_spks, pool_spks, scores):
+    """Write the scores of each source speaker in <scores-dir>/affinity_<spk>"""
+    os.makedirs(scores_dir, exist_ok=True)
+    for src_spk, spk_scores in zip(src_spks, scores):
+        with open(join(scores_dir, 'affinity_' + src_spk), 'w') as f:
+            f.write(''.join('{} {} {:g}\n'.format(src_spk, pool_spk, score)
+                            for pool_spk, score in zip(pool_spks, spk_scores)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.exit(__doc__)
+    plda_dir, src_xvec_dir, pool_xvec_dir, scores_dir = sys.argv[1:]
+    plda = Plda(plda_dir)
+    src_spks, src_xvectors = read_vectors(join(src_xvec_dir, 'spk_xvector.scp'))
+    pool_spks, pool_xvectors = read_vectors(join(pool_xvec_dir, 'spk_xvector.scp'))
+    print("Computing the PLDA scores of {} source speakers against {} speakers".format(len(src_spks),
+                                                                                       len(pool_spks)))
+    write_scores(scores_dir, src_spks, pool_spks, plda.score(src_xvectors, pool_xvectors))
@@ -0,0 +1,87 @@
+"""Build the affinity matrix of the speakers of an anonymization pool, for their clustering (affinity_propagation.py)
+
+The matrix of the scores of each pool speaker against each pool speaker (PLDA, as plda.py, or cosine, as
+compute_spk_pool_cosine.py) is symmetric: only its upper blocks are computed, by threads, each block being the product
+of a few hundred x-vectors by a few hundred x-vectors, and written with its transpose straight to a float32 .npy file
+mapped in memory. The speakers are in the order of <pool-xvec-dir>/spk_xvector.scp.
+
+Usage:
+  pool_affinity.py [--distance (plda|cosine)] [--plda-dir <dir>] [--block-size <nb>] [--nj <nb>] <pool-xvec-dir> \\
+                   <output-npy>
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import numpy as np
+
+from plda import Plda, read_vectors
+
+
+def build(xvectors, score, output_path, block_size, nj):
+    """Write the matrix of the scores of all the pairs of x-vectors to a .npy file
+
+    Parameters
+    ----------
+    xvectors : numpy.ndarray
+        the x-vectors, one per row, as expected by score
+    score : callable
+        function of two blocks of x-vectors, returning the matrix of their scores (symmetric)
+    output_path : str
+        path to the .npy file, written aside and renamed at the end
+    block_size : int
+        number of x-vectors of the blocks
+    nj : int
+        number of threads (the matrix products release the GIL)
+    """
+    size = xvectors.shape[0]
+    temp_path = output_path + '.tmp.npy'
+    matrix = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=(size, size))
+    starts = range(0, size, block_size)
+
+    def build_block(rows, cols):
+        block = score(xvectors[rows], xvectors[cols]).astype(np.float32)
+        matrix[rows, cols] = block
+        if rows != cols:
+            matrix[cols, rows] = block.T
+
+    with ThreadPoolExecutor(max_workers=nj) as executor:
+        blocks = [executor.submit(build_block, slice(i, i + block_size), slice(j, j + block_size))
+                  for i in starts for j in starts if j >= i]
+        for block in blocks:
+            block.result()
+    matrix.flush()
+    os.replace(temp_path, output_path)
+
+
+def cosine_scores(xvectors1, xvectors2):
+    """Opposite of the cosine distances of normalized x-vectors: the higher, the closer"""
+    return xvectors1 @ xvectors2.T - 1.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the affinity matrix of the speakers of a pool')
+    parser.add_argument('--distance', choices=['plda', 'cosine'], default='plda')
+    parser.add_argument('--plda-dir', help='directory of the PLDA model (see plda.py), for --distance plda')
+    parser.add_argument('--block-size', type=int, default=512, help='number of x-vectors of the blocks')
+    parser.add_argument('--nj', type=int, default=os.cpu_count() or 1, help='number of threads')
+    parser.add_argument('pool_xvec_dir')
+    parser.add_argument('output_npy')
+    args = parser.parse_args()
+
+    spks, xvectors = read_vectors(join(args.pool_xvec_dir, 'spk_xvector.scp'))
+    if args.distance == 'plda':
+        if not args.plda_dir:
+            parser.error('--plda-dir is required with --distance plda')
+        plda = Plda(args.plda_dir)
+        xvectors, score = plda.prepare(xvectors), plda.llr
+    else:
+        xvectors, score = xvectors / np.linalg.norm(xvectors, axis=1, keepdims=True), cosine_scores
+    print("Computing the {} affinity matrix of {} pool speakers".format(args.distance, len(spks)))
+    build(xvectors, score, args.output_npy, args.block_size, args.nj)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Save or load the profile of a speaker, so that a returning speaker skips the stages a.0 and a.1 of transform.sh
+
+A profile keeps the x-vector of the speaker, its pseudo-x-vector, the gender of the pseudo-speaker and the pool
+speakers of its pitch conversion (utt2pool), with the params they were computed with. It is only used with the same
+params.
+
+Usage:
+  speaker_profile.py save <profile-dir> <src-data-dir> <src-xvec-dir> <params>
+  speaker_profile.py load <profile-dir> <src-data-dir> <src-xvec-dir> <params>
+
+load exits with the status 2 if there is no profile for these params.
+"""
+
+import json
+import os
+import shutil
+import sys
+import uuid
+from os.path import exists, join
+
+import numpy as np
+from kaldiio import ReadHelper, WriteHelper
+
+NO_PROFILE = 2
+
+
+def read_vectors(scp_file):
+    with ReadHelper('scp:' + scp_file) as reader:
+        return {key: vec for key, vec in reader}
+
+
+def read_spk2utt(src_data):
+    with open(join(src_data, 'spk2utt')) as f:
+        return {sp[0]: sp[1:] for sp in (line.split() for line in f.read().splitlines())}
+
+
+def save(profile_dir, src_data, src_xvec_dir, params):
+    spk2utt = read_spk2utt(src_data)
+    if len(spk2utt) != 1:
+        sys.exit('a profile is for a single speaker, got {} speakers'.format(len(spk2utt)))
+    spk, utts = next(iter(spk2utt.items()))
+    pseudo_xvecs_dir = join(src_xvec_dir, 'pseudo_xvecs')
+
+    # the pseudo-x-vector and the pool speakers are the same for all the utterances of the speaker (rand-level spk)
+    with open(join(pseudo_xvecs_dir, 'spk2gender')) as f:
+        gender = dict(line.split() for line in f.read().splitlines())[spk]
+    pool_spks = []
+    utt2pool_file = join(pseudo_xvecs_dir, 'utt2pool')
+    if exists(utt2pool_file):
+        with open(utt2pool_file) as f:
+            pool_spks = f.readline().split()[1:]
+
+    # the profile is written aside, then renamed: a concurrent run sees a complete profile or none
+    temp_dir = '{}.{}.tmp'.format(profile_dir.rstrip('/'), uuid.uuid4().hex)
+    os.makedirs(temp_dir)
+    try:
+        np.save(join(temp_dir, 'xvector.npy'), read_vectors(join(src_xvec_dir, 'spk_xvector.scp'))[spk])
+        np.save(join(temp_dir, 'pseudo_xvector.npy'),
+                read_vectors(join(pseudo_xvecs_dir, 'pseudo_xvector.scp'))[utts[0]])
+        with open(join(temp_dir, 'profile.json'), 'w') as f:
+            json.dump({'params': params, 'gender': gender, 'pool_spks': pool_spks}, f)
+        if exists(profile_dir):
+            # computed again with other params
+            shutil.rmtree(profile_dir, ignore_errors=True)
+        try:
+            os.rename(temp_dir, profile_dir)
+        except OSError:
+            # saved by a concurrent run
+            pass
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print("Saved the profile of " + spk + " to " + profile_dir)
+
+
+def load(profile_dir, src_data, src_xvec_dir, params):
+    try:
+        with open(join(profile_dir, 'profile.json')) as f:
+            profile = json.load(f)
+        pseudo_xvec = np.load(join(profile_dir, 'pseudo_xvector.npy'))
+    except (OSError, ValueError):
+        print("No profile in " + profile_dir)
+        sys.exit(NO_PROFILE)
+    if profile['params'] != params:
+        print("The profile in " + profile_dir + " was computed with other params")
+        sys.exit(NO_PROFILE)
+
+    # the files written by make_pseudospeaker.sh, for the utterances of this run
+    pseudo_xvecs_dir = join(src_xvec_dir, 'pseudo_xvecs')
+    shutil.rmtree(pseudo_xvecs_dir, ignore_errors=True)
+    os.makedirs(pseudo_xvecs_dir)
+    spk2utt = read_spk2utt(src_data)
+    utts = sorted(utt for spk_utts in spk2utt.values() for utt in spk_utts)
+    ark_scp_output = 'ark,scp:{}/{}.ark,{}/{}.scp'.format(pseudo_xvecs_dir, 'pseudo_xvector',
+                                                          pseudo_xvecs_dir, 'pseudo_xvector')
+    with WriteHelper(ark_scp_output) as writer:
+        for utt in utts:
+            writer(utt, pseudo_xvec)
+    with open(join(pseudo_xvecs_dir, 'spk2gender'), 'w') as f:
+        f.write(''.join('{} {}\n'.format(spk, profile['gender']) for spk in sorted(spk2utt)))
+    if profile['pool_spks']:
+        with open(join(pseudo_xvecs_dir, 'utt2pool'), 'w') as f:
+            f.write(''.join('{} {}\n'.format(utt, ' '.join(profile['pool_spks'])) for utt in utts))
+    print("Loaded the profile from " + profile_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 6 or sys.argv[1] not in ('save', 'load'):
+        sys.exit(__doc__)
+    command, profile_dir, src_data, src_xvec_dir, params = sys.argv[1:]
+    params = dict(param.split('=', 1) for param in params.split(','))
+    if command == 'save':
+        save(profile_dir, src_data, src_xvec_dir, params)
+    else:
+        load(profile_dir, src_data, src_xvec_dir, params)
@@ -15,6 +15,7 @@ use_gpu=yes
 iv_root=exp/nnet3_cleaned
 model_dir=exp/chain_cleaned/tdnn_1d_sp
 md_name=prefinal-l.raw
+data_root=data
 cmvn_op='--norm-means=false --norm-vars=false'
 
 . parse_options.sh
@@ -27,7 +28,7 @@ for dset in $dsets; do
   expo=$ppg_dir
   mark=$expo/.done
   if [ ! -f $mark ]; then
-    data=data/${dset}_hires
+    data=${data_root}/${dset}_hires
     for name in $data/feats.scp $model_dir/$md_name; do
       [ ! -f $name ] && echo "File $name does not exist" && exit 1
     done
@@ -9,6 +9,8 @@
 
 nj=32
 stage=0
+data_root=data
+ivectors_dir=
 
 . utils/parse_options.sh
 
@@ -18,6 +20,8 @@ if [ $# != 3 ]; then
   echo "Options"
   echo "   --nj=40             # Number of CPUs to use for feature extraction"
   echo "   --stage=0           # Extraction stage"
+  echo "   --data-root=data    # Directory of the data dirs"
+  echo "   --ivectors-dir=     # Directory of the online i-vectors (default: the nnet3_cleaned dir of the model)"
   exit 1;
 fi
 
@@ -25,11 +29,11 @@ data=$1
 ppg_model=$2
 ppg_dir=$3
 
-original_data_dir=data/${data}
-data_dir=data/${data}_hires
+original_data_dir=${data_root}/${data}
+data_dir=${data_root}/${data}_hires
 
 ivec_extractor=${ppg_model}/nnet3_cleaned/extractor
-ivec_data_dir=${ppg_model}/nnet3_cleaned/ivectors_${data}_hires
+ivec_data_dir=${ivectors_dir:-${ppg_model}/nnet3_cleaned}/ivectors_${data}_hires
 
 model_dir=${ppg_model}/chain_cleaned/tdnn_1d_sp
 
@@ -48,6 +52,6 @@ fi
 if [ $stage -le 1 ]; then
     # Keeping nj to 1 due to GPU memory issues
     local/featex/extract_bn.sh --cmd "$train_cmd" --nj 1 \
-	--iv-root ${ivec_data_dir} --model-dir ${model_dir} \
+	--iv-root ${ivec_data_dir} --model-dir ${model_dir} --data-root ${data_root} \
        	${data} ${ppg_dir} || exit 1;
 fi
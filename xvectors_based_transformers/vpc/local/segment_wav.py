@@ -0,0 +1,82 @@
+"""Split a long wav file into utterance-sized chunks, cut in its quietest parts
+
+Each chunk is cut at the frame of lowest energy between `--min-length` and `--max-length` seconds after its start,
+so that the cuts fall in pauses when there are some. The chunks overlap by `--overlap` seconds, for the crossfades of
+stitch_wav.py.
+
+The chunks are saved as `<output-dir>/<id>-<index>.wav` (id: name of the input file), and their position in the input
+file in `<output-dir>/segments`, as Kaldi segments: `<chunk-id> <id> <start> <end>` (in seconds).
+
+Usage:
+  segment_wav.py [--max-length <s>] [--min-length <s>] [--overlap <s>] <input-wav> <output-dir>
+"""
+
+import argparse
+import os
+
+import numpy as np
+from scipy.io import wavfile
+
+FRAME_LENGTH = 0.025
+FRAME_SHIFT = 0.010
+
+
+def frame_energies(signal, fs):
+    """Get the log energy of the frames of a signal (FRAME_LENGTH long, every FRAME_SHIFT)"""
+    frame_length = int(FRAME_LENGTH * fs)
+    frame_shift = int(FRAME_SHIFT * fs)
+    nb_frames = max(1, 1 + (len(signal) - frame_length) // frame_shift)
+    # the energy of a frame is a difference of the cumulative sum of the squared samples
+    cumulative = np.concatenate([[0.], np.cumsum(signal.astype(np.float64) ** 2)])
+    starts = np.arange(nb_frames) * frame_shift
+    ends = np.minimum(starts + frame_length, len(signal))
+    return np.log(cumulative[ends] - cumulative[starts] + 1e-10)
+
+
+def find_cuts(energies, nb_samples, fs, max_length, min_length):
+    """Get the samples where the signal is cut: the start of the signal, the cuts and its end"""
+    frame_shift = int(FRAME_SHIFT * fs)
+    center = int(FRAME_LENGTH * fs) // 2
+    cuts = [0]
+    while nb_samples - cuts[-1] > max_length * fs:
+        # the quietest frame between min_length and max_length after the last cut
+        first = (cuts[-1] + int(min_length * fs)) // frame_shift
+        last = min((cuts[-1] + int(max_length * fs) - center) // frame_shift, len(energies) - 1)
+        if last <= first:
+            cuts.append(cuts[-1] + int(max_length * fs))
+            continue
+        cuts.append(int(np.argmin(energies[first:last + 1]) + first) * frame_shift + center)
+    cuts.append(nb_samples)
+    return cuts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split a long wav file into chunks, cut in its quietest parts')
+    parser.add_argument('--max-length', type=float, default=10., help='max length of the chunks (in seconds)')
+    parser.add_argument('--min-length', type=float, default=None,
+                        help='min length of the chunks, but the last one (in seconds, default: max-length / 2)')
+    parser.add_argument('--overlap', type=float, default=0.05,
+                        help='overlap between the chunks, for their crossfades (in seconds)')
+    parser.add_argument('input_wav')
+    parser.add_argument('output_dir')
+    args = parser.parse_args()
+    min_length = args.max_length / 2 if args.min_length is None else args.min_length
+
+    fs, signal = wavfile.read(args.input_wav)
+    utt_id = os.path.splitext(os.path.basename(args.input_wav))[0]
+    cuts = find_cuts(frame_energies(signal, fs), len(signal), fs, args.max_length, min_length)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    half_overlap = int(args.overlap * fs) // 2
+    with open(os.path.join(args.output_dir, 'segments'), 'w') as f:
+        for i, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+            start = max(start - half_overlap, 0)
+            end = min(end + half_overlap, len(signal))
+            chunk_id = '{}-{:04d}'.format(utt_id, i)
+            wavfile.write(os.path.join(args.output_dir, chunk_id + '.wav'), fs, signal[start:end])
+            f.write('{} {} {:.4f} {:.4f}\n'.format(chunk_id, utt_id, start / fs, end / fs))
+    print("Split {} into {} chunks".format(args.input_wav, len(cuts) - 1))
+
+
+if __name__ == '__main__':
+    main()
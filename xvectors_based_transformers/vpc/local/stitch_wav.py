@@ -0,0 +1,69 @@
+"""Stitch the transformed chunks of a wav file split by segment_wav.py back into one file
+
+Each chunk is put at its position in the segments file, and the overlapping parts of consecutive chunks are
+crossfaded linearly. The transformed chunks can be a few samples longer or shorter than the input ones (the frames of
+the synthesis): they are cut or padded to the length of their segment.
+
+Usage:
+  stitch_wav.py <segments> <chunks-dir> <output-wav>
+"""
+
+import argparse
+import os
+
+import numpy as np
+from scipy.io import wavfile
+
+
+def read_segments(path):
+    """Read a segments file: list of (chunk id, start, end), sorted by start"""
+    segments = []
+    with open(path) as f:
+        for line in f:
+            chunk_id, _, start, end = line.split()
+            segments.append((chunk_id, float(start), float(end)))
+    return sorted(segments, key=lambda segment: segment[1])
+
+
+def stitch(segments, chunks_dir):
+    """Get the signal made of the chunks (float samples), its sampling frequency and the sample type of the chunks"""
+    output = None
+    fs = dtype = None
+    previous_end = 0
+    for chunk_id, start, end in segments:
+        chunk_fs, chunk = wavfile.read(os.path.join(chunks_dir, chunk_id + '.wav'))
+        if fs is None:
+            fs, dtype = chunk_fs, chunk.dtype
+            output = np.zeros(int(round(segments[-1][2] * fs)))
+        start, end = int(round(start * fs)), int(round(end * fs))
+        chunk = np.pad(chunk.astype(np.float64), (0, max(0, end - start - len(chunk))))[:end - start]
+
+        # linear crossfade over the overlap with the previous chunk
+        overlap = max(0, min(previous_end - start, end - start))
+        if overlap:
+            fade_in = np.linspace(0., 1., overlap + 2)[1:-1]
+            output[start:start + overlap] *= 1. - fade_in
+            chunk[:overlap] *= fade_in
+        output[start:end] += chunk
+        previous_end = end
+    return output, fs, dtype
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stitch the transformed chunks of a wav file into one file')
+    parser.add_argument('segments')
+    parser.add_argument('chunks_dir')
+    parser.add_argument('output_wav')
+    args = parser.parse_args()
+
+    segments = read_segments(args.segments)
+    output, fs, dtype = stitch(segments, args.chunks_dir)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        output = np.clip(np.round(output), info.min, info.max)
+    wavfile.write(args.output_wav, fs, output.astype(dtype))
+    print("Stitched {} chunks into {}".format(len(segments), args.output_wav))
+
+
+if __name__ == '__main__':
+    main()
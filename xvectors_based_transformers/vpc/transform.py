@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Run the stages of transform.sh as a graph, the independent stages at the same time
+
+transform.sh runs its stages one after the other. Here each stage declares the stages whose outputs it reads, and
+runs (with `transform.sh --stages <stage>`) as soon as they have ended: the pseudo-speaker generation (a.1, PLDA
+scoring against the pool), the pitch extraction (a.2) and the PPG extraction (a.3) run at the same time. The stages
+work in the same data dirs as a sequential run, so the Kaldi scripts are unchanged.
+
+The CPUs (--nj, default: all the CPUs) are shared between the stages running at the same time: a stage which doesn't
+use parallel jobs counts for one CPU, the other ones share the rest. The wall and CPU time of each stage are written
+in the --timings file, as with transform.sh.
+
+Usage: same as transform.sh, e.g.
+  transform.py --nj 8 --timings timings.txt --wgender m ../io/inputs/e0003.wav ../io/outputs/
+"""
+
+import collections
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transform.sh')
+
+Stage = collections.namedtuple('Stage', ['name', 'after', 'parallel'])
+
+# the stages of transform.sh, the stages whose outputs they read and whether they run parallel jobs (--nj)
+STAGES = [
+    Stage('setup', (), False),
+    # a.0 rewrites the files of the data dir (utils/fix_data_dir.sh): the stages reading it wait for it
+    Stage('a.0', ('setup',), True),
+    Stage('a.1', ('a.0',), False),
+    Stage('a.2', ('a.0',), True),
+    Stage('a.3', ('a.0',), True),
+    Stage('a.4', ('a.1', 'a.2', 'a.3'), False),
+    Stage('a.5', ('a.4',), False),
+    Stage('a.6', ('a.5',), False),
+    Stage('a.7', ('a.6',), False),
+    Stage('copy', ('a.6',), False),
+]
+
+
+class Terminated(Exception):
+    """Raised when the runner gets a SIGTERM"""
+
+
+def parse_args(argv):
+    """Split the args of transform.sh into its options (a dict, all the options have a value) and its positional args"""
+    options = collections.OrderedDict()
+    i = 0
+    while i + 1 < len(argv) and argv[i].startswith('--'):
+        options[argv[i]] = argv[i + 1]
+        i += 2
+    return options, argv[i:]
+
+
+def share_cpus(stages, nb_cpus):
+    """Get the number of jobs of the stages starting at the same time, from the number of free CPUs"""
+    parallel = [stage.name for stage in stages if stage.parallel]
+    nb_jobs = {stage.name: 1 for stage in stages}
+    shared = max(nb_cpus - (len(stages) - len(parallel)), len(parallel))
+    for i, name in enumerate(parallel):
+        nb_jobs[name] = shared // len(parallel) + (i < shared % len(parallel))
+    return nb_jobs
+
+
+def get_command(options, args, stage, nj):
+    """Get the command running a stage of transform.sh"""
+    cmd = [SCRIPT]
+    for option, value in options.items():
+        cmd.extend([option, value])
+    cmd.extend(['--nj', str(nj), '--stages', stage])
+    return cmd + args
+
+
+def run(options, args, nb_cpus, stages):
+    """Run the stages, each one when the stages it depends on have ended
+
+    Returns
+    -------
+    bool
+        True if all the stages succeeded
+    """
+    pending = [stage for stage in STAGES if stage.name in stages]
+    done = set()
+    running = {}
+    ended = queue.Queue()
+    failed = False
+
+    def wait(name, process):
+        ended.put((name, process.wait()))
+
+    try:
+        while pending or running:
+            ready = [stage for stage in pending
+                     if all(name in done or name not in stages for name in stage.after)]
+            if ready and not failed:
+                nb_jobs = share_cpus(ready, nb_cpus - sum(nj for _, nj in running.values()))
+                for stage in ready:
+                    pending.remove(stage)
+                    # each stage runs in its own process group, to be stopped with the jobs it started
+                    process = subprocess.Popen(get_command(options, args, stage.name, nb_jobs[stage.name]),
+                                               start_new_session=True)
+                    running[stage.name] = (process, nb_jobs[stage.name])
+                    threading.Thread(target=wait, args=(stage.name, process), daemon=True).start()
+            if not running:
+                break
+            name, returncode = ended.get()
+            del running[name]
+            if returncode and not failed:
+                print('{}: stage {} failed with the status {}'.format(sys.argv[0], name, returncode), file=sys.stderr)
+                failed = True
+                # the other stages are stopped
+                for process, _ in running.values():
+                    stop(process)
+            elif not returncode:
+                done.add(name)
+    finally:
+        for process, _ in running.values():
+            stop(process)
+            process.wait()
+    return not failed
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def main(argv):
+    options, args = parse_args(argv)
+    if len(args) != 2 or '--wgender' not in options:
+        # the other usages (e.g. --help) are left to transform.sh
+        return subprocess.call([SCRIPT] + argv)
+    nb_cpus = int(options.pop('--nj', 0)) or os.cpu_count() or 1
+    stages = set(options.pop('--stages').split(',')) if '--stages' in options else {stage.name for stage in STAGES}
+    # the data of the run is removed once, when all the stages have ended (see --cleanup of transform.sh)
+    cleanup = options.pop('--cleanup', 'tmpfs')
+
+    def terminate(*_):
+        raise Terminated()
+
+    signal.signal(signal.SIGTERM, terminate)
+    succeeded = False
+    try:
+        succeeded = run(options, args, nb_cpus, stages)
+    except Terminated:
+        pass
+    finally:
+        if cleanup != 'false':
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            subprocess.call(get_command(dict(options, **{'--cleanup': cleanup}), args, 'none', 1))
+    return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -33,6 +33,16 @@ cross_gender=same
 distance=plda
 proximity=dense
 pseudo_xvec_rand_level=spk
+rand_seed=20
+name=
+cleanup=
+spk_per_utt=false
+timings=
+nj=
+profile=
+stages=
+segment=0
+workspace=
 
 expect_args=4
 while [[ $1 == \-\-* ]]; do
@@ -45,13 +55,23 @@ while [[ $1 == \-\-* ]]; do
     --cross_gender) shift; cross_gender=$1; shift ;;
     --distance) shift; distance=$1; shift ;;
     --proximity) shift; proximity=$1; shift ;;
+    --name) shift; name=$1; shift ;;
+    --cleanup) shift; cleanup=$1; shift ;;
+    --spk-per-utt) shift; spk_per_utt=$1; shift ;;
+    --rand-seed) shift; rand_seed=$1; shift ;;
+    --timings) shift; timings=$1; shift ;;
+    --nj) shift; nj=$1; shift ;;
+    --profile) shift; profile=$1; shift ;;
+    --stages) shift; stages=$1; shift ;;
+    --segment) shift; segment=$1; shift ;;
+    --workspace) shift; workspace=$1; shift ;;
     --*) echo "$0: invalid option '$1'"; exit 1
   esac
 done
 
 if [ $# != $expect_args ]; then
     echo "Usage:"
-    echo "  transform.sh [--anon_pool <anon_pool_dir>|--sample-frequency <nb>|--cross-gender (same|other|random)|--distance (plda|cosine)|--proximity (dense|farthest|random)] --wgender (m|f) <input_file> <output_dir>"
+    echo "  transform.sh [--anon_pool <anon_pool_dir>|--sample-frequency <nb>|--cross-gender (same|other|random)|--distance (plda|cosine)|--proximity (dense|farthest|random)|--name <name>|--cleanup (true|false|tmpfs)|--spk-per-utt (true|false)|--rand-seed <nb>|--timings <file>|--nj <nb>|--profile <dir>|--stages <list>|--segment <seconds>|--workspace <dir>] --wgender (m|f) <input_file> <output_dir>"
     echo "Options:"
     echo "  --wgender (m|f)          # gender of the speaker"
     echo "  --anon-pool <anon_pool>             # path to the anonymization pool to use (must have been built with the ./build.sh script"
@@ -59,18 +79,41 @@ if [ $# != $expect_args ]; then
     echo "  --distance (plda|cosine)            # "
     echo "  --proximity (dense|farthest|random) # "
     echo "  --sample-frequency <nb>             # sampling frequency of the utterance to transform (default: 16000 "
+    echo "  --name <name>                       # name of the data dir of this run, so that several runs can work at the same time (default: single_wav or batch)"
+    echo "  --cleanup (true|false|tmpfs)        # remove the data of this run when it exits; tmpfs: only in the default tmpfs workspace (default: tmpfs, false with --stages)"
+    echo "  --spk-per-utt (true|false)          # with a directory of wav files, each file is a different speaker (default: false)"
+    echo "  --rand-seed <nb>                    # seed of the random choice of the pseudo-speakers (default: 20)"
+    echo "  --timings <file>                    # append the duration of each stage to this file, as '<stage> <seconds>' lines"
+    echo "  --nj <nb>                           # number of parallel jobs (default: number of CPUs)"
+    echo "  --profile <dir>                     # profile of the speaker: loaded if it exists, to skip the stages a.0 and a.1, saved otherwise"
+    echo "  --stages <list>                     # comma-separated stages to run: setup,a.0,...,a.7,copy (default: all), e.g. to run independent stages at the same time (see transform.py)"
+    echo "  --segment <seconds>                 # split an input file longer than this into chunks transformed as parallel jobs with the same pseudo-speaker, then stitched (default: 0, no split)"
+    echo "  --workspace <dir>                   # directory of the intermediate files of the run (default: /dev/shm/vpc if it has room for them, else the vpc directory)"
+    exit 1;
+fi
+
+if [[ -n "$name" && ! "$name" =~ ^[A-Za-z0-9_-]+$ ]]; then
+    echo "$0: invalid name '$name': only letters, digits, '_' and '-' are allowed"
     exit 1;
 fi
 
 
 # Possible options and default values
 debug_level=1
-rand_seed=20
-nj=$(nproc)
+nj=${nj:-$(nproc)}
+clk_tck=$(getconf CLK_TCK)
 
 ipath=$1; shift;
 opath=$1; shift;
 
+# a long input file is split into chunks (see local/segment_wav.py): each chunk is a speaker of the data dir, so that
+# the stages split by speaker run a job per chunk, and the pseudo-speaker of the file is given to all the chunks
+segmented=false
+if [ ! -d "${ipath}" ] && [ "$segment" != 0 ]; then
+  segmented=true
+  spk_per_utt=true
+fi
+
 . cmd.sh
 . ../env.sh
 . path.sh
@@ -86,12 +129,10 @@ results=$opath/${outname}-${results}.wav
 # Chain model for BN PPG extraction
 ppg_type=
 ppg_model=exp/models/1_asr_am/exp
-ppg_dir=${ppg_model}/nnet3_cleaned
 
 
 # x-vector extraction
 xvec_nnet_dir=exp/models/2_xvect_extr/exp/xvector_nnet_1a # change this to pretrained xvector model downloaded from Kaldi website
-anon_xvec_out_dir=${xvec_nnet_dir}/anon
 plda_dir=${xvec_nnet_dir}
 
 
@@ -101,7 +142,7 @@ plda_dir=${xvec_nnet_dir}
 function create_dir () {
 
     
-    dir=data/$1
+    dir=${data_root}/$1
     wavpath=$2
     wavgender=$3
     netcdf=$4
@@ -130,7 +171,7 @@ function create_dir () {
 function create_dir_batch () {
 
     
-    dir=data/$1
+    dir=${data_root}/$1
     
     wavgender=$3
     netcdf=$4
@@ -150,14 +191,22 @@ function create_dir_batch () {
       echo "$id dummy text" >> ${dir}/text
 
       # Create spk2utt and utt2spk
-      #spk="spk-$id"
-      echo "$id $spk" >> ${dir}/utt2spk
-      uttlist="$uttlist $id"
+      if [ "$spk_per_utt" = true ]; then
+        # files sent by different users: each one is anonymized as its own speaker
+        echo "$id spk-$id" >> ${dir}/utt2spk
+        echo "spk-$id $id" >> ${dir}/spk2utt
+        echo "spk-$id $wavgender" >> ${dir}/spk2gender
+      else
+        echo "$id $spk" >> ${dir}/utt2spk
+        uttlist="$uttlist $id"
+      fi
     done
-    echo "$spk $uttlist" > ${dir}/spk2utt
+    if [ "$spk_per_utt" != true ]; then
+      echo "$spk $uttlist" > ${dir}/spk2utt
 
-    # Create spk2gender
-    echo "$spk $wavgender" > ${dir}/spk2gender
+      # Create spk2gender
+      echo "$spk $wavgender" > ${dir}/spk2gender
+    fi
     
 }
 
@@ -169,8 +218,8 @@ function extract_xvectors ()
     nnet_dir=$2
     out_dir=$3
 
-    mfccdir=`pwd`/mfcc
-    vaddir=`pwd`/mfcc
+    mfccdir=${work}/mfcc
+    vaddir=${work}/mfcc
 
     mkdir -p ${out_dir}
     dataname=$(basename $data_dir)
@@ -178,11 +227,11 @@ function extract_xvectors ()
     # Note that train_cmd is defined in cmd.sh (from Kaldi)
 
     steps/make_mfcc.sh --write-utt2num-frames true --mfcc-config conf/mfcc.conf \
-		       --nj $nj --cmd "$train_cmd" ${data_dir} exp/make_mfcc $mfccdir || exit 1
+		       --nj $nj --cmd "$train_cmd" ${data_dir} ${work}/exp/make_mfcc $mfccdir || exit 1
 
     utils/fix_data_dir.sh ${data_dir} || exit 1
     
-    sid/compute_vad_decision.sh --nj $nj --cmd "$train_cmd" ${data_dir} exp/make_vad $vaddir || exit 1
+    sid/compute_vad_decision.sh --nj $nj --cmd "$train_cmd" ${data_dir} ${work}/exp/make_vad $vaddir || exit 1
 
     utils/fix_data_dir.sh ${data_dir} || exit 1
 
@@ -197,108 +246,372 @@ function create_new_data_anon ()
 {
     anon_data_suffix=_anon
     wav_path=${data_netcdf}/${input_wav_dir}/nsf_output_wav
-    new_input_wav_dir=data/${input_wav_dir}${anon_data_suffix}
+    new_input_wav_dir=${data_root}/${input_wav_dir}${anon_data_suffix}
     if [ -d "$new_input_wav_dir" ]; then
 	rm -rf ${new_input_wav_dir}
     fi
-    utils/copy_data_dir.sh data/${input_wav_dir} ${new_input_wav_dir}
+    utils/copy_data_dir.sh ${data_root}/${input_wav_dir} ${new_input_wav_dir}
     [ -f ${new_input_wav_dir}/feats.scp ] && rm ${new_input_wav_dir}/feats.scp
     [ -f ${new_input_wav_dir}/vad.scp ] && rm ${new_input_wav_dir}/vad.scp
     # Copy new spk2gender in case cross_gender vc has been done
     cp ${anon_xvec_out_dir}/xvectors_${input_wav_dir}/pseudo_xvecs/spk2gender ${new_input_wav_dir}/
-    awk -v p="$wav_path" '{print $1, "sox", p"/"$1".wav", "-t wav -R -b 16 - |"}' data/${input_wav_dir}/wav.scp > ${new_input_wav_dir}/wav.scp
+    awk -v p="$wav_path" '{print $1, "sox", p"/"$1".wav", "-t wav -R -b 16 - |"}' ${data_root}/${input_wav_dir}/wav.scp > ${new_input_wav_dir}/wav.scp
+}
+
+function time_stage ()
+{
+    # record the duration (wall and CPU time of the commands) of the current stage in the timings file, then start
+    # the timer of the next one. The CPU time is the time of the children of the script which have ended (cutime and
+    # cstime in /proc/<pid>/stat)
+    now=$(date +%s.%N)
+    read -r -a proc_stat < /proc/$$/stat
+    cpu_ticks=$(( ${proc_stat[15]} + ${proc_stat[16]} ))
+    if [ -n "$timings" ] && [ -n "$current_stage" ]; then
+	awk -v stage=$current_stage -v start=$stage_start -v end=$now \
+	    -v cpu=$(( cpu_ticks - stage_cpu_ticks )) -v clk_tck=$clk_tck \
+	    'BEGIN { printf "%s %.3f %.3f\n", stage, end - start, cpu / clk_tck }' >> $timings
+    fi
+    current_stage=$1
+    stage_start=$now
+    stage_cpu_ticks=$cpu_ticks
 }
 
+function run_stage ()
+{
+    # true if the stage is one of the stages to run (see --stages)
+    [ -z "$stages" ] || [[ ",${stages}," == *",$1,"* ]]
+}
 
+function stage_fingerprint ()
+{
+    # fingerprint of a stage: hash of its config ($2) and of the fingerprints of the stages whose outputs it reads
+    # ($3...), so that it changes when one of its inputs has changed
+    local stage=$1 config=$2 input
+    shift 2
+    {
+	echo "$stage $config"
+	for input in "$@"; do
+	    cat ${fingerprints_dir}/$input 2>/dev/null || echo "$input missing"
+	done
+    } | sha256sum | cut -d' ' -f1
+}
 
-#=========== transformation steps ===========
+function input_fingerprint ()
+{
+    # fingerprint of the data dir: hash of the path, the names and the content of the input wav files
+    if [ -d "${ipath}" ]; then
+	(cd ${ipath} && sha256sum *.wav)
+    else
+	(cd $(dirname ${ipath}) && sha256sum $(basename ${ipath}))
+    fi | { realpath ${ipath}; echo "$wgender $spk_per_utt $segment"; cat; } | sha256sum | cut -d' ' -f1
+}
+
+function up_to_date ()
+{
+    # true if the outputs of the stage have been computed with the same fingerprint
+    if [ -f ${fingerprints_dir}/$1 ] && [ "$(cat ${fingerprints_dir}/$1)" = "$2" ]; then
+	if [ $debug_level -ge 1 ]; then
+	    printf "${RED}\nStage $1: up to date, skipped.${NC}\n"
+	fi
+	return 0
+    fi
+    # the outputs of the stage are not valid until it ends
+    rm -f ${fingerprints_dir}/$1
+    return 1
+}
+
+function save_fingerprint ()
+{
+    mkdir -p ${fingerprints_dir}
+    echo $2 > ${fingerprints_dir}/$1
+}
 
+function make_segmented_pseudospeaker ()
+{
+    # the pseudo-speaker of a segmented file: generated for the mean x-vector of its chunks, in a data dir where they
+    # are the utterances of a single speaker, then given to all the chunks through a profile (see speaker_profile.py)
+    spk_dir=${data_root}/${input_wav_dir}_spk
+    spk_xvec_dir=${anon_xvec_out_dir}/xvectors_${input_wav_dir}_spk
+    rm -rf ${spk_dir} ${spk_xvec_dir}
+    mkdir -p ${spk_dir} ${spk_xvec_dir}
+    spk=spk-$(basename ${ipath} .wav)
+    cp ${data_root}/${input_wav_dir}/wav.scp ${spk_dir}/
+    awk -v spk=$spk '{print $1, spk}' ${data_root}/${input_wav_dir}/wav.scp > ${spk_dir}/utt2spk
+    utils/utt2spk_to_spk2utt.pl ${spk_dir}/utt2spk > ${spk_dir}/spk2utt
+    echo "$spk $wgender" > ${spk_dir}/spk2gender
+    ivector-mean ark:${spk_dir}/spk2utt scp:${anon_xvec_out_dir}/xvectors_${input_wav_dir}/xvector.scp \
+		 ark,scp:${spk_xvec_dir}/spk_xvector.ark,${spk_xvec_dir}/spk_xvector.scp || exit 1
+
+    local/anon/make_pseudospeaker.sh --rand-level ${pseudo_xvec_rand_level} \
+				     --cross-gender ${cross_gender} \
+				     --distance ${distance} \
+				     --proximity ${proximity} \
+				     --rand-seed ${rand_seed} \
+				     ${spk_dir} \
+				     ${anon_pool} \
+				     ${anon_xvec_out_dir} \
+				     ${plda_dir} || exit 1
+
+    # saved to the profile of the speaker if there is one
+    segment_profile=${profile:-${spk_xvec_dir}/profile}
+    python local/anon/speaker_profile.py save ${segment_profile} ${spk_dir} ${spk_xvec_dir} ${profile_params} || exit 1
+    python local/anon/speaker_profile.py load ${segment_profile} ${data_root}/${input_wav_dir} \
+	   ${anon_xvec_out_dir}/xvectors_${input_wav_dir} ${profile_params} || exit 1
+}
+
+function default_workspace ()
+{
+    # the workspace of the previous stages of the run (see --stages), else /dev/shm (tmpfs) if it has room for the
+    # intermediate files of the run: about 10 times the size of the input audio, plus a margin
+    local shm=/dev/shm/vpc needed_kb
+    if [ -d ${shm}/data/${input_wav_dir} ]; then
+	echo ${shm}
+	return
+    fi
+    needed_kb=$(( $(du -skL ${ipath} | cut -f1) * 10 + 512 * 1024 ))
+    if [ ! -d data/${input_wav_dir} ] && [ -d /dev/shm ] && [ -w /dev/shm ] && \
+	   [ $(df -Pk /dev/shm | awk 'NR == 2 {print $4}') -ge $needed_kb ]; then
+	echo ${shm}
+    else
+	echo .
+    fi
+}
+
+function remove_run_data ()
+{
+    # all the files of a run are named after its data dir
+    rm -rf ${data_root}/${input_wav_dir} ${data_root}/${input_wav_dir}_hires ${data_root}/${input_wav_dir}_anon \
+       ${data_root}/${input_wav_dir}_chunks ${data_root}/${input_wav_dir}_spk \
+       ${data_netcdf}/${input_wav_dir} \
+       ${ppg_dir}/ppg_${input_wav_dir} ${ivectors_dir}/ivectors_${input_wav_dir}_hires \
+       ${anon_xvec_out_dir}/xvectors_${input_wav_dir} ${anon_xvec_out_dir}/xvectors_${input_wav_dir}_spk
+    rm -f ${work}/mfcc/*_${input_wav_dir}.* ${work}/exp/make_mfcc/*_${input_wav_dir}.* \
+       ${work}/exp/make_vad/*_${input_wav_dir}.* ${work}/exp/make_pitch/*_${input_wav_dir}.*
+}
+
+
+
+#=========== transformation steps ===========
 
-data_netcdf=$(realpath exp/am_nsf_data)   # directory where features for voice anonymization will be stored
 
+# each run works in its own data dir: <workspace>/data/<name>, and the features dirs named after it
+# the stages whose inputs and config have not changed since the previous run in the same data dir are skipped: each
+# stage saves its fingerprint (see stage_fingerprint) in <workspace>/data/<name>/.fingerprints when it ends
 if [ -d "${ipath}" ] ; then
-  input_wav_dir=batch 
-  create_dir_batch ${input_wav_dir} ${ipath} ${wgender} ${data_netcdf}
+  input_wav_dir=${name:-batch}
 else
-  input_wav_dir=single_wav
-  create_dir ${input_wav_dir} ${ipath} ${wgender} ${data_netcdf}
+  input_wav_dir=${name:-single_wav}
 fi
 
-#=========== remove data from previous run =
-rm -Rf ./exp/am_nsf_data/${input_wav_dir}
-rm -Rf ./exp/models/1_asr_am/exp/nnet3_cleaned/ppg_${input_wav_dir}/
-
-spk2utt=data/$input_wav_dir/spk2utt
-num_spk=$(wc -l < $spk2utt)
-[ $nj -gt $num_spk ] && nj=$num_spk
+# the intermediate files of the run are written in the workspace (absolute paths, as it can be out of the vpc
+# directory), apart from the models and the anonymization pool, which are only read
+work=$(realpath -m ${workspace:-$(default_workspace)})
+mkdir -p ${work}
+data_root=${work}/data
+data_netcdf=${work}/exp/am_nsf_data   # directory where features for voice anonymization will be stored
+ppg_dir=${work}/exp/ppg
+ivectors_dir=${work}/exp/ivectors
+anon_xvec_out_dir=${work}/exp/xvectors
+fingerprints_dir=${data_root}/${input_wav_dir}/.fingerprints
+
+# the data left in the default tmpfs workspace would hold memory until a reboot: it is removed at the end of a whole
+# run, while a stage run separately (see --stages) keeps it for the next stages
+if [ -z "$cleanup" ]; then
+  [ -z "$stages" ] && cleanup=tmpfs || cleanup=false
+fi
+if [ "$cleanup" = tmpfs ]; then
+  [ -z "$workspace" ] && [ "$work" != "$(realpath .)" ] && cleanup=true || cleanup=false
+fi
+# also when the setup fails
+if [ "$cleanup" = true ]; then
+  trap remove_run_data EXIT
+fi
 
-# Extract xvectors from data which has to be anonymized
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.0: Extracting xvectors for ${input_wav_dir}.${NC}\n"
+if run_stage setup; then
+  fingerprint=$(input_fingerprint)
+  if ! up_to_date setup $fingerprint; then
+    time_stage setup
+    if [ -d "${ipath}" ] ; then
+      create_dir_batch ${input_wav_dir} ${ipath} ${wgender} ${data_netcdf}
+    elif [ "$segmented" = true ]; then
+      rm -rf ${data_root}/${input_wav_dir}_chunks
+      python local/segment_wav.py --max-length ${segment} ${ipath} ${data_root}/${input_wav_dir}_chunks || exit 1;
+      create_dir_batch ${input_wav_dir} ${data_root}/${input_wav_dir}_chunks ${wgender} ${data_netcdf}
+    else
+      create_dir ${input_wav_dir} ${ipath} ${wgender} ${data_netcdf}
+    fi
+    rm -f ${anon_xvec_out_dir}/xvectors_${input_wav_dir}/pseudo_xvecs/.profile
+    save_fingerprint setup $fingerprint
+  fi
 fi
-extract_xvectors data/${input_wav_dir} ${xvec_nnet_dir} ${anon_xvec_out_dir} || exit 1;
 
-# Generate pseudo-speakers for source data
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.1: Generating pseudo-speakers for ${input_wav_dir}.${NC}\n"
+spk2utt=${data_root}/$input_wav_dir/spk2utt
+num_spk=0
+[ -f $spk2utt ] && num_spk=$(wc -l < $spk2utt)
+[ $num_spk -gt 0 ] && [ $nj -gt $num_spk ] && nj=$num_spk
+
+# the x-vector and the pseudo-speaker of a returning speaker are loaded from its profile, in place of the stage a.0
+# (the .profile file tells the stage a.1 that it is skipped too, when it runs separately: see --stages)
+profile_params="anon_pool=${anon_pool},xvec_nnet_dir=${xvec_nnet_dir},rand_level=${pseudo_xvec_rand_level}"
+profile_params="${profile_params},cross_gender=${cross_gender},distance=${distance},proximity=${proximity},rand_seed=${rand_seed}"
+profile_loaded=false
+if [ -n "$profile" ] && { run_stage a.0 || run_stage a.1; }; then
+  # the chunks of a segmented file are the same speaker
+  if [ $num_spk -ne 1 ] && [ "$segmented" != true ]; then
+    echo "$0: a profile is for a single speaker, got $num_spk speakers"
+    exit 1;
+  fi
+  pseudo_xvecs_dir=${anon_xvec_out_dir}/xvectors_${input_wav_dir}/pseudo_xvecs
+  if run_stage a.0; then
+    time_stage profile
+    profile_status=0
+    python local/anon/speaker_profile.py load ${profile} ${data_root}/${input_wav_dir} \
+	   ${anon_xvec_out_dir}/xvectors_${input_wav_dir} ${profile_params} || profile_status=$?
+    [ $profile_status -ne 0 ] && [ $profile_status -ne 2 ] && exit 1
+    if [ $profile_status -eq 0 ]; then
+      touch ${pseudo_xvecs_dir}/.profile
+      # the next stages depend on the pseudo-speaker of the profile, whatever the x-vector of this run
+      save_fingerprint a.0 profile
+      save_fingerprint a.1 $(cat ${pseudo_xvecs_dir}/* | sha256sum | cut -d' ' -f1)
+    else
+      rm -f ${pseudo_xvecs_dir}/.profile
+    fi
+  fi
+  [ -f ${pseudo_xvecs_dir}/.profile ] && profile_loaded=true
 fi
-local/anon/make_pseudospeaker.sh --rand-level ${pseudo_xvec_rand_level} \
-      				 --cross-gender ${cross_gender} \
-				 --distance ${distance} \
-				 --proximity ${proximity} \
-				 --rand-seed ${rand_seed} \
-				 data/${input_wav_dir} \
-				 ${anon_pool} \
-                                 ${anon_xvec_out_dir} \
-				 ${plda_dir} || exit 1;
-
-# Extract pitch for source data
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.2: Pitch extraction for ${input_wav_dir}.${NC}\n"
+
+if [ "$profile_loaded" != true ]; then
+  fingerprint=$(stage_fingerprint a.0 "${xvec_nnet_dir}" setup)
+  if run_stage a.0 && ! up_to_date a.0 $fingerprint; then
+    # Extract xvectors from data which has to be anonymized
+    if [ $debug_level -ge 1 ]; then 
+        printf "${RED}\nStage a.0: Extracting xvectors for ${input_wav_dir}.${NC}\n"
+    fi
+    time_stage a.0
+    extract_xvectors ${data_root}/${input_wav_dir} ${xvec_nnet_dir} ${anon_xvec_out_dir} || exit 1;
+    save_fingerprint a.0 $fingerprint
+  fi
+
+  fingerprint=$(stage_fingerprint a.1 "${anon_pool} ${pseudo_xvec_rand_level} ${cross_gender} ${distance} ${proximity} ${rand_seed}" a.0)
+  if run_stage a.1 && ! up_to_date a.1 $fingerprint; then
+    # Generate pseudo-speakers for source data
+    if [ $debug_level -ge 1 ]; then 
+        printf "${RED}\nStage a.1: Generating pseudo-speakers for ${input_wav_dir}.${NC}\n"
+    fi
+    time_stage a.1
+    if [ "$segmented" = true ]; then
+      make_segmented_pseudospeaker
+    else
+      local/anon/make_pseudospeaker.sh --rand-level ${pseudo_xvec_rand_level} \
+            				 --cross-gender ${cross_gender} \
+      				 --distance ${distance} \
+      				 --proximity ${proximity} \
+      				 --rand-seed ${rand_seed} \
+      				 ${data_root}/${input_wav_dir} \
+      				 ${anon_pool} \
+                                       ${anon_xvec_out_dir} \
+      				 ${plda_dir} || exit 1;
+
+      if [ -n "$profile" ]; then
+        time_stage save-profile
+        python local/anon/speaker_profile.py save ${profile} ${data_root}/${input_wav_dir} \
+  	     ${anon_xvec_out_dir}/xvectors_${input_wav_dir} ${profile_params} || exit 1;
+      fi
+    fi
+    save_fingerprint a.1 $fingerprint
+  fi
 fi
-local/featex/make_pitch.sh --nj $nj --cmd "$train_cmd" --sample-frequency $sample_frequency data/${input_wav_dir} \
-			   exp/make_pitch data/${input_wav_dir}/pitch || exit 1;
 
-# Extract PPGs for source data
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.3: PPG extraction for ${input_wav_dir}.${NC}\n"
+fingerprint=$(stage_fingerprint a.2 "${sample_frequency}" setup)
+if run_stage a.2 && ! up_to_date a.2 $fingerprint; then
+  # Extract pitch for source data
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.2: Pitch extraction for ${input_wav_dir}.${NC}\n"
+  fi
+  time_stage a.2
+  local/featex/make_pitch.sh --nj $nj --cmd "$train_cmd" --sample-frequency $sample_frequency ${data_root}/${input_wav_dir} \
+  			   ${work}/exp/make_pitch ${data_root}/${input_wav_dir}/pitch || exit 1;
+  save_fingerprint a.2 $fingerprint
 fi
-local/featex/extract_ppg.sh --nj $nj --stage 0 \
-			    ${input_wav_dir} ${ppg_model} \
-			    ${ppg_dir}/ppg_${input_wav_dir} || exit 1;
 
-# Create netcdf data for voice conversion
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.4: Make netcdf data for VC.${NC}\n"
+fingerprint=$(stage_fingerprint a.3 "${ppg_model}" setup)
+if run_stage a.3 && ! up_to_date a.3 $fingerprint; then
+  # Extract PPGs for source data
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.3: PPG extraction for ${input_wav_dir}.${NC}\n"
+  fi
+  time_stage a.3
+  # remove data from previous run
+  rm -Rf ${ppg_dir}/ppg_${input_wav_dir}/
+  local/featex/extract_ppg.sh --nj $nj --stage 0 --data-root ${data_root} --ivectors-dir ${ivectors_dir} \
+  			    ${input_wav_dir} ${ppg_model} \
+  			    ${ppg_dir}/ppg_${input_wav_dir} || exit 1;
+  save_fingerprint a.3 $fingerprint
 fi
-local/anon/make_netcdf.sh --stage 0 data/${input_wav_dir} \
-	                  ${anon_pool} \
-			  ${ppg_dir}/ppg_${input_wav_dir}/phone_post.scp \
-			  ${anon_xvec_out_dir}/xvectors_${input_wav_dir}/pseudo_xvecs \
-			  ${data_netcdf}/${input_wav_dir} || exit 1;
-
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.5: Extract melspec from acoustic model for ${input_wav_dir}.${NC}\n"
+
+fingerprint=$(stage_fingerprint a.4 "${anon_pool}" a.1 a.2 a.3)
+if run_stage a.4 && ! up_to_date a.4 $fingerprint; then
+  # Create netcdf data for voice conversion
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.4: Make netcdf data for VC.${NC}\n"
+  fi
+  time_stage a.4
+  # remove data from previous run
+  rm -Rf ${data_netcdf}/${input_wav_dir}
+  local/anon/make_netcdf.sh --stage 0 ${data_root}/${input_wav_dir} \
+  	                  ${anon_pool} \
+  			  ${ppg_dir}/ppg_${input_wav_dir}/phone_post.scp \
+  			  ${anon_xvec_out_dir}/xvectors_${input_wav_dir}/pseudo_xvecs \
+  			  ${data_netcdf}/${input_wav_dir} || exit 1;
+  save_fingerprint a.4 $fingerprint
 fi
-local/vc/am/01_gen.sh ${data_netcdf}/${input_wav_dir} ${ppg_type} || exit 1;
 
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.6: Generate waveform from NSF model for ${input_wav_dir}.${NC}\n"
+fingerprint=$(stage_fingerprint a.5 "${ppg_type}" a.4)
+if run_stage a.5 && ! up_to_date a.5 $fingerprint; then
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.5: Extract melspec from acoustic model for ${input_wav_dir}.${NC}\n"
+  fi
+  time_stage a.5
+  local/vc/am/01_gen.sh ${data_netcdf}/${input_wav_dir} ${ppg_type} || exit 1;
+  save_fingerprint a.5 $fingerprint
 fi
-local/vc/nsf/01_gen.sh ${data_netcdf}/${input_wav_dir} || exit 1;
 
-if [ $debug_level -ge 1 ]; then 
-    printf "${RED}\nStage a.7: Creating new data directories corresponding to anonymization.${NC}\n"
+fingerprint=$(stage_fingerprint a.6 "" a.5)
+if run_stage a.6 && ! up_to_date a.6 $fingerprint; then
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.6: Generate waveform from NSF model for ${input_wav_dir}.${NC}\n"
+  fi
+  time_stage a.6
+  local/vc/nsf/01_gen.sh ${data_netcdf}/${input_wav_dir} || exit 1;
+  save_fingerprint a.6 $fingerprint
 fi
-create_new_data_anon 
 
+fingerprint=$(stage_fingerprint a.7 "" a.1 a.6)
+if run_stage a.7 && ! up_to_date a.7 $fingerprint; then
+  if [ $debug_level -ge 1 ]; then 
+      printf "${RED}\nStage a.7: Creating new data directories corresponding to anonymization.${NC}\n"
+  fi
+  time_stage a.7
+  create_new_data_anon 
+  save_fingerprint a.7 $fingerprint
+fi
 
 
 
-if [ ! -z ${opath} ];then
-  cp ${data_netcdf}/${input_wav_dir}/nsf_output_wav/*.wav ${opath}
-else
-  cp ${data_netcdf}/${input_wav_dir}/nsf_output_wav/*.wav ${results}
+if run_stage copy; then
+  time_stage copy
+  if [ "$segmented" = true ]; then
+    # the transformed chunks are stitched back into one file
+    output=${opath:-${results}}
+    [ -d "${output}" ] && output=${output%/}/$(basename ${ipath})
+    python local/stitch_wav.py ${data_root}/${input_wav_dir}_chunks/segments ${data_netcdf}/${input_wav_dir}/nsf_output_wav \
+	   ${output} || exit 1;
+  elif [ ! -z ${opath} ];then
+    cp ${data_netcdf}/${input_wav_dir}/nsf_output_wav/*.wav ${opath}
+  else
+    cp ${data_netcdf}/${input_wav_dir}/nsf_output_wav/*.wav ${results}
+  fi
 fi
+time_stage
 
-exit 0 
+exit 0
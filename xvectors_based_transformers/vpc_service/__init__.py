@@ -0,0 +1 @@
+"""Helpers of the RESTful service (app.py) running the VPC baseline"""
@@ -0,0 +1,160 @@
+"""Admission control of the runs of transform.sh
+
+Each run of transform.sh starts parallel Kaldi jobs (`--nj`). Without a limit, a burst of requests starts many runs
+with `nproc` jobs each, which oversubscribe the host and slow down all the requests. The `AdmissionController` bounds
+the number of runs at the same time and the number of requests waiting for a run, and shares the CPUs between the
+runs. The runs can be given a deadline, after which they are cancelled (see `run_with_deadline`).
+
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+
+class Rejected(Exception):
+    """Raised when a request can't wait for a run: the wait queue is full"""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of a request is exceeded, while waiting for a run or during the run"""
+
+
+class AdmissionController:
+    """Bound the number of runs, and their number of jobs
+
+    A run is admitted when less than `max_running` runs are running and at least one CPU of the budget is free.
+    It gets a share of the free CPUs (its number of jobs, `nj`): `cpus // max_running`, or all the free CPUs for the
+    last run which can be admitted, so that the runs at the same time don't use more than the budget.
+
+    Parameters
+    ----------
+    max_running: int
+        Max number of runs at the same time
+    max_waiting: int
+        Max number of requests waiting for a run. More requests are rejected
+    cpus: int
+        Number of CPUs shared by the runs. Default is the number of CPUs of the host
+
+    Examples
+    --------
+    >>> admission = AdmissionController(max_running=2, max_waiting=8)
+    >>> with admission.admit(deadline=time.monotonic() + 60) as nj:
+    ...     run_with_deadline(['./vpc/transform.sh', '--nj', str(nj), ...], deadline)
+
+    """
+
+    def __init__(self, max_running=2, max_waiting=8, cpus=None):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.cpus = cpus or os.cpu_count() or 1
+        self.nb_running = 0
+        self.nb_waiting = 0
+        self.used_cpus = 0
+        self._condition = threading.Condition()
+
+    def admit(self, deadline=None, bounded=True):
+        """Wait for a run to be admitted
+
+        Parameters
+        ----------
+        deadline: float
+            If set, time (see `time.monotonic`) after which the request stops waiting
+        bounded: bool
+            If False, the request waits even if the wait queue is full (e.g. for the internal runs, whose number is
+            already bounded)
+
+        Returns
+        -------
+        context manager
+            Gives the number of jobs of the run, and ends the run on exit
+
+        Raises
+        ------
+        Rejected
+            If the wait queue is full
+        DeadlineExceeded
+            If the deadline is exceeded before the run is admitted
+        """
+        with self._condition:
+            if bounded and self.nb_waiting >= self.max_waiting and not self._can_run():
+                raise Rejected('{} requests are already waiting'.format(self.nb_waiting))
+            self.nb_waiting += 1
+            try:
+                while not self._can_run():
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        raise DeadlineExceeded('deadline exceeded while waiting for a run')
+                    self._condition.wait(timeout)
+            finally:
+                self.nb_waiting -= 1
+            free_cpus = self.cpus - self.used_cpus
+            if self.nb_running + 1 < self.max_running:
+                nj = max(1, min(free_cpus, self.cpus // self.max_running))
+            else:
+                nj = free_cpus
+            self.nb_running += 1
+            self.used_cpus += nj
+        return _Run(self, nj)
+
+    def _can_run(self):
+        return self.nb_running < self.max_running and self.used_cpus < self.cpus
+
+    def _end(self, nj):
+        with self._condition:
+            self.nb_running -= 1
+            self.used_cpus -= nj
+            self._condition.notify_all()
+
+
+class _Run:
+    def __init__(self, controller, nj):
+        self._controller = controller
+        self.nj = nj
+
+    def __enter__(self):
+        return self.nj
+
+    def __exit__(self, *_):
+        self._controller._end(self.nj)
+
+
+def run_with_deadline(cmd, deadline=None, grace_period=10, **kwargs):
+    """Run a command, and cancel it if the deadline is exceeded
+
+    The command runs in its own process group, so that the processes it starts (e.g. the Kaldi jobs) are cancelled
+    with it: they get a SIGTERM, then a SIGKILL after the grace period.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If the command was cancelled
+    subprocess.CalledProcessError
+        If the command failed
+    """
+    process = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+    try:
+        returncode = process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        _kill_group(process, signal.SIGTERM)
+        try:
+            process.wait(grace_period)
+        except subprocess.TimeoutExpired:
+            _kill_group(process, signal.SIGKILL)
+            process.wait()
+        raise DeadlineExceeded('deadline exceeded, the run was cancelled')
+    except BaseException:
+        _kill_group(process, signal.SIGKILL)
+        process.wait()
+        raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _kill_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,80 @@
+"""Read and write the archives of wav files of the batch endpoint (/vpc/batch)
+
+The archives are zip or tar files (optionally compressed). Only the wav files of an archive are read; the files are
+extracted under generated names, so that the names in the archive are never used as paths.
+
+"""
+
+import os
+import shutil
+import tarfile
+import zipfile
+
+
+ZIP, TAR = 'zip', 'tar'
+MIMETYPES = {ZIP: 'application/zip', TAR: 'application/x-tar'}
+
+
+def get_archive_format(path):
+    """Get the format of an archive (ZIP or TAR), or None if the file is not a zip or tar archive"""
+    if zipfile.is_zipfile(path):
+        return ZIP
+    if tarfile.is_tarfile(path):
+        return TAR
+    return None
+
+
+def extract_wavs(path, output_dir, chunk_size=1 << 20):
+    """Extract the wav files of an archive
+
+    The files are saved as `<output_dir>/<index>.wav`, with the index of the file in the archive on 5 digits, so that
+    they are sorted in the order of the archive.
+
+    Returns
+    -------
+    tuple
+        The format of the archive (ZIP or TAR) and the list of (name in the archive, utterance id) of the wav files
+
+    Raises
+    ------
+    ValueError
+        If the file is not a zip or tar archive
+    """
+    archive_format = get_archive_format(path)
+    if archive_format is None:
+        raise ValueError('not a zip or tar archive')
+
+    files = []
+
+    def extract(name, source):
+        utt_id = '{:05d}'.format(len(files))
+        with open(os.path.join(output_dir, utt_id + '.wav'), 'wb') as f:
+            shutil.copyfileobj(source, f, chunk_size)
+        files.append((name, utt_id))
+
+    if archive_format == ZIP:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.wav'):
+                    with archive.open(info) as source:
+                        extract(info.filename, source)
+    else:
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith('.wav'):
+                    with archive.extractfile(member) as source:
+                        extract(member.name, source)
+    return archive_format, files
+
+
+def write_archive(archive_format, files, path):
+    """Write an archive (ZIP or TAR) with the given (name in the archive, path) files"""
+    if archive_format == ZIP:
+        # the wav files hardly compress: they are stored
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+            for name, file_path in files:
+                archive.write(file_path, name)
+    else:
+        with tarfile.open(path, 'w') as archive:
+            for name, file_path in files:
+                archive.add(file_path, name)
@@ -0,0 +1,128 @@
+"""Group the requests of the service in batches
+
+Each run of transform.sh pays a fixed cost (startup of the Kaldi tools, loading of the x-vector, AM and NSF models,
+...) which is much higher than the cost of a short utterance. The `BatchQueue` collects the files sent by concurrent
+requests and converts them in a single run, then routes each result to its waiting request.
+
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+_Pending = collections.namedtuple('_Pending', ['items', 'futures', 'deadline'])
+
+
+class BatchQueue:
+    """Collect items in batches of up to `max_size` items or `max_wait` seconds, and process each batch at once
+
+    Only the items submitted with the same key are processed in the same batch (e.g. the files to transform with the
+    same params).
+
+    Parameters
+    ----------
+    process_batch: callable
+        Called with a key and a list of items, returns the list of results, in the same order as the items. If it
+        raises an exception, the exception is set on the result of each item of the batch
+    max_size: int
+        Max number of items in a batch
+    max_wait: float
+        Max time (in seconds) an item waits for other items before its batch is processed
+    nb_workers: int
+        Max number of batches processed at the same time
+
+    Examples
+    --------
+    >>> batches = BatchQueue(lambda key, items: [item.upper() for item in items], max_size=8, max_wait=0.2)
+    >>> batches.submit('params', 'a').result()
+    'A'
+
+    """
+
+    def __init__(self, process_batch, max_size=8, max_wait=0.2, nb_workers=1):
+        self.process_batch = process_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+
+        self._executor = ThreadPoolExecutor(nb_workers)
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._nb_pending = 0
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item):
+        """Add an item to the batch of its key
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The result of the item, set when its batch is processed
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('the batch queue is closed')
+            if key not in self._pending:
+                self._pending[key] = _Pending([], [], time.monotonic() + self.max_wait)
+            pending = self._pending[key]
+            pending.items.append(item)
+            pending.futures.append(future)
+            self._nb_pending += 1
+            if len(pending.items) >= self.max_size:
+                self._start(key)
+            self._condition.notify()
+        return future
+
+    def count_pending(self):
+        """Get the number of items submitted and not processed yet"""
+        with self._condition:
+            return self._nb_pending
+
+    def close(self):
+        """Process the pending batches, then stop"""
+        with self._condition:
+            self._closed = True
+            for key in list(self._pending):
+                self._start(key)
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def _dispatch(self):
+        # start the batches which have waited long enough
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                for key, pending in list(self._pending.items()):
+                    if pending.deadline <= now:
+                        self._start(key)
+                timeout = min((p.deadline for p in self._pending.values()), default=now + 1) - now
+                self._condition.wait(max(timeout, 0))
+
+    def _start(self, key):
+        # called with the lock held
+        pending = self._pending.pop(key)
+        self._executor.submit(self._process, key, pending.items, pending.futures)
+
+    def _process(self, key, items, futures):
+        try:
+            self._process_batch(key, items, futures)
+        finally:
+            with self._condition:
+                self._nb_pending -= len(items)
+
+    def _process_batch(self, key, items, futures):
+        try:
+            results = self.process_batch(key, items)
+            if len(results) != len(items):
+                raise RuntimeError('{} results for a batch of {} items'.format(len(results), len(items)))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
@@ -0,0 +1,138 @@
+"""Cache of the results of the service
+
+The same audio file is often sent again with the same params (retries, duplicate uploads, regression tests), and the
+transformation is deterministic for given params and seed. The results are kept on disk, in files named after a hash
+of the audio file and of the normalized params, to be sent again without running the transformation.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+class ResultCache:
+    """On-disk cache of the transformed files, with size- and age-based eviction
+
+    The entries are saved as `<root>/<key[:2]>/<key>.wav`. The modification time of an entry is the time it was
+    added and its access time the last time it was read: the entries older than `max_age` are evicted, then the least
+    recently read ones until the size of the cache is under `max_size`.
+
+    Parameters
+    ----------
+    root: str
+        Directory of the cache
+    max_size: int
+        Max size of the cache, in bytes
+    max_age: float
+        Max age of the entries, in seconds
+
+    """
+
+    def __init__(self, root, max_size=1 << 30, max_age=7 * 24 * 3600):
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def get_key(audio_digest, params):
+        """Get the key of an entry from the SHA-256 of the audio file and the normalized params (a dict)"""
+        return hashlib.sha256('{}|{}'.format(audio_digest, json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+    def open(self, key):
+        """Open the file of an entry, or return None if the entry is missing or too old"""
+        path = self._get_path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        mtime = os.fstat(f.fileno()).st_mtime
+        if now - mtime > self.max_age:
+            f.close()
+            return None
+        # the access time is the last time the entry was read, whatever the mount options
+        try:
+            os.utime(path, (now, mtime))
+        except FileNotFoundError:
+            pass
+        return f
+
+    def put(self, key, path):
+        """Add a copy of a file to the cache, then evict the old entries if needed"""
+        cache_path = self._get_path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(cache_path, uuid.uuid4().hex)
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, cache_path)
+        self.evict()
+
+    def evict(self):
+        """Remove the entries older than `max_age`, then the least recently read ones above `max_size`"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for dir_name in os.listdir(self.root):
+                dir_path = os.path.join(self.root, dir_name)
+                if not os.path.isdir(dir_path):
+                    continue
+                for name in os.listdir(dir_path):
+                    if not name.endswith('.wav'):
+                        continue
+                    path = os.path.join(dir_path, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if now - stat.st_mtime > self.max_age:
+                        _remove(path)
+                    else:
+                        entries.append((stat.st_atime, stat.st_size, path))
+
+            size = sum(entry_size for _, entry_size, _ in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                _remove(path)
+                size -= entry_size
+
+    def _get_path(self, key):
+        return os.path.join(self.root, key[:2], key + '.wav')
+
+
+class HashingReader:
+    """Read a file object and compute the SHA-256 of what has been read"""
+
+    def __init__(self, f):
+        self._f = f
+        self._sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Get the SHA-256 of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,230 @@
+"""Run the transformations as asynchronous jobs
+
+A job is submitted with its input file and its params, and processed in a bounded pool of worker threads. Its status
+(queued, running, done or failed) and its current stage are kept in a sqlite table, so that they survive a restart of
+the service. The result of a job is kept for a retention time after its end, then evicted.
+
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# e.g. "Stage a.3: PPG extraction for job_xxx." printed by transform.sh
+STAGE_PATTERN = re.compile(r'Stage ([a-z]\.\d+): (.*?)\.?$')
+COLOR_PATTERN = re.compile(r'\x1b\[[0-9;]*m')
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the max number of pending jobs is reached"""
+
+
+class JobManager:
+    """Submit jobs and follow them
+
+    Each job has its own directory `<root>/<job id>`, with its input file (`input.wav`), its result (`output.wav`) and
+    the log of its run (`run.log`).
+
+    Parameters
+    ----------
+    root: str
+        Directory of the jobs and of their table (`jobs.sqlite`)
+    run_job: callable
+        Called with the job id, the params, the path to the input file, the path to the result, the path to the log
+        and a callback to report the current stage (called with a str). Raises an exception if the job fails
+    nb_workers: int
+        Number of jobs running at the same time
+    max_pending: int
+        Max number of queued or running jobs. More jobs are refused (`QueueFull`)
+    retention: float
+        Time (in seconds) the jobs and their result are kept after their end
+
+    """
+
+    def __init__(self, root, run_job, nb_workers=1, max_pending=16, retention=3600):
+        self.root = root
+        self.run_job = run_job
+        self.max_pending = max_pending
+        self.retention = retention
+
+        os.makedirs(root, exist_ok=True)
+        self._db_path = os.path.join(root, 'jobs.sqlite')
+        self._lock = threading.Lock()
+        self._execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, stage TEXT, params TEXT, '
+                      'error TEXT, created REAL, started REAL, ended REAL)')
+
+        self._executor = ThreadPoolExecutor(nb_workers)
+        self._stopped = threading.Event()
+        self._recover()
+        self._evictor = threading.Thread(target=self._evict_periodically, daemon=True)
+        self._evictor.start()
+
+    def submit(self, params, source):
+        """Queue a job
+
+        Parameters
+        ----------
+        params: str
+            Params of the job, as given to `run_job`
+        source: file object
+            The input file, copied by chunks in the directory of the job
+
+        Returns
+        -------
+        str
+            The id of the job
+
+        Raises
+        ------
+        QueueFull
+            If `max_pending` jobs are already queued or running
+        """
+        # refuse the job before its upload if possible, and check again once uploaded
+        self._check_pending()
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id))
+        try:
+            with open(self.input_path(job_id), 'wb') as f:
+                shutil.copyfileobj(source, f, 1 << 20)
+            with self._lock:
+                self._check_pending()
+                self._execute('INSERT INTO jobs (id, status, params, created) VALUES (?, ?, ?, ?)',
+                              (job_id, QUEUED, params, time.time()))
+        except BaseException:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            raise
+        self._executor.submit(self._run, job_id, params)
+        return job_id
+
+    def get(self, job_id):
+        """Get the status of a job, as a dict, or None if the job is unknown or evicted"""
+        rows = self._query('SELECT id, status, stage, error, created, started, ended FROM jobs WHERE id = ?',
+                           (job_id,))
+        if not rows:
+            return None
+        keys = ['id', 'status', 'stage', 'error', 'created', 'started', 'ended']
+        return dict(zip(keys, rows[0]))
+
+    def delete(self, job_id):
+        """Remove a job which is not running and its files. Returns False if the job is running or unknown"""
+        with self._lock:
+            job = self.get(job_id)
+            if job is None or job['status'] == RUNNING:
+                return False
+            # a queued job is skipped by its worker
+            self._execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        return True
+
+    def evict(self):
+        """Remove the jobs ended for more than the retention time"""
+        rows = self._query('SELECT id FROM jobs WHERE status IN (?, ?) AND ended < ?',
+                           (DONE, FAILED, time.time() - self.retention))
+        for job_id, in rows:
+            self.delete(job_id)
+
+    def count(self, *statuses):
+        """Get the number of jobs with one of the given statuses"""
+        return self._query('SELECT COUNT(*) FROM jobs WHERE status IN ({})'.format(', '.join('?' * len(statuses))),
+                           statuses)[0][0]
+
+    def close(self):
+        """Wait for the running jobs, then stop"""
+        self._stopped.set()
+        self._executor.shutdown()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def input_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'input.wav')
+
+    def output_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'output.wav')
+
+    def log_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'run.log')
+
+    def _check_pending(self):
+        nb_pending = self.count(QUEUED, RUNNING)
+        if nb_pending >= self.max_pending:
+            raise QueueFull('{} jobs are already pending'.format(nb_pending))
+
+    def _run(self, job_id, params):
+        with self._lock:
+            if self.get(job_id) is None:
+                # deleted while queued
+                return
+            self._execute('UPDATE jobs SET status = ?, started = ? WHERE id = ?', (RUNNING, time.time(), job_id))
+
+        def report_stage(stage):
+            self._execute('UPDATE jobs SET stage = ? WHERE id = ?', (stage, job_id))
+
+        try:
+            self.run_job(job_id, params, self.input_path(job_id), self.output_path(job_id), self.log_path(job_id),
+                         report_stage)
+        except Exception as e:
+            self._execute('UPDATE jobs SET status = ?, error = ?, ended = ? WHERE id = ?',
+                          (FAILED, str(e) or type(e).__name__, time.time(), job_id))
+        else:
+            self._execute('UPDATE jobs SET status = ?, ended = ? WHERE id = ?', (DONE, time.time(), job_id))
+
+    def _recover(self):
+        # after a restart: the running jobs were interrupted, the queued ones are queued again
+        self._execute('UPDATE jobs SET status = ?, error = ?, ended = ? WHERE status = ?',
+                      (FAILED, 'interrupted by a restart of the service', time.time(), RUNNING))
+        for job_id, params in self._query('SELECT id, params FROM jobs WHERE status = ? ORDER BY created', (QUEUED,)):
+            self._executor.submit(self._run, job_id, params)
+
+    def _evict_periodically(self):
+        while not self._stopped.wait(min(self.retention, 60)):
+            self.evict()
+
+    def _connect(self):
+        # a connection per call: the jobs are updated from several threads
+        return sqlite3.connect(self._db_path, timeout=30)
+
+    def _execute(self, sql, args=()):
+        db = self._connect()
+        try:
+            with db:
+                db.execute(sql, args)
+        finally:
+            db.close()
+
+    def _query(self, sql, args=()):
+        db = self._connect()
+        try:
+            return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+
+def run_with_stages(cmd, log_path, report_stage, **kwargs):
+    """Run a command, save its output in a log file and report the stages it prints (see `STAGE_PATTERN`)
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command fails
+    """
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                                   **kwargs)
+        for line in process.stdout:
+            log.write(line)
+            match = STAGE_PATTERN.search(COLOR_PATTERN.sub('', line).strip())
+            if match:
+                report_stage('{}: {}'.format(*match.groups()))
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
@@ -0,0 +1,189 @@
+"""Metrics of the service, exposed in the Prometheus text format
+
+Only the few metric types needed by the service are implemented (counters, gauges and histograms, with labels), so
+that the service doesn't depend on a Prometheus client library.
+
+"""
+
+import bisect
+import threading
+
+
+# from 100 ms to ~30 min: the stages of the transformation take from less than a second to minutes
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2000)
+
+
+class Metric:
+    """A metric with labels
+
+    Parameters
+    ----------
+    name: str
+    documentation: str
+    label_names: tuple of str
+
+    """
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """Get the lines of the metric in the Prometheus text format"""
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return ['{}{} {}'.format(self.name, _format_labels(self.label_names, labels), _format_number(value))]
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A gauge, whose values are set, or computed when rendered (see `set_function`)"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._functions = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Compute the value of the gauge with `function()` when it is rendered"""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def render(self):
+        for key, function in list(self._functions.items()):
+            value = function()
+            with self._lock:
+                self._values[key] = value
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.])
+            counts, total = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def _render_value(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _format_number(bound)
+            lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.label_names + ('le',), labels + (le,)),
+                                                 cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.label_names, labels), _format_number(total[0])))
+        lines.append('{}_count{} {}'.format(self.name, _format_labels(self.label_names, labels), cumulative))
+        return lines
+
+
+class Registry:
+    """The metrics of the service"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Get all the metrics in the Prometheus text format"""
+        return ''.join(line + '\n' for metric in self.metrics for line in metric.render())
+
+
+def read_timings(path, cpu=False):
+    """Read the timings file written by transform.sh (see --timings): one `<stage> <seconds> [<CPU seconds>]` per line
+
+    Parameters
+    ----------
+    path: str
+    cpu: bool
+        If True, read the CPU time of the stages instead of their duration
+
+    Returns
+    -------
+    list of (str, float)
+        The stages and their durations (or CPU times), in the order they ended. Empty if the file doesn't exist
+    """
+    timings = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) in (2, 3) and (not cpu or len(fields) == 3):
+                    timings.append((fields[0], float(fields[2 if cpu else 1])))
+    except FileNotFoundError:
+        pass
+    return timings
+
+
+def format_server_timing(timings, descriptions=None):
+    """Format timings (a list of (name, seconds)) as the value of a Server-Timing header (durations in ms)"""
+    descriptions = descriptions or {}
+    metrics = []
+    for name, seconds in timings:
+        metric = '{};dur={:.1f}'.format(name.replace('.', '_'), seconds * 1000)
+        if name in descriptions:
+            metric += ';desc="{}"'.format(descriptions[name])
+        metrics.append(metric)
+    return ', '.join(metrics)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
@@ -0,0 +1,112 @@
+"""CPU backend of the service: transform in-process with the voice_transformation library
+
+The VoiceMask and VTLN-based transformers of `vtln_based_transformers` need neither Kaldi nor a GPU. Their params
+(built from the target speakers) are loaded once at the startup of the service, then each file is transformed in the
+process of the service: its transformer is fitted on the file itself, as the speaker is unknown.
+
+The library is imported from the `VOICE_TRANSFORMATION_PATH` directory if this variable is set, else from the
+`vtln_based_transformers` directory of this repository, if found, else from the installed packages.
+
+"""
+
+import os
+import pickle
+import sys
+import time
+
+
+METHODS = ('voicemask', 'vtln')
+
+DEFAULT_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '..',
+                                    'vtln_based_transformers')
+
+
+def import_transformer_class(method):
+    """Import the `Transformer` class of a method of the voice_transformation library"""
+    library_path = os.environ.get('VOICE_TRANSFORMATION_PATH', DEFAULT_LIBRARY_PATH)
+    if os.path.isdir(library_path) and library_path not in sys.path:
+        sys.path.append(library_path)
+
+    if method == 'voicemask':
+        from voice_transformation.voicemask import Transformer
+    elif method == 'vtln':
+        from voice_transformation.vtln_based_conversion import Transformer
+    else:
+        raise ValueError('unknown method {}, expected one of {}'.format(method, ', '.join(METHODS)))
+    return Transformer
+
+
+def load_transformer_params(params_path):
+    """Load the params of a method
+
+    Both the params saved by the examples of the library (01_prebuild_params.py, with dill) and the ones saved by
+    apply_transformation.py (--params_file, a dict with the params and the targets) are accepted.
+    """
+    try:
+        import dill as loader
+    except ImportError:
+        loader = pickle
+    with open(params_path, 'rb') as f:
+        saved = loader.load(f)
+    if isinstance(saved, dict) and 'params' in saved:
+        return saved['params']
+    return saved
+
+
+class VoiceTransformationBackend:
+    """Transform audio files in-process with a method of the voice_transformation library
+
+    Parameters
+    ----------
+    method: str
+        voicemask or vtln
+    params_path: str
+        Path to the pre-built params of the method, see `load_transformer_params`
+
+    """
+
+    def __init__(self, method, params_path):
+        self.method = method
+        self.transformer_class = import_transformer_class(method)
+        self.transformer_params = load_transformer_params(params_path)
+        # the targets are the keys of the target pitches, for both methods (none: the voicemask keeps the pitch)
+        self.targets = sorted(self.transformer_class(self.transformer_params).target_pitches or [])
+
+        from voice_transformation.utils.load import load_utterance
+        self._load_utterance = load_utterance
+
+    def transform(self, source_filepath, result_filepath, target=None):
+        """Transform an audio file and save the result as a 16 bits wav file
+
+        Returns
+        -------
+        list of (str, float)
+            The duration (in seconds) of each step: analysis, fit, transform (and synthesis) and save
+
+        Raises
+        ------
+        ValueError
+            If the target is not one of the target speakers of the params
+        """
+        if target is not None and target not in self.targets:
+            raise ValueError('unknown target {}'.format(target))
+
+        timings = []
+        start = time.perf_counter()
+
+        def step(name):
+            nonlocal start
+            now = time.perf_counter()
+            timings.append((name, now - start))
+            start = now
+
+        utterance = self._load_utterance(source_filepath, lazy=False)
+        step('analysis')
+        transformer = self.transformer_class(self.transformer_params)
+        transformer.fit([utterance])
+        step('fit')
+        transformed = transformer.transform(utterance, target=target)
+        step('transform')
+        transformed.save(result_filepath, format='WAV', subtype='PCM_16')
+        step('save')
+        return timings